@@ -1,9 +1,9 @@
-from flask import Flask, request, send_file, jsonify, redirect, Response
+from flask import Flask, request, send_file, jsonify, redirect, Response, stream_with_context
 from flask_cors import CORS
 from docx import Document
 from docx.shared import RGBColor, Pt, Inches
 from docx.oxml import parse_xml
-from docx.oxml.ns import qn
+from docx.oxml.ns import qn, nsdecls
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_BREAK
 import os
 import re
@@ -12,6 +12,12 @@ import json
 import base64
 import requests
 import time
+import copy
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 app = Flask(__name__)
@@ -19,7 +25,8 @@ app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 55 * 1024 * 1024  # 55 MB
 # CORS con restricciones de seguridad - solo permitir orígenes específicos
 allowed_origins = os.getenv('ALLOWED_ORIGINS', 'https://generador-hojas-vida.web.app,https://generador-hojas-vida.firebaseapp.com').split(',')
-CORS(app, origins=allowed_origins, methods=['GET', 'POST', 'DELETE', 'OPTIONS'], allow_headers=['Content-Type'])
+CORS(app, origins=allowed_origins, methods=['GET', 'POST', 'DELETE', 'OPTIONS'], allow_headers=['Content-Type'],
+     expose_headers=['Content-Disposition', 'X-PDF-Backend', 'X-Cache', 'Server-Timing'])
 
 # Configuración de APIs de iLovePDF
 # API Principal: Usada en la API de cursos-certificados (GitHub) - ~250 conversiones
@@ -31,14 +38,19 @@ ILOVEPDF_APIS = [
         # API Principal - Credenciales de la API de cursos-certificados
         # TODO: Reemplazar con las credenciales reales de la API principal
         'public_key': os.getenv('ILOVEPDF_PRIMARY_PUBLIC_KEY', None),  # Agregar aquí la public_key principal
-        'secret_key': os.getenv('ILOVEPDF_PRIMARY_SECRET_KEY', None)   # Agregar aquí la secret_key principal
+        'secret_key': os.getenv('ILOVEPDF_PRIMARY_SECRET_KEY', None),  # Agregar aquí la secret_key principal
+        'peso': int(os.getenv('ILOVEPDF_PRIMARY_PESO', '1')),
+        'creditos': int(os.getenv('ILOVEPDF_PRIMARY_CREDITOS', '250'))
     },
     {
         'name': 'backup',
         # API de Respaldo - Se usa automáticamente cuando la principal se queda sin créditos
         # NOTA: Estas credenciales deben moverse a variables de entorno en producción
         'public_key': os.getenv('ILOVEPDF_BACKUP_PUBLIC_KEY', 'project_public_e8de4c9dde8d3130930dc8f9620f9fd0_4gcUq34631a35630e89502c9cb2229d123ff4'),
-        'secret_key': os.getenv('ILOVEPDF_BACKUP_SECRET_KEY', 'secret_key_5f1ab1bb9dc866aadc8a05671e460491_zNqoaf28f8b33e1755f025940359d1d4a70a3')
+        'secret_key': os.getenv('ILOVEPDF_BACKUP_SECRET_KEY', 'secret_key_5f1ab1bb9dc866aadc8a05671e460491_zNqoaf28f8b33e1755f025940359d1d4a70a3'),
+        # Peso 0: solo se usa cuando la principal no está disponible
+        'peso': int(os.getenv('ILOVEPDF_BACKUP_PESO', '0')),
+        'creditos': int(os.getenv('ILOVEPDF_BACKUP_CREDITOS', '250'))
     }
 ]
 
@@ -49,8 +61,28 @@ ILOVEPDF_APIS = [
 #    - ILOVEPDF_PRIMARY_PUBLIC_KEY = "tu_public_key_aqui"
 #    - ILOVEPDF_PRIMARY_SECRET_KEY = "tu_secret_key_aqui"
 
-# Variable para rastrear qué API está activa
-current_api_index = 0
+# Estado de cada clave (créditos, circuit breaker): ver PoolIlovepdf
+ILOVEPDF_FALLOS_MAX = int(os.getenv('ILOVEPDF_FALLOS_MAX', '3'))               # errores transitorios seguidos que abren el breaker
+ILOVEPDF_ENFRIAMIENTO = float(os.getenv('ILOVEPDF_ENFRIAMIENTO', '60'))        # segundos con el breaker abierto
+ILOVEPDF_REPROBAR = float(os.getenv('ILOVEPDF_REPROBAR', '1800'))              # cada cuánto se vuelve a probar una clave agotada
+ILOVEPDF_REINTENTOS = int(os.getenv('ILOVEPDF_REINTENTOS', '2'))               # reintentos extra por errores transitorios
+# Conversiones en lote: archivos por tarea y subidas simultáneas dentro de una tarea
+ILOVEPDF_LOTE_MAX = int(os.getenv('ILOVEPDF_LOTE_MAX', '50'))
+ILOVEPDF_SUBIDAS_PARALELAS = int(os.getenv('ILOVEPDF_SUBIDAS_PARALELAS', '4'))
+
+# URL base de la API de iLovePDF (se puede apuntar a un servidor local de pruebas)
+ILOVEPDF_BASE_URL = os.getenv('ILOVEPDF_BASE_URL', 'https://api.ilovepdf.com').rstrip('/')
+
+# Timeout de lectura (segundos) de cada paso de la conversión; se ajustan con ILOVEPDF_TIMEOUT_<PASO>
+ILOVEPDF_TIMEOUTS = {
+    paso: float(os.getenv(f'ILOVEPDF_TIMEOUT_{paso.upper()}', str(valor)))
+    for paso, valor in {'auth': 10, 'start': 10, 'upload': 60, 'process': 120, 'estado': 10, 'download': 60}.items()
+}
+ILOVEPDF_TIMEOUT_CONEXION = float(os.getenv('ILOVEPDF_TIMEOUT_CONEXION', '5'))
+# Espera a que la tarea quede lista: sondeo con backoff exponencial (ESPERA_MIN -> ESPERA_MAX) hasta ESPERA_TOTAL
+ILOVEPDF_ESPERA_MIN = float(os.getenv('ILOVEPDF_ESPERA_MIN', '0.1'))
+ILOVEPDF_ESPERA_MAX = float(os.getenv('ILOVEPDF_ESPERA_MAX', '2'))
+ILOVEPDF_ESPERA_TOTAL = float(os.getenv('ILOVEPDF_ESPERA_TOTAL', '120'))
 
 # Meses en español
 MESES = {
@@ -107,12 +139,20 @@ def root():
         "endpoints": {
             "/health": "GET - Verificar estado del servidor",
             "/upload-attachments": "POST - Subir anexos a R2 (clientName, clientId, attachments).",
+            "/upload-attachments/stream": "POST - Subir anexos a R2 con multipart/form-data (un campo de archivo por anexo), en streaming.",
             "/drive-download": "GET - Descargar archivo desde R2 (file_id r2/..., file_name). Para admin.",
             "/list-folder": "GET - Listar archivos en R2 (folder_id r2/anexos/...). Para admin.",
             "/delete-attachment": "DELETE - Eliminar archivo en R2 (file_id r2/...). Para admin.",
-            "/generate-word": "POST - Generar documento Word (Hoja de Vida)",
-            "/generate-cuenta-cobro": "POST - Generar cuenta de cobro desde template",
-            "/convert-word-to-pdf": "POST - Convertir Word a PDF usando iLovePDF"
+            "/generate-word": "POST - Generar documento Word (Hoja de Vida). format=pdf devuelve el PDF",
+            "/generate-cuenta-cobro": "POST - Generar cuenta de cobro desde template. format=pdf devuelve el PDF",
+            "/generate-cuenta-cobro/batch": "POST - Generar varias cuentas de cobro (ZIP con manifest.json). format=pdf para PDFs",
+            "/templates": "GET - Catálogo de templates (versión, tamaño, tiempo de parseo). ?cargar=1 para cargarlos todos",
+            "/templates/cache-stats": "GET - Estadísticas del catálogo de templates en memoria",
+            "/render-cache/stats": "GET - Estadísticas de la caché de documentos generados",
+            "/convert-word-to-pdf": "POST - Convertir Word a PDF (LibreOffice local o iLovePDF; campo 'backend')",
+            "/convert-word-to-pdf/batch": "POST - Convertir varios Word a PDF en una sola tarea (campo 'files'); ZIP con manifest.json",
+            "/pdf-cache/stats": "GET - Estadísticas de la caché de PDFs convertidos (disco y R2)",
+            "/pdf-backends": "GET - Backend de conversión a PDF activo, estado del pool de LibreOffice y de las claves de iLovePDF"
         }
     })
 
@@ -159,6 +199,8 @@ ATTACHMENT_NAMES = {
 }
 
 _r2_client = None
+# Subidas simultáneas de anexos a R2 (el pool de conexiones del cliente se dimensiona igual)
+R2_UPLOAD_WORKERS = max(int(os.getenv('R2_UPLOAD_WORKERS', '8')), 1)
 
 def get_r2_client():
     """Cliente S3-compatible para Cloudflare R2. Requiere R2_S3_ENDPOINT, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME."""
@@ -179,7 +221,7 @@ def get_r2_client():
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
             region_name='auto',
-            config=Config(signature_version='s3v4')
+            config=Config(signature_version='s3v4', max_pool_connections=max(R2_UPLOAD_WORKERS, 10))
         )
         return _r2_client
     except Exception as e:
@@ -205,65 +247,106 @@ def _data_url_to_bytes(data_url):
     except Exception:
         return None, mime
 
+def _carpeta_anexos(client_name, client_id):
+    """(folder_name, prefix) de los anexos de un cliente: anexos/Nombre_Cliente_NumDoc/."""
+    # Nombre del cliente (legible) + número de documento para unicidad
+    name = re.sub(r'[\s/\\?*:]+', '_', (client_name or '').strip()).strip('_') or 'Cliente'
+    cid = re.sub(r'[\s/\\?*:]+', '_', (client_id or '').strip()).strip('_') or ''
+    folder_name = f"{name}_{cid}".replace('__', '_').strip('_') or 'cliente_doc'
+    return folder_name, f'anexos/{folder_name}/'
+
+def _nombre_anexo(key, fname):
+    """Nombre del archivo en R2: etiqueta de ATTACHMENT_NAMES + extensión permitida (pdf por defecto)."""
+    label = ATTACHMENT_NAMES.get(key, key)
+    fname = (fname or 'documento').strip()
+    ext = fname.split('.')[-1] if '.' in fname else 'pdf'
+    if ext.lower() not in ('pdf', 'jpg', 'jpeg', 'png', 'doc', 'docx'):
+        ext = 'pdf'
+    return f'{label}.{ext}'
+
+def _anexo_subido(key, file_name, key_path):
+    """Entrada de uploaded_files para un anexo ya guardado en R2."""
+    from urllib.parse import quote
+    file_id_r2 = f'r2/{key_path}'
+    api_base = os.getenv('API_PUBLIC_URL', 'https://api-hv.onrender.com').rstrip('/')
+    web_link = f'{api_base}/drive-download?file_id={quote(file_id_r2, safe="")}&file_name={quote(file_name, safe="")}'
+    return {
+        'key': key,
+        'name': file_name,
+        'file_id': file_id_r2,
+        'web_link': web_link,
+    }
+
+def _resultado_anexos(folder_name, prefix, uploaded_files, errors):
+    """Respuesta de /upload-attachments (la misma para JSON con data URLs y para multipart)."""
+    folder_id_r2 = f'r2/{prefix.rstrip("/")}'
+    return {
+        'success': True,
+        'folder_name': folder_name,
+        'folder_id': folder_id_r2,
+        'drive_folder_link': folder_id_r2,
+        'uploaded_files': uploaded_files,
+        'errors': errors,
+        'storage_type': 'r2',
+        'message': f'Se subieron {len(uploaded_files)} archivo(s) a Cloudflare R2.',
+    }
+
 def _upload_attachments_to_r2(client_name, client_id, attachments):
     """Sube anexos a R2. Carpeta = anexos/Nombre_Cliente_NumDoc para identificar por nombre del cliente."""
     client = get_r2_client()
     bucket = get_r2_bucket_name()
     if not client or not bucket:
         return None
-    # Nombre del cliente (legible) + número de documento para unicidad
-    name = re.sub(r'[\s/\\?*:]+', '_', (client_name or '').strip()).strip('_') or 'Cliente'
-    cid = re.sub(r'[\s/\\?*:]+', '_', (client_id or '').strip()).strip('_') or ''
-    folder_name = f"{name}_{cid}".replace('__', '_').strip('_') or 'cliente_doc'
-    prefix = f'anexos/{folder_name}/'
+    folder_name, prefix = _carpeta_anexos(client_name, client_id)
+    from boto3.s3.transfer import TransferConfig
+    from concurrent.futures import ThreadPoolExecutor
+    # Cada subida corre en un hilo del pool: sin hilos propios de s3transfer por archivo
+    transfer_config = TransferConfig(use_threads=False)
+    
+    def subir(key, file_name, key_path, data_url):
+        """(archivo subido, None) o (None, error) para un anexo."""
+        # Se decodifica en el hilo: solo hay en memoria los anexos que se están subiendo
+        raw, content_type = _data_url_to_bytes(data_url)
+        if raw is None:
+            return None, f'Error decodificando {key} ({file_name})'
+        try:
+            client.upload_fileobj(
+                io.BytesIO(raw),
+                bucket,
+                key_path,
+                ExtraArgs={'ContentType': content_type or 'application/octet-stream'},
+                Config=transfer_config
+            )
+            return _anexo_subido(key, file_name, key_path), None
+        except Exception as e:
+            err_msg = str(e).split('\n')[0][:200] if e else 'Error desconocido'
+            return None, f'Error subiendo {key} ({file_name}): {err_msg}'
+    
     uploaded_files = []
     errors = []
     try:
+        # Los resultados se leen en el orden de los anexos: uploaded_files y errors salen en el
+        # mismo orden que antes aunque las subidas terminen desordenadas
+        pendientes = []
         for key, att in attachments.items():
             if not att or not att.get('dataUrl'):
                 continue
-            label = ATTACHMENT_NAMES.get(key, key)
-            fname = (att.get('name') or 'documento').strip()
-            ext = fname.split('.')[-1] if '.' in fname else 'pdf'
-            if ext.lower() not in ('pdf', 'jpg', 'jpeg', 'png', 'doc', 'docx'):
-                ext = 'pdf'
-            file_name = f'{label}.{ext}'
-            key_path = prefix + file_name
-            raw, content_type = _data_url_to_bytes(att['dataUrl'])
-            if raw is None:
-                errors.append(f'Error decodificando {key} ({file_name})')
-                continue
-            try:
-                client.upload_fileobj(
-                    io.BytesIO(raw),
-                    bucket,
-                    key_path,
-                    ExtraArgs={'ContentType': content_type or 'application/octet-stream'}
-                )
-                file_id_r2 = f'r2/{key_path}'
-                from urllib.parse import quote
-                api_base = os.getenv('API_PUBLIC_URL', 'https://api-hv.onrender.com').rstrip('/')
-                web_link = f'{api_base}/drive-download?file_id={quote(file_id_r2, safe="")}&file_name={quote(file_name, safe="")}'
-                uploaded_files.append({
-                    'key': key,
-                    'name': file_name,
-                    'file_id': file_id_r2,
-                    'web_link': web_link,
-                })
-            except Exception as e:
-                err_msg = str(e).split('\n')[0][:200] if e else 'Error desconocido'
-                errors.append(f'Error subiendo {key} ({file_name}): {err_msg}')
-        folder_id_r2 = f'r2/{prefix.rstrip("/")}'
-        return {
-            'success': True,
-            'folder_name': folder_name,
-            'folder_id': folder_id_r2,
-            'drive_folder_link': folder_id_r2,
-            'uploaded_files': uploaded_files,
-            'errors': errors,
-            'storage_type': 'r2',
-            'message': f'Se subieron {len(uploaded_files)} archivo(s) a Cloudflare R2.',
-        }
+            file_name = _nombre_anexo(key, att.get('name'))
+            pendientes.append((key, file_name, prefix + file_name, att['dataUrl']))
+        
+        resultados = []
+        if pendientes:
+            # El cliente de boto3 es seguro entre hilos: todas las subidas lo comparten
+            with ThreadPoolExecutor(max_workers=min(R2_UPLOAD_WORKERS, len(pendientes))) as executor:
+                futuros = [executor.submit(subir, *args) for args in pendientes]
+                resultados = [futuro.result() for futuro in futuros]
+        
+        for subido, error in resultados:
+            if subido is not None:
+                uploaded_files.append(subido)
+            else:
+                errors.append(error)
+        return _resultado_anexos(folder_name, prefix, uploaded_files, errors)
     except Exception as e:
         print('R2 upload error:', e)
         return None
@@ -289,6 +372,201 @@ def upload_attachments():
         }), 503
     return jsonify(result)
 
+# --- Subida de anexos en streaming (multipart/form-data) ---
+# Cada archivo pasa del cuerpo de la petición a R2 en partes de tamaño fijo: en memoria solo hay
+# una parte por petición, sin base64 ni copia completa del archivo.
+R2_PARTE_MB = max(float(os.getenv('R2_PARTE_MB', '8')), 5)        # S3/R2: mínimo 5 MB por parte (salvo la última)
+ANEXOS_STREAM_MAX_MB = float(os.getenv('ANEXOS_STREAM_MAX_MB', '200'))
+ANEXOS_STREAM_BLOQUE = 64 * 1024
+
+class _SubidaR2EnPartes:
+    """
+    Sube un archivo a R2 a medida que llegan los bytes. Con menos de una parte se hace un solo
+    put_object; si no, multipart upload con partes de exactamente R2_PARTE_MB (R2 exige que todas
+    menos la última midan lo mismo). Si algo falla se aborta el multipart para no dejar partes huérfanas.
+    """
+    
+    def __init__(self, client, bucket, key_path, content_type):
+        self.client = client
+        self.bucket = bucket
+        self.key_path = key_path
+        self.content_type = content_type or 'application/octet-stream'
+        self.tamaño_parte = int(R2_PARTE_MB * 1024 * 1024)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._partes = []
+        self.bytes = 0
+    
+    def _subir_parte(self, datos):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key_path, ContentType=self.content_type)['UploadId']
+        numero = len(self._partes) + 1
+        respuesta = self.client.upload_part(Bucket=self.bucket, Key=self.key_path, UploadId=self._upload_id,
+                                            PartNumber=numero, Body=bytes(datos))
+        self._partes.append({'ETag': respuesta['ETag'], 'PartNumber': numero})
+    
+    def escribir(self, datos):
+        self.bytes += len(datos)
+        datos = memoryview(datos)
+        while datos:
+            # Se llena el buffer justo hasta el tamaño de parte para no copiar más de una parte
+            hueco = self.tamaño_parte - len(self._buffer)
+            self._buffer += datos[:hueco]
+            datos = datos[hueco:]
+            if len(self._buffer) == self.tamaño_parte:
+                self._subir_parte(self._buffer)
+                self._buffer = bytearray()
+    
+    def terminar(self):
+        """Sube lo que queda y cierra la subida."""
+        if self._upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key_path, Body=bytes(self._buffer),
+                                   ContentType=self.content_type)
+        else:
+            if self._buffer:
+                self._subir_parte(self._buffer)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key_path, UploadId=self._upload_id,
+                                                  MultipartUpload={'Parts': self._partes})
+        self._buffer = bytearray()
+    
+    def abortar(self):
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key_path, UploadId=self._upload_id)
+            except Exception as e:
+                print('R2 abort error:', e)
+
+def _upload_attachments_stream_to_r2(client, bucket, stream, boundary, client_name='', client_id=''):
+    """
+    Lee un cuerpo multipart/form-data con MultipartDecoder y sube cada archivo (el nombre del campo
+    es la clave del anexo: cedula, rut, ...) mientras llega. clientName y clientId pueden venir como
+    campos, antes del primer archivo. Devuelve (resultado, error): si hay error pero ya se subieron
+    archivos, resultado trae esos archivos (quedan en R2) para que el cliente conozca sus claves.
+    Si el cuerpo se corta o es inválido, aborta la subida en curso y relanza la excepción.
+    """
+    from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+    # El buffer del decoder se vacía en cada bloque: basta con unos pocos bloques de margen
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=4 * ANEXOS_STREAM_BLOQUE)
+    campos = {'clientName': client_name, 'clientId': client_id}
+    folder_name = prefix = None
+    uploaded_files = []
+    errors = []
+    campo = None        # nombre del campo de texto en curso
+    texto = bytearray()
+    actual = None       # (key, file_name, _SubidaR2EnPartes) del archivo en curso
+    fallido = False     # el archivo en curso ya falló: se descarta el resto de sus datos
+    
+    def fallar(mensaje):
+        if uploaded_files:
+            return _resultado_anexos(folder_name, prefix, uploaded_files, errors), mensaje
+        return None, mensaje
+    
+    try:
+        while True:
+            bloque = stream.read(ANEXOS_STREAM_BLOQUE)
+            decoder.receive_data(bloque or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, Field):
+                    campo, texto = event.name, bytearray()
+                elif isinstance(event, File):
+                    campo = None
+                    if prefix is None:
+                        if not (campos['clientName'] or '').strip() or not (campos['clientId'] or '').strip():
+                            return fallar('Se requiere clientName y clientId antes de los archivos')
+                        folder_name, prefix = _carpeta_anexos(campos['clientName'].strip(), campos['clientId'].strip())
+                    file_name = _nombre_anexo(event.name, event.filename)
+                    subida = _SubidaR2EnPartes(client, bucket, prefix + file_name, event.headers.get('Content-Type'))
+                    actual, fallido = (event.name, file_name, subida), False
+                elif isinstance(event, Data):
+                    if campo is not None:
+                        texto += event.data
+                        if len(texto) > ANEXOS_STREAM_BLOQUE:
+                            return fallar(f'Campo {campo} demasiado largo')
+                        if not event.more_data:
+                            campos[campo] = texto.decode('utf-8', 'replace')
+                            campo = None
+                    elif actual is not None:
+                        key, file_name, subida = actual
+                        try:
+                            if not fallido and event.data:
+                                subida.escribir(event.data)
+                            if not event.more_data and not fallido:
+                                # Campo de archivo vacío (no se eligió archivo): se omite, como un anexo sin dataUrl
+                                if subida.bytes:
+                                    subida.terminar()
+                                    uploaded_files.append(_anexo_subido(key, file_name, subida.key_path))
+                        except Exception as e:
+                            fallido = True
+                            subida.abortar()
+                            err_msg = str(e).split('\n')[0][:200] if e else 'Error desconocido'
+                            errors.append(f'Error subiendo {key} ({file_name}): {err_msg}')
+                        if not event.more_data:
+                            actual = None
+                event = decoder.next_event()
+            if not bloque or isinstance(event, Epilogue):
+                break
+    except BaseException:
+        # Cuerpo inválido, cliente desconectado o límite superado a mitad de un archivo:
+        # sin abort el multipart queda huérfano en el bucket (y se cobra)
+        if actual is not None and not fallido:
+            actual[2].abortar()
+        raise
+    
+    if actual is not None:
+        # El cuerpo terminó a mitad de un archivo
+        actual[2].abortar()
+        errors.append(f'Error subiendo {actual[0]} ({actual[1]}): cuerpo multipart incompleto')
+    if prefix is None:
+        return fallar('No se proporcionaron anexos (archivos)')
+    return _resultado_anexos(folder_name, prefix, uploaded_files, errors), None
+
+@app.route('/upload-attachments/stream', methods=['POST', 'OPTIONS'])
+def upload_attachments_stream():
+    """
+    Igual que /upload-attachments pero con multipart/form-data: un campo de archivo por anexo
+    (nombre del campo = clave: cedula, rut, eps, ...) y clientName/clientId como campos previos o
+    en la URL. Los archivos van directo a R2 por partes; no aplica el límite de 55 MB del JSON.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+    from werkzeug.http import parse_options_header
+    from werkzeug.wsgi import get_input_stream
+    mimetype, opciones = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = opciones.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'Se esperaba multipart/form-data', 'success': False}), 400
+    client = get_r2_client()
+    bucket = get_r2_bucket_name()
+    if not client or not bucket:
+        return jsonify({
+            'error': 'R2 no configurado. En Render configura R2_S3_ENDPOINT, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME. Ver R2_SETUP.md.',
+            'success': False,
+        }), 503
+    try:
+        # Stream crudo con su propio límite (MAX_CONTENT_LENGTH es para los JSON con base64)
+        stream = get_input_stream(request.environ, max_content_length=int(ANEXOS_STREAM_MAX_MB * 1024 * 1024))
+        result, error = _upload_attachments_stream_to_r2(
+            client, bucket, stream, boundary,
+            request.args.get('clientName', ''), request.args.get('clientId', ''))
+    except RequestEntityTooLarge:
+        return jsonify({
+            'error': f'Los archivos superan {ANEXOS_STREAM_MAX_MB:g} MB en total. Sube menos archivos a la vez.',
+            'success': False,
+        }), 413
+    except ClientDisconnected:
+        return jsonify({'error': 'El cuerpo de la petición llegó incompleto', 'success': False}), 400
+    except ValueError as e:
+        # Cuerpo multipart mal formado
+        return jsonify({'error': f'Multipart inválido: {e}', 'success': False}), 400
+    if error:
+        # Lo ya subido se informa igual: esos archivos quedaron en R2
+        return jsonify({**(result or {}), 'error': error, 'success': False}), 400
+    return jsonify(result)
+
 @app.route('/drive-download', methods=['GET'])
 def drive_download():
     """
@@ -381,196 +659,1397 @@ def delete_attachment():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def convert_word_to_pdf_with_ilovepdf(word_file_bytes, filename='document.docx'):
+# --- Latencias por paso (se devuelven en la cabecera Server-Timing) ---
+@contextmanager
+def medir_paso(tiempos, paso):
+    """Suma a tiempos[paso] los milisegundos del bloque (no hace nada si tiempos es None)."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        if tiempos is not None:
+            tiempos[paso] = round(tiempos.get(paso, 0) + (time.perf_counter() - inicio) * 1000, 1)
+
+def cabecera_server_timing(tiempos):
+    """'paso;dur=ms, ...' en el formato de la cabecera Server-Timing."""
+    return ', '.join(f'{paso};dur={ms}' for paso, ms in tiempos.items())
+
+# --- Cliente iLovePDF: sesiones keep-alive por servidor y token reutilizado hasta que vence ---
+_ilovepdf_sesiones = {}
+_ilovepdf_tokens = {}  # public_key -> (token, vence_en monotonic)
+_ilovepdf_lock = threading.Lock()
+
+def _sesion_ilovepdf(url_base):
+    """requests.Session (pool de conexiones keep-alive) por servidor de iLovePDF: un solo handshake TLS."""
+    with _ilovepdf_lock:
+        sesion = _ilovepdf_sesiones.get(url_base)
+        if sesion is None:
+            from requests.adapters import HTTPAdapter
+            sesion = requests.Session()
+            adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            sesion.mount('https://', adaptador)
+            sesion.mount('http://', adaptador)
+            _ilovepdf_sesiones[url_base] = sesion
+        return sesion
+
+def _timeout_ilovepdf(paso):
+    """(conexión, lectura) para requests según el paso de la conversión."""
+    return (ILOVEPDF_TIMEOUT_CONEXION, ILOVEPDF_TIMEOUTS[paso])
+
+def _url_servidor_ilovepdf(server):
+    """URL de un servidor de tareas devuelto por /v1/start, con el mismo esquema que ILOVEPDF_BASE_URL."""
+    esquema = ILOVEPDF_BASE_URL.split('://', 1)[0] if '://' in ILOVEPDF_BASE_URL else 'https'
+    return f'{esquema}://{server}'
+
+def _vencimiento_token(token):
+    """Segundos de vida del JWT según su claim 'exp' (1 hora si no se puede leer)."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return max(float(exp) - time.time(), 0)
+    except Exception:
+        pass
+    return 3600
+
+class ErrorIlovepdf(Exception):
+    """
+    Error de una llamada a iLovePDF. `tipo`: 'creditos' (la clave no tiene créditos), 'auth'
+    (credenciales o token rechazados), 'transitorio' (red, timeout, 429, 5xx) o 'peticion'
+    (archivo o tarea inválidos: cambiar de clave no ayuda).
+    """
+    
+    def __init__(self, mensaje, tipo='peticion', status=None):
+        super().__init__(mensaje)
+        self.tipo = tipo
+        self.status = status
+
+ILOVEPDF_INDICADORES_CREDITOS = ('credits', 'quota', 'insufficient', 'balance')
+
+def _error_ilovepdf(response, accion):
     """
-    Convierte un archivo Word a PDF usando la API de iLovePDF con fallback automático
-    si se acaban los créditos.
+    ErrorIlovepdf para una respuesta no-200, clasificado por código HTTP. El mensaje solo se mira
+    en 401/403/429 (así avisa iLovePDF que se acabaron los créditos): un 503 que mencione "quota"
+    no debe dejar la clave como agotada.
     """
-    global current_api_index
+    status = response.status_code
+    texto = response.text.strip()
+    try:
+        cuerpo = response.json()
+    except ValueError:
+        cuerpo = None
+    error = cuerpo.get('error') if isinstance(cuerpo, dict) else None
+    if isinstance(error, dict):
+        # Formato de iLovePDF: {"error": {"type": "AuthError", "message": "Not enough credits", ...}}
+        detalle = f"{error.get('type') or ''} {error.get('message') or ''}"
+    else:
+        detalle = texto
+    if status == 402 or (status in (401, 403, 429)
+                         and any(ind in detalle.lower() for ind in ILOVEPDF_INDICADORES_CREDITOS)):
+        tipo = 'creditos'
+    elif status in (401, 403):
+        tipo = 'auth'
+    elif status in (408, 429) or status >= 500:
+        tipo = 'transitorio'
+    else:
+        tipo = 'peticion'
+    return ErrorIlovepdf(f"{accion} ({status}): {texto}", tipo, status)
+
+def _token_ilovepdf(api_config):
+    """Token de autenticación de la API, reutilizado hasta 60 s antes de que venza."""
+    public_key = api_config['public_key']
+    with _ilovepdf_lock:
+        guardado = _ilovepdf_tokens.get(public_key)
+    if guardado and time.monotonic() < guardado[1]:
+        return guardado[0]
     
-    max_retries = len(ILOVEPDF_APIS)
+    try:
+        auth_response = _sesion_ilovepdf(ILOVEPDF_BASE_URL).post(f'{ILOVEPDF_BASE_URL}/v1/auth', json={
+            'public_key': public_key
+        }, timeout=_timeout_ilovepdf('auth'))
+    except requests.RequestException as e:
+        raise ErrorIlovepdf(f"Error de red con iLovePDF: {e}", 'transitorio')
     
-    for attempt in range(max_retries):
-        api_config = ILOVEPDF_APIS[current_api_index]
-        
-        # Si no hay credenciales configuradas, saltar esta API
-        if not api_config['public_key'] or not api_config['secret_key']:
-            current_api_index = (current_api_index + 1) % len(ILOVEPDF_APIS)
-            continue
-        
-        try:
-            # Paso 1: Autenticarse y obtener token
-            auth_url = 'https://api.ilovepdf.com/v1/auth'
-            auth_response = requests.post(auth_url, json={
-                'public_key': api_config['public_key']
+    # Verificar respuesta de autenticación
+    if auth_response.status_code != 200:
+        raise _error_ilovepdf(auth_response, 'Error de autenticación')
+    
+    token = auth_response.json().get('token')
+    if not token:
+        raise ErrorIlovepdf("No se recibió token de autenticación", 'transitorio')
+    with _ilovepdf_lock:
+        _ilovepdf_tokens[public_key] = (token, time.monotonic() + _vencimiento_token(token) - 60)
+    return token
+
+def _olvidar_token_ilovepdf(api_config):
+    with _ilovepdf_lock:
+        _ilovepdf_tokens.pop(api_config['public_key'], None)
+
+# Estados de /v1/task: TaskWaiting y TaskProcessing siguen en curso, TaskSuccess* ya se puede descargar
+ILOVEPDF_ESTADOS_FALLIDOS = ('TaskError', 'TaskDeleted', 'TaskNotFound')
+ILOVEPDF_DESCARGA_NO_LISTA = (404, 409, 425)
+
+def _esperar_tarea_ilovepdf(sesion, server_url, task, headers, estado, limite):
+    """
+    Sondea /v1/task con backoff exponencial hasta que la tarea termina. Con `estado` vacío
+    (respuesta de /v1/process sin 'status') no sondea: la descarga se reintenta si aún no está lista.
+    """
+    espera = ILOVEPDF_ESPERA_MIN
+    while estado and not estado.startswith('TaskSuccess'):
+        if estado in ILOVEPDF_ESTADOS_FALLIDOS:
+            raise ErrorIlovepdf(f"La tarea terminó con estado {estado}")
+        if time.monotonic() + espera > limite:
+            raise ErrorIlovepdf(f"La tarea no quedó lista en {ILOVEPDF_ESPERA_TOTAL:g} s (estado {estado})", 'transitorio')
+        time.sleep(espera)
+        espera = min(espera * 2, ILOVEPDF_ESPERA_MAX)
+        estado_response = sesion.get(f'{server_url}/v1/task/{task}', headers=headers, timeout=_timeout_ilovepdf('estado'))
+        if estado_response.status_code == 200:
+            estado = estado_response.json().get('status') or estado
+
+def _descargar_ilovepdf(sesion, download_url, headers, limite):
+    """GET de /v1/download; si el archivo aún no está listo (404/409/425) reintenta con backoff hasta `limite`."""
+    espera = ILOVEPDF_ESPERA_MIN
+    while True:
+        download_response = sesion.get(download_url, headers=headers, timeout=_timeout_ilovepdf('download'))
+        if download_response.status_code not in ILOVEPDF_DESCARGA_NO_LISTA or time.monotonic() + espera > limite:
+            return download_response
+        time.sleep(espera)
+        espera = min(espera * 2, ILOVEPDF_ESPERA_MAX)
+
+class PoolIlovepdf:
+    """
+    Claves (proveedores) de iLovePDF con estado propio, seguro entre hilos. Se eligen por round-robin
+    ponderado (peso 0 = solo respaldo, cuando no queda otra disponible). Cada clave tiene un circuit
+    breaker: tras ILOVEPDF_FALLOS_MAX errores transitorios seguidos se abre ILOVEPDF_ENFRIAMIENTO s y
+    luego deja pasar una sola petición de prueba. Una clave sin créditos queda 'agotada' y un hilo en
+    segundo plano la vuelve a probar cada ILOVEPDF_REPROBAR s (auth + start, que no gastan créditos).
+    """
+    
+    def __init__(self, apis):
+        self._lock = threading.Lock()
+        self._sondeo = None
+        self.proveedores = []
+        for api in apis:
+            con_credenciales = bool(api['public_key'] and api['secret_key'])
+            self.proveedores.append({
+                'nombre': api['name'],
+                'config': api,
+                'peso': max(int(api.get('peso', 1)), 0),
+                'creditos': api.get('creditos'),
+                'estado': 'activo' if con_credenciales else 'sin_credenciales',
+                'fallos': 0,
+                'abierto_hasta': 0.0,
+                'proximo_sondeo': 0.0,
+                'actual': 0,
+                'conversiones': 0,
+                'errores': 0,
+                'ultimo_error': None,
             })
-            
-            # Verificar respuesta de autenticación
-            if auth_response.status_code != 200:
-                error_text = auth_response.text.lower()
-                error_json = {}
-                try:
-                    error_json = auth_response.json()
-                except:
-                    pass
-                
-                # Detectar errores de créditos
-                if any(ind in error_text for ind in ['credits', 'quota', 'limit', 'exceeded', 'insufficient', 'balance']):
-                    raise Exception(f"CREDITS_EXHAUSTED: {auth_response.text}")
-                
-                raise Exception(f"Error de autenticación ({auth_response.status_code}): {auth_response.text}")
-            
-            auth_data = auth_response.json()
-            token = auth_data.get('token')
-            
-            if not token:
-                raise Exception("No se recibió token de autenticación")
-            
-            # Paso 2: Iniciar tarea de conversión
-            start_url = 'https://api.ilovepdf.com/v1/start/officepdf'
-            headers = {'Authorization': f'Bearer {token}'}
-            start_response = requests.get(start_url, headers=headers)
-            
-            if start_response.status_code != 200:
-                error_text = start_response.text.lower()
-                if any(ind in error_text for ind in ['credits', 'quota', 'limit', 'exceeded', 'insufficient', 'balance']):
-                    raise Exception(f"CREDITS_EXHAUSTED: {start_response.text}")
-                raise Exception(f"Error al iniciar tarea ({start_response.status_code}): {start_response.text}")
-            
-            task_data = start_response.json()
-            server = task_data.get('server')
-            task = task_data.get('task')
-            
-            if not server or not task:
-                raise Exception("No se recibieron datos de servidor o tarea")
-            
-            # Paso 3: Subir archivo Word
-            upload_url = f'https://{server}/v1/upload'
-            files = {'file': (filename, word_file_bytes, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')}
-            upload_response = requests.post(upload_url, files=files, headers=headers)
-            
-            if upload_response.status_code != 200:
-                error_text = upload_response.text.lower()
-                if any(ind in error_text for ind in ['credits', 'quota', 'limit', 'exceeded', 'insufficient', 'balance']):
-                    raise Exception(f"CREDITS_EXHAUSTED: {upload_response.text}")
-                raise Exception(f"Error al subir archivo ({upload_response.status_code}): {upload_response.text}")
-            
-            upload_data = upload_response.json()
-            server_filename = upload_data.get('server_filename')
-            
-            if not server_filename:
-                raise Exception("No se recibió nombre de archivo del servidor")
-            
-            # Paso 4: Procesar conversión
-            process_url = f'https://{server}/v1/process'
-            process_data = {
-                'task': task,
-                'tool': 'officepdf',
-                'files': [{'server_filename': server_filename, 'filename': filename}]
-            }
-            process_response = requests.post(process_url, json=process_data, headers=headers)
-            
-            if process_response.status_code != 200:
-                error_text = process_response.text.lower()
-                if any(ind in error_text for ind in ['credits', 'quota', 'limit', 'exceeded', 'insufficient', 'balance']):
-                    raise Exception(f"CREDITS_EXHAUSTED: {process_response.text}")
-                raise Exception(f"Error al procesar ({process_response.status_code}): {process_response.text}")
-            
-            # Esperar un momento para que el procesamiento termine
-            time.sleep(1)
-            
-            # Paso 5: Descargar PDF resultante
-            download_url = f'https://{server}/v1/download/{task}'
-            download_response = requests.get(download_url, headers=headers)
-            
-            if download_response.status_code != 200:
-                error_text = download_response.text.lower()
-                if any(ind in error_text for ind in ['credits', 'quota', 'limit', 'exceeded', 'insufficient', 'balance']):
-                    raise Exception(f"CREDITS_EXHAUSTED: {download_response.text}")
-                raise Exception(f"Error al descargar PDF ({download_response.status_code}): {download_response.text}")
-            
-            # Si llegamos aquí, la conversión fue exitosa
-            print(f"✅ Conversión exitosa usando API {api_config['name']}")
-            return download_response.content
-            
-        except Exception as e:
-            error_message = str(e)
-            is_credits_error = 'CREDITS_EXHAUSTED' in error_message or any(
-                ind in error_message.lower() for ind in ['credits', 'quota', 'limit', 'exceeded', 'insufficient', 'balance', '401', '403']
-            )
-            
-            if is_credits_error:
-                # Cambiar a la siguiente API
-                current_api_index = (current_api_index + 1) % len(ILOVEPDF_APIS)
-                print(f"⚠️ Créditos agotados en API {api_config['name']}. Cambiando a API de respaldo...")
-                
-                # Si no hay más APIs, lanzar error
-                if attempt == max_retries - 1:
-                    raise Exception(f"Todas las APIs de iLovePDF han agotado sus créditos. Último error: {error_message}")
-                
-                # Continuar con el siguiente intento
-                continue
+    
+    def _disponible(self, proveedor, ahora):
+        if proveedor['estado'] == 'activo':
+            return True
+        # Breaker abierto que ya cumplió el enfriamiento: se deja pasar una petición de prueba
+        return proveedor['estado'] == 'abierto' and ahora >= proveedor['abierto_hasta']
+    
+    def elegir(self, excluir=()):
+        """Proveedor para la próxima conversión (None si no hay ninguno disponible)."""
+        with self._lock:
+            ahora = time.monotonic()
+            candidatos = [p for p in self.proveedores if p['nombre'] not in excluir and self._disponible(p, ahora)]
+            # Las claves de respaldo (peso 0) solo entran si no queda ninguna con peso
+            ponderados = [p for p in candidatos if p['peso'] > 0] or candidatos
+            if not ponderados:
+                return None
+            # Round-robin ponderado suave: reparte según el peso sin rachas seguidas de una misma clave
+            total = 0
+            for proveedor in ponderados:
+                peso = proveedor['peso'] or 1
+                proveedor['actual'] += peso
+                total += peso
+            elegido = max(ponderados, key=lambda p: p['actual'])
+            elegido['actual'] -= total
+            if elegido['estado'] == 'abierto':
+                elegido['estado'] = 'probando'
+            return elegido
+    
+    def exito(self, proveedor, archivos=1):
+        with self._lock:
+            proveedor['estado'] = 'activo'
+            proveedor['fallos'] = 0
+            proveedor['conversiones'] += archivos
+            if proveedor['creditos'] is not None:
+                proveedor['creditos'] = max(proveedor['creditos'] - archivos, 0)
+    
+    def fallo(self, proveedor, error):
+        """Registra un ErrorIlovepdf: abre el breaker o marca la clave como agotada según el tipo."""
+        with self._lock:
+            ahora = time.monotonic()
+            proveedor['errores'] += 1
+            proveedor['ultimo_error'] = str(error)[:300]
+            if error.tipo == 'creditos':
+                proveedor['estado'] = 'agotado'
+                proveedor['creditos'] = 0
+                proveedor['proximo_sondeo'] = ahora + ILOVEPDF_REPROBAR
+                self._iniciar_sondeo()
+            elif error.tipo == 'peticion':
+                # La clave respondió bien; el problema es el archivo o la tarea
+                proveedor['estado'] = 'activo'
+                proveedor['fallos'] = 0
             else:
-                # Error diferente, relanzar
-                raise e
+                proveedor['fallos'] += 1
+                if proveedor['estado'] == 'probando' or proveedor['fallos'] >= ILOVEPDF_FALLOS_MAX:
+                    proveedor['estado'] = 'abierto'
+                    proveedor['abierto_hasta'] = ahora + ILOVEPDF_ENFRIAMIENTO
+                    print(f"⚠️ API {proveedor['nombre']} en enfriamiento {ILOVEPDF_ENFRIAMIENTO:g}s tras {proveedor['fallos']} errores")
+    
+    def _iniciar_sondeo(self):
+        # Se llama con el lock tomado
+        if self._sondeo is None or not self._sondeo.is_alive():
+            self._sondeo = threading.Thread(target=self._sondear, name='ilovepdf-sondeo', daemon=True)
+            self._sondeo.start()
     
-    raise Exception("No se pudo convertir el archivo después de intentar todas las APIs disponibles")
+    def _sondear(self):
+        """Hilo en segundo plano: vuelve a probar las claves agotadas cuando les toca."""
+        while True:
+            with self._lock:
+                agotados = [p for p in self.proveedores if p['estado'] == 'agotado']
+                if not agotados:
+                    self._sondeo = None
+                    return
+                ahora = time.monotonic()
+                pendientes = [p for p in agotados if ahora >= p['proximo_sondeo']]
+                espera = min(p['proximo_sondeo'] for p in agotados) - ahora
+            if not pendientes:
+                time.sleep(min(max(espera, 0.05), 60))
+                continue
+            for proveedor in pendientes:
+                self._probar(proveedor)
+    
+    def _probar(self, proveedor):
+        api_config = proveedor['config']
+        try:
+            _olvidar_token_ilovepdf(api_config)
+            token = _token_ilovepdf(api_config)
+            try:
+                respuesta = _sesion_ilovepdf(ILOVEPDF_BASE_URL).get(
+                    f'{ILOVEPDF_BASE_URL}/v1/start/officepdf',
+                    headers={'Authorization': f'Bearer {token}'}, timeout=_timeout_ilovepdf('start'))
+            except requests.RequestException as e:
+                raise ErrorIlovepdf(f"Error de red con iLovePDF: {e}", 'transitorio')
+            if respuesta.status_code != 200:
+                raise _error_ilovepdf(respuesta, 'Error al iniciar tarea')
+        except ErrorIlovepdf as e:
+            with self._lock:
+                proveedor['ultimo_error'] = str(e)[:300]
+                espera = ILOVEPDF_REPROBAR if e.tipo == 'creditos' else ILOVEPDF_ENFRIAMIENTO
+                proveedor['proximo_sondeo'] = time.monotonic() + espera
+            return
+        with self._lock:
+            proveedor['estado'] = 'activo'
+            proveedor['fallos'] = 0
+            proveedor['creditos'] = api_config.get('creditos')
+        print(f"✅ API {proveedor['nombre']} vuelve a tener créditos")
+    
+    def estado(self):
+        with self._lock:
+            ahora = time.monotonic()
+            return [{
+                'nombre': p['nombre'],
+                'estado': p['estado'],
+                'peso': p['peso'],
+                'creditos_estimados': p['creditos'],
+                'fallos_seguidos': p['fallos'],
+                'reabre_en_s': round(max(p['abierto_hasta'] - ahora, 0), 1) if p['estado'] == 'abierto' else None,
+                'proximo_sondeo_en_s': round(max(p['proximo_sondeo'] - ahora, 0), 1) if p['estado'] == 'agotado' else None,
+                'conversiones': p['conversiones'],
+                'errores': p['errores'],
+                'ultimo_error': p['ultimo_error'],
+            } for p in self.proveedores]
 
-@app.route('/convert-word-to-pdf', methods=['POST'])
-def convert_word_to_pdf():
+pool_ilovepdf = PoolIlovepdf(ILOVEPDF_APIS)
+
+def _iniciar_tarea_ilovepdf(api_config, tiempos):
+    """Auth + /v1/start: devuelve (sesion del servidor de la tarea, server_url, task, headers)."""
+    # Paso 1: Token de autenticación (se reutiliza mientras no venza)
+    with medir_paso(tiempos, 'auth'):
+        token = _token_ilovepdf(api_config)
+    
+    # Paso 2: Iniciar tarea de conversión
+    start_url = f'{ILOVEPDF_BASE_URL}/v1/start/officepdf'
+    headers = {'Authorization': f'Bearer {token}'}
+    with medir_paso(tiempos, 'start'):
+        start_response = _sesion_ilovepdf(ILOVEPDF_BASE_URL).get(start_url, headers=headers, timeout=_timeout_ilovepdf('start'))
+    
+    if start_response.status_code != 200:
+        raise _error_ilovepdf(start_response, 'Error al iniciar tarea')
+    
+    task_data = start_response.json()
+    server = task_data.get('server')
+    task = task_data.get('task')
+    
+    if not server or not task:
+        raise ErrorIlovepdf("No se recibieron datos de servidor o tarea", 'transitorio')
+    
+    # El resto de pasos van al servidor de la tarea, con su propia sesión keep-alive
+    server_url = _url_servidor_ilovepdf(server)
+    return _sesion_ilovepdf(server_url), server_url, task, headers
+
+def _subir_archivo_ilovepdf(sesion, server_url, task, headers, filename, word_file_bytes):
+    """Paso 3: sube un .docx a la tarea y devuelve su entrada para /v1/process."""
+    upload_url = f'{server_url}/v1/upload'
+    files = {'file': (filename, word_file_bytes, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')}
+    upload_response = sesion.post(upload_url, files=files, headers=headers, data={'task': task},
+                                  timeout=_timeout_ilovepdf('upload'))
+    
+    if upload_response.status_code != 200:
+        raise _error_ilovepdf(upload_response, f'Error al subir archivo {filename}')
+    
+    server_filename = upload_response.json().get('server_filename')
+    if not server_filename:
+        raise ErrorIlovepdf("No se recibió nombre de archivo del servidor", 'transitorio')
+    return {'server_filename': server_filename, 'filename': filename}
+
+def _procesar_y_descargar_ilovepdf(sesion, server_url, task, headers, archivos_subidos, tiempos):
+    """Pasos 4 y 5: procesa la tarea, espera a que quede lista y descarga el resultado (PDF o ZIP)."""
+    process_url = f'{server_url}/v1/process'
+    process_data = {
+        'task': task,
+        'tool': 'officepdf',
+        'files': archivos_subidos
+    }
+    with medir_paso(tiempos, 'process'):
+        process_response = sesion.post(process_url, json=process_data, headers=headers, timeout=_timeout_ilovepdf('process'))
+    
+    if process_response.status_code != 200:
+        raise _error_ilovepdf(process_response, 'Error al procesar')
+    
+    # Esperar a que la tarea quede lista (normalmente /v1/process ya responde TaskSuccess)
+    limite = time.monotonic() + ILOVEPDF_ESPERA_TOTAL
+    with medir_paso(tiempos, 'espera'):
+        _esperar_tarea_ilovepdf(sesion, server_url, task, headers, process_response.json().get('status'), limite)
+    
+    download_url = f'{server_url}/v1/download/{task}'
+    with medir_paso(tiempos, 'download'):
+        download_response = _descargar_ilovepdf(sesion, download_url, headers, limite)
+    
+    if download_response.status_code != 200:
+        raise _error_ilovepdf(download_response, 'Error al descargar PDF')
+    return download_response.content
+
+def _convertir_con_api_ilovepdf(api_config, word_file_bytes, filename, tiempos):
+    """Una conversión completa con una clave: auth, start, upload, process, espera y download."""
+    try:
+        sesion, server_url, task, headers = _iniciar_tarea_ilovepdf(api_config, tiempos)
+        with medir_paso(tiempos, 'upload'):
+            subido = _subir_archivo_ilovepdf(sesion, server_url, task, headers, filename, word_file_bytes)
+        return _procesar_y_descargar_ilovepdf(sesion, server_url, task, headers, [subido], tiempos)
+    except requests.RequestException as e:
+        # Conexión rechazada, timeout de algún paso, etc.
+        raise ErrorIlovepdf(f"Error de red con iLovePDF: {e}", 'transitorio')
+
+def _convertir_lote_con_api_ilovepdf(api_config, archivos, tiempos):
     """
-    Convierte un documento Word a PDF usando iLovePDF con fallback automático
+    Varios .docx [(filename, bytes)] en una sola tarea: subidas en paralelo, un solo process y una
+    sola descarga (un ZIP si hay más de un archivo). Cada archivo se sube como NNNN.docx para que
+    el PDF del ZIP se pueda asociar a su posición aunque se repitan nombres.
+    Devuelve los PDFs en el mismo orden de `archivos`.
     """
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
     try:
-        # Verificar si se envió un archivo
-        if 'file' not in request.files:
-            return jsonify({"error": "No se proporcionó ningún archivo"}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({"error": "Nombre de archivo vacío"}), 400
+        sesion, server_url, task, headers = _iniciar_tarea_ilovepdf(api_config, tiempos)
         
-        # Leer el archivo
-        word_file_bytes = file.read()
+        def subir(i):
+            return _subir_archivo_ilovepdf(sesion, server_url, task, headers, f'{i:04d}.docx', archivos[i][1])
         
-        # Convertir a PDF
-        pdf_bytes = convert_word_to_pdf_with_ilovepdf(word_file_bytes, file.filename)
+        with medir_paso(tiempos, 'upload'):
+            with ThreadPoolExecutor(max_workers=max(min(ILOVEPDF_SUBIDAS_PARALELAS, len(archivos)), 1)) as executor:
+                subidos = list(executor.map(subir, range(len(archivos))))
         
-        # Preparar respuesta
-        output = io.BytesIO(pdf_bytes)
-        output.seek(0)
+        contenido = _procesar_y_descargar_ilovepdf(sesion, server_url, task, headers, subidos, tiempos)
+    except requests.RequestException as e:
+        raise ErrorIlovepdf(f"Error de red con iLovePDF: {e}", 'transitorio')
+    
+    if len(archivos) == 1:
+        return [contenido]
+    try:
+        pdfs = {}
+        with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+            for nombre in zf.namelist():
+                base = os.path.splitext(os.path.basename(nombre))[0]
+                if base.isdigit():
+                    pdfs[int(base)] = zf.read(nombre)
+    except zipfile.BadZipFile:
+        raise ErrorIlovepdf("La descarga de un lote no es un ZIP válido", 'transitorio')
+    faltantes = [archivos[i][0] for i in range(len(archivos)) if i not in pdfs]
+    if faltantes:
+        raise ErrorIlovepdf(f"El ZIP de iLovePDF no trae el PDF de: {', '.join(faltantes)}")
+    return [pdfs[i] for i in range(len(archivos))]
+
+def _con_proveedor_ilovepdf(operacion, archivos=1):
+    """
+    Ejecuta operacion(api_config) con la clave que elija pool_ilovepdf. Un error transitorio se
+    reintenta (con la misma clave mientras su breaker siga cerrado) y una clave sin créditos se
+    descarta para pasar a la siguiente.
+    """
+    sin_creditos = set()
+    ultimo_error = None
+    
+    for intento in range(len(ILOVEPDF_APIS) + ILOVEPDF_REINTENTOS):
+        proveedor = pool_ilovepdf.elegir(excluir=sin_creditos)
+        if proveedor is None:
+            break
+        api_config = proveedor['config']
         
-        # Nombre del archivo PDF
-        pdf_filename = file.filename.replace('.docx', '.pdf').replace('.doc', '.pdf')
-        if not pdf_filename.endswith('.pdf'):
-            pdf_filename += '.pdf'
+        try:
+            resultado = operacion(api_config)
+        except ErrorIlovepdf as e:
+            ultimo_error = e
+            pool_ilovepdf.fallo(proveedor, e)
+            if e.tipo == 'peticion':
+                # Otra clave fallaría igual
+                raise
+            if e.tipo == 'auth':
+                # Token vencido o revocado: se pide uno nuevo en el próximo intento
+                _olvidar_token_ilovepdf(api_config)
+            if e.tipo == 'creditos':
+                sin_creditos.add(proveedor['nombre'])
+                print(f"⚠️ Créditos agotados en API {api_config['name']}. Cambiando a API de respaldo...")
+            else:
+                print(f"⚠️ Error transitorio en API {api_config['name']}: {e}. Reintentando...")
+                time.sleep(min(ILOVEPDF_ESPERA_MIN * 2 ** intento, ILOVEPDF_ESPERA_MAX))
+            continue
         
-        return send_file(
-            output,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=pdf_filename
+        pool_ilovepdf.exito(proveedor, archivos)
+        print(f"✅ Conversión exitosa usando API {api_config['name']}" + (f" ({archivos} archivos)" if archivos > 1 else ''))
+        return resultado
+    
+    if ultimo_error is not None and ultimo_error.tipo == 'creditos':
+        raise Exception(f"Todas las APIs de iLovePDF han agotado sus créditos. Último error: {ultimo_error}")
+    if ultimo_error is not None:
+        raise Exception(f"No se pudo convertir el archivo con iLovePDF. Último error: {ultimo_error}")
+    raise Exception("No hay APIs de iLovePDF disponibles (sin credenciales, sin créditos o en enfriamiento)")
+
+def convert_word_to_pdf_with_ilovepdf(word_file_bytes, filename='document.docx', tiempos=None):
+    """
+    Convierte un archivo Word a PDF usando la API de iLovePDF (clave elegida por pool_ilovepdf,
+    con reintentos y cambio de clave si se acaban los créditos).
+    Si se pasa `tiempos` (dict), se acumulan ahí los ms de cada paso.
+    """
+    return _con_proveedor_ilovepdf(
+        lambda api_config: _convertir_con_api_ilovepdf(api_config, word_file_bytes, filename, tiempos))
+
+def convert_words_to_pdf_with_ilovepdf(archivos, tiempos=None):
+    """
+    Convierte varios .docx [(filename, bytes)] con tareas de iLovePDF de hasta ILOVEPDF_LOTE_MAX
+    archivos cada una. Devuelve [(filename, pdf_bytes)] en el mismo orden.
+    """
+    resultado = []
+    for inicio in range(0, len(archivos), ILOVEPDF_LOTE_MAX):
+        parte = archivos[inicio:inicio + ILOVEPDF_LOTE_MAX]
+        pdfs = _con_proveedor_ilovepdf(
+            lambda api_config: _convertir_lote_con_api_ilovepdf(api_config, parte, tiempos), len(parte))
+        resultado.extend(zip((filename for filename, _ in parte), pdfs))
+    return resultado
+
+# --- Conversión a PDF local: pool de LibreOffice en caliente (unoserver) ---
+# Cada worker es un proceso `unoserver` (LibreOffice headless + servidor XML-RPC) que queda arrancado;
+# las conversiones se le envían por XML-RPC, sin arrancar LibreOffice por cada archivo.
+LIBREOFFICE_UNOSERVER_CMD = os.getenv('LIBREOFFICE_UNOSERVER_CMD', 'unoserver')
+LIBREOFFICE_WORKERS = int(os.getenv('LIBREOFFICE_WORKERS', '1'))
+LIBREOFFICE_TIMEOUT = float(os.getenv('LIBREOFFICE_TIMEOUT', '60'))            # segundos por conversión
+LIBREOFFICE_ARRANQUE_TIMEOUT = float(os.getenv('LIBREOFFICE_ARRANQUE_TIMEOUT', '45'))
+LIBREOFFICE_MAX_TRABAJOS = int(os.getenv('LIBREOFFICE_MAX_TRABAJOS', '200'))  # reciclar el proceso tras N conversiones
+
+def _puerto_libre():
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _crear_transporte_xmlrpc(timeout):
+    import xmlrpc.client
+    
+    class _TransporteConTimeout(xmlrpc.client.Transport):
+        def make_connection(self, host):
+            conexion = super().make_connection(host)
+            conexion.timeout = timeout
+            return conexion
+    
+    return _TransporteConTimeout()
+
+class PoolLibreOffice:
+    """
+    Pool de procesos unoserver. Cada conversión toma un worker libre (espera si todos están ocupados),
+    con timeout por trabajo; un worker que falla, se cuelga o llega a LIBREOFFICE_MAX_TRABAJOS se
+    mata y se vuelve a arrancar en segundo plano (la petición no espera el reinicio) y vuelve al
+    pool cuando está listo.
+    """
+    
+    def __init__(self, tamaño, cmd):
+        import queue
+        import shutil
+        self.tamaño = max(tamaño, 1)
+        self.cmd = cmd
+        self.ruta = shutil.which(cmd)  # se resuelve una vez al arrancar, no en cada conversión
+        self._libres = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._iniciado = False
+        self._fallo_arranque = None
+        self.stats = {'conversiones': 0, 'errores': 0, 'timeouts': 0, 'reciclados': 0}
+    
+    def disponible(self):
+        return self.ruta is not None
+    
+    def _contar(self, *claves):
+        with self._stats_lock:
+            for clave in claves:
+                self.stats[clave] += 1
+    
+    def _arrancar(self, worker):
+        import subprocess
+        import tempfile
+        worker['puerto'] = _puerto_libre()
+        worker['perfil'] = worker.get('perfil') or tempfile.mkdtemp(prefix='lo_perfil_')
+        worker['proceso'] = subprocess.Popen(
+            [self.ruta or self.cmd, '--interface', '127.0.0.1', '--port', str(worker['puerto']),
+             '--uno-port', str(_puerto_libre()),
+             '--user-installation', 'file://' + worker['perfil']],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
         )
-        
-    except Exception as e:
-        import traceback
-        return jsonify({
-            "error": str(e),
-            "traceback": traceback.format_exc()
-        }), 500
+        worker['trabajos'] = 0
+        self._esperar_listo(worker)
+    
+    def _esperar_listo(self, worker):
+        """Espera a que el servidor XML-RPC del worker acepte conexiones."""
+        import socket
+        limite = time.monotonic() + LIBREOFFICE_ARRANQUE_TIMEOUT
+        espera = 0.05
+        while time.monotonic() < limite:
+            if worker['proceso'].poll() is not None:
+                raise Exception(f"unoserver terminó al arrancar (código {worker['proceso'].returncode})")
+            try:
+                with socket.create_connection(('127.0.0.1', worker['puerto']), timeout=1):
+                    return
+            except OSError:
+                time.sleep(espera)
+                espera = min(espera * 2, 1.0)
+        self._detener(worker)
+        raise Exception(f"unoserver no respondió en {LIBREOFFICE_ARRANQUE_TIMEOUT:.0f}s")
+    
+    def _detener(self, worker):
+        proceso = worker.get('proceso')
+        if proceso is None or proceso.poll() is not None:
+            return
+        proceso.terminate()
+        try:
+            proceso.wait(timeout=5)
+        except Exception:
+            proceso.kill()
+    
+    def _reciclar(self, worker):
+        """Reinicia el worker en un hilo aparte y lo devuelve a los libres al terminar."""
+        def reiniciar():
+            self._contar('reciclados')
+            self._detener(worker)
+            try:
+                self._arrancar(worker)
+            except Exception as e:
+                print(f"⚠️ No se pudo reiniciar worker de LibreOffice: {e}")
+                # Vuelve igual al pool (el siguiente uso lo intenta de nuevo), sin reintentar en bucle
+                time.sleep(5)
+            self._libres.put(worker)
+        threading.Thread(target=reiniciar, name='lo-reciclar', daemon=True).start()
+    
+    def iniciar(self):
+        """Arranca los workers (una vez, al primer uso)."""
+        with self._lock:
+            if self._iniciado:
+                return
+            # Si el arranque acaba de fallar no se reintenta en cada petición (se va directo al respaldo)
+            if self._fallo_arranque and time.monotonic() - self._fallo_arranque < 60:
+                raise Exception("El pool de LibreOffice no pudo arrancar hace menos de 60s")
+            arrancados = []
+            try:
+                for _ in range(self.tamaño):
+                    worker = {}
+                    self._arrancar(worker)
+                    arrancados.append(worker)
+            except Exception:
+                self._fallo_arranque = time.monotonic()
+                for worker in arrancados:
+                    self._detener(worker)
+                raise
+            for worker in arrancados:
+                self._workers.append(worker)
+                self._libres.put(worker)
+            self._iniciado = True
+            import atexit
+            atexit.register(self.cerrar)
+            print(f"✅ Pool de LibreOffice listo ({self.tamaño} workers)")
+    
+    def cerrar(self):
+        for worker in self._workers:
+            self._detener(worker)
+    
+    def convertir(self, word_file_bytes, timeout=None):
+        """Convierte los bytes de un .docx a PDF en un worker del pool."""
+        import queue
+        import xmlrpc.client
+        self.iniciar()
+        timeout = timeout or LIBREOFFICE_TIMEOUT
+        limite = time.monotonic() + timeout
+        while True:
+            try:
+                worker = self._libres.get(timeout=max(limite - time.monotonic(), 0))
+            except queue.Empty:
+                raise Exception(f"No hay workers de LibreOffice libres después de {timeout:.0f}s")
+            if worker['proceso'].poll() is None:
+                break
+            # Murió mientras estaba libre: se reinicia en segundo plano y se toma otro
+            self._reciclar(worker)
+        reciclar = False
+        try:
+            proxy = xmlrpc.client.ServerProxy(f"http://127.0.0.1:{worker['puerto']}",
+                                              transport=_crear_transporte_xmlrpc(timeout), allow_none=True)
+            # convert(inpath, indata, outpath, convert_to, filtername, filter_options, update_index)
+            resultado = proxy.convert(None, xmlrpc.client.Binary(word_file_bytes), None, 'pdf', None, [], False)
+            worker['trabajos'] += 1
+            self._contar('conversiones')
+            reciclar = worker['trabajos'] >= LIBREOFFICE_MAX_TRABAJOS
+            return resultado.data if isinstance(resultado, xmlrpc.client.Binary) else resultado
+        except Exception as e:
+            self._contar('errores', *(['timeouts'] if isinstance(e, TimeoutError) else []))
+            # El proceso pudo quedar colgado o a medio convertir: se reinicia
+            reciclar = True
+            raise Exception(f"Error en LibreOffice: {e}")
+        finally:
+            if reciclar:
+                self._reciclar(worker)
+            else:
+                self._libres.put(worker)
+    
+    def estado(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            'disponible': self.disponible(),
+            'iniciado': self._iniciado,
+            'workers': self.tamaño,
+            'libres': self._libres.qsize(),
+            **stats,
+        }
 
-@app.route('/generate-word', methods=['POST'])
-def generate_word():
-    """Genera un documento Word desde cero con todos los datos recibidos"""
+pool_libreoffice = PoolLibreOffice(LIBREOFFICE_WORKERS, LIBREOFFICE_UNOSERVER_CMD)
+
+def convertir_con_libreoffice(word_file_bytes, filename='document.docx', tiempos=None):
+    """Backend local: convierte con el pool de LibreOffice."""
+    with medir_paso(tiempos, 'libreoffice'):
+        return pool_libreoffice.convertir(word_file_bytes)
+
+# --- Backends de conversión a PDF ---
+# 'libreoffice': pool local (si falla, se usa iLovePDF como respaldo)
+# 'ilovepdf': API externa (consume créditos)
+# 'auto': libreoffice si unoserver está instalado, si no ilovepdf
+PDF_BACKENDS = {
+    'libreoffice': convertir_con_libreoffice,
+    'ilovepdf': convert_word_to_pdf_with_ilovepdf,
+}
+PDF_BACKEND = os.getenv('PDF_BACKEND', 'auto').strip().lower()
+PDF_RESPALDO_ILOVEPDF = os.getenv('PDF_RESPALDO_ILOVEPDF', '1') == '1'
+
+def backend_pdf(pedido=None):
+    """Backend a usar: el pedido en la petición o el configurado en PDF_BACKEND."""
+    backend = str(pedido or PDF_BACKEND).strip().lower()
+    if backend not in PDF_BACKENDS:
+        backend = 'auto'
+    if backend == 'auto':
+        backend = 'libreoffice' if pool_libreoffice.disponible() else 'ilovepdf'
+    return backend
+
+def convertir_a_pdf(word_file_bytes, filename='document.docx', backend=None, tiempos=None):
+    """
+    Convierte un .docx a PDF con el backend elegido. Si el backend local falla y
+    PDF_RESPALDO_ILOVEPDF=1, se reintenta con iLovePDF. Devuelve (pdf_bytes, backend usado).
+    `tiempos` (dict opcional) recibe los ms de cada paso de la conversión.
+    """
+    backend = backend_pdf(backend)
     try:
-        data = request.json
-        
-        # Obtener datos básicos
-        nombre = data.get('fullName', '').strip()
-        cedula = data.get('idNumber', '').strip()
-        fecha_raw = data.get('birthDate', '').strip()
-        fecha = formatear_fecha(fecha_raw)  # Convertir a formato "20 de noviembre de 1990"
+        return PDF_BACKENDS[backend](word_file_bytes, filename, tiempos), backend
+    except Exception as e:
+        if backend == 'ilovepdf' or not PDF_RESPALDO_ILOVEPDF:
+            raise
+        print(f"⚠️ Conversión con {backend} falló ({e}). Usando iLovePDF como respaldo...")
+        return convert_word_to_pdf_with_ilovepdf(word_file_bytes, filename, tiempos), 'ilovepdf'
+
+# --- Caché de PDFs convertidos: SHA-256 del .docx -> PDF ---
+# Nivel 1: disco local acotado por tamaño (LRU por fecha de uso). Nivel 2 (opcional, PDF_CACHE_R2=1):
+# R2, compartido entre instancias y reinicios. Un acierto no llama a ningún backend ni gasta créditos.
+PDF_CACHE_DIR = os.getenv('PDF_CACHE_DIR', '') or None
+PDF_CACHE_MAX_MB = float(os.getenv('PDF_CACHE_MAX_MB', '256'))   # 0 desactiva el nivel de disco
+PDF_CACHE_R2 = os.getenv('PDF_CACHE_R2', '0') == '1'
+PDF_CACHE_R2_PREFIJO = os.getenv('PDF_CACHE_R2_PREFIJO', 'cache/pdf/')
+PDF_CACHE_REESCANEO = float(os.getenv('PDF_CACHE_REESCANEO', '30'))   # s entre escaneos de la carpeta
+
+class CachePdf:
+    """
+    Caché en dos niveles de PDFs convertidos, direccionada por el SHA-256 del .docx. En disco cada
+    PDF es <sha>.pdf (escritura atómica); el índice de tamaños se arma leyendo la carpeta y se
+    expulsan los menos usados recientemente (por mtime) al pasar de PDF_CACHE_MAX_MB. La carpeta la
+    comparten los workers de gunicorn: cada PDF_CACHE_REESCANEO s el índice se rehace con un escaneo
+    para que el límite sea el de toda la carpeta y no el de cada proceso. Las escrituras, borrados y
+    escaneos se hacen fuera del lock; el lock solo protege el índice y los contadores.
+    """
+    
+    def __init__(self, carpeta, max_mb, usar_r2, prefijo_r2):
+        import tempfile
+        self.carpeta = carpeta or os.path.join(tempfile.gettempdir(), 'pdf_cache')
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.usar_r2 = usar_r2
+        self.prefijo_r2 = prefijo_r2
+        self._indice = OrderedDict()  # sha -> tamaño, del menos al más usado recientemente
+        self._cargado = False
+        self._bytes = 0
+        self._escaneado = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'hits_disco': 0, 'hits_r2': 0, 'misses': 0, 'guardados': 0, 'evictions': 0, 'errores': 0}
+    
+    @staticmethod
+    def clave(word_file_bytes):
+        return hashlib.sha256(word_file_bytes).hexdigest()
+    
+    def _ruta(self, clave):
+        return os.path.join(self.carpeta, f'{clave}.pdf')
+    
+    def _contar(self, nombre, cantidad=1):
+        with self._lock:
+            self.stats[nombre] += cantidad
+    
+    def _cargar_indice(self, forzar=False):
+        # Se llama sin el lock: el escaneo de la carpeta no bloquea a los demás hilos
+        if self._cargado and not forzar:
+            return
+        os.makedirs(self.carpeta, exist_ok=True)
+        archivos = []
+        for entrada in os.scandir(self.carpeta):
+            if entrada.is_file() and entrada.name.endswith('.pdf'):
+                try:
+                    info = entrada.stat()
+                except FileNotFoundError:
+                    continue  # otro worker lo expulsó durante el escaneo
+                archivos.append((info.st_mtime, entrada.name[:-4], info.st_size))
+        indice = OrderedDict()
+        for _, clave, tamaño in sorted(archivos):
+            indice[clave] = tamaño
+        with self._lock:
+            if self._cargado and not forzar:
+                return  # otro hilo lo cargó mientras se escaneaba
+            self._indice = indice
+            self._bytes = sum(indice.values())
+            self._cargado = True
+            self._escaneado = time.monotonic()
+    
+    def _leer_disco(self, clave):
+        if self.max_bytes <= 0:
+            return None
+        self._cargar_indice()
+        with self._lock:
+            if clave in self._indice:
+                self._indice.move_to_end(clave)
+        # Aunque no esté en el índice se intenta leer: puede haberlo escrito otro worker
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, 'rb') as f:
+                contenido = f.read()
+            os.utime(ruta)  # la fecha de uso ordena la expulsión entre workers y reinicios
+            with self._lock:
+                if clave not in self._indice:
+                    self._indice[clave] = len(contenido)
+                    self._bytes += len(contenido)
+            return contenido
+        except FileNotFoundError:
+            # Otro worker lo expulsó
+            with self._lock:
+                self._bytes -= self._indice.pop(clave, 0)
+            return None
+    
+    def _guardar_disco(self, clave, contenido):
+        if self.max_bytes <= 0 or len(contenido) > self.max_bytes:
+            return
+        self._cargar_indice()
+        ruta = self._ruta(clave)
+        temporal = f'{ruta}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+        with self._lock:
+            # Un solo hilo por periodo rehace el índice
+            rescanear = time.monotonic() - self._escaneado >= PDF_CACHE_REESCANEO
+            if rescanear:
+                self._escaneado = time.monotonic()
+        if rescanear:
+            # Contar también lo que escribieron los otros workers (el archivo nuevo, con el mtime
+            # más reciente, queda al final del orden)
+            self._cargar_indice(forzar=True)
+        expulsados = []
+        with self._lock:
+            self._bytes += len(contenido) - self._indice.pop(clave, 0)
+            self._indice[clave] = len(contenido)
+            while self._bytes > self.max_bytes and self._indice:
+                viejo, tamaño = self._indice.popitem(last=False)
+                self._bytes -= tamaño
+                expulsados.append(viejo)
+            self.stats['evictions'] += len(expulsados)
+        for viejo in expulsados:
+            try:
+                os.remove(self._ruta(viejo))
+            except FileNotFoundError:
+                pass
+    
+    def _r2(self):
+        if not self.usar_r2:
+            return None, None
+        client = get_r2_client()
+        bucket = get_r2_bucket_name()
+        return (client, bucket) if client and bucket else (None, None)
+    
+    def _leer_r2(self, clave):
+        client, bucket = self._r2()
+        if not client:
+            return None
+        try:
+            obj = client.get_object(Bucket=bucket, Key=f'{self.prefijo_r2}{clave}.pdf')
+            return obj['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return None
+    
+    def _guardar_r2(self, clave, contenido):
+        client, bucket = self._r2()
+        if not client:
+            return
+        try:
+            client.put_object(Bucket=bucket, Key=f'{self.prefijo_r2}{clave}.pdf', Body=contenido,
+                              ContentType='application/pdf')
+        except Exception as e:
+            self._contar('errores')
+            print(f"⚠️ Caché PDF: no se pudo guardar en R2: {e}")
+    
+    def obtener(self, clave):
+        """(pdf_bytes, nivel) con nivel 'disco' o 'r2', o (None, None) si no está."""
+        try:
+            contenido = self._leer_disco(clave)
+            if contenido is not None:
+                self._contar('hits_disco')
+                return contenido, 'disco'
+            contenido = self._leer_r2(clave)
+            if contenido is not None:
+                self._contar('hits_r2')
+                self._guardar_disco(clave, contenido)
+                return contenido, 'r2'
+        except Exception as e:
+            # Un fallo de la caché nunca impide convertir
+            self._contar('errores')
+            print(f"⚠️ Caché PDF: error al leer {clave[:12]}: {e}")
+        self._contar('misses')
+        return None, None
+    
+    def guardar(self, clave, contenido):
+        self._contar('guardados')
+        try:
+            self._guardar_disco(clave, contenido)
+        except Exception as e:
+            self._contar('errores')
+            print(f"⚠️ Caché PDF: no se pudo guardar en disco: {e}")
+        if self._r2()[0]:
+            # La subida a R2 no retrasa la respuesta
+            threading.Thread(target=self._guardar_r2, args=(clave, contenido), daemon=True).start()
+    
+    def estado(self):
+        if self.max_bytes > 0 and os.path.isdir(self.carpeta):
+            self._cargar_indice()
+        with self._lock:
+            archivos = len(self._indice)
+            mb = round(self._bytes / (1024 * 1024), 2)
+            contadores = dict(self.stats)
+        consultas = contadores['hits_disco'] + contadores['hits_r2'] + contadores['misses']
+        aciertos = contadores['hits_disco'] + contadores['hits_r2']
+        return {
+            **contadores,
+            'hit_rate': round(aciertos / consultas, 4) if consultas else 0.0,
+            'carpeta': self.carpeta,
+            'archivos_disco': archivos,
+            'mb_disco': mb,
+            'max_mb_disco': PDF_CACHE_MAX_MB,
+            'r2': self._r2()[0] is not None,
+        }
+
+cache_pdf = CachePdf(PDF_CACHE_DIR, PDF_CACHE_MAX_MB, PDF_CACHE_R2, PDF_CACHE_R2_PREFIJO)
+
+def convertir_a_pdf_cacheado(word_file_bytes, filename='document.docx', backend=None, tiempos=None, usar_cache=True):
+    """
+    Como convertir_a_pdf, pero buscando primero en cache_pdf por el SHA-256 del .docx.
+    Devuelve (pdf_bytes, backend usado, nivel de caché 'disco'/'r2' o None si se convirtió).
+    """
+    clave = CachePdf.clave(word_file_bytes)
+    if usar_cache:
+        with medir_paso(tiempos, 'cache'):
+            pdf_bytes, nivel = cache_pdf.obtener(clave)
+        if pdf_bytes is not None:
+            return pdf_bytes, 'cache', nivel
+    pdf_bytes, backend_usado = convertir_a_pdf(word_file_bytes, filename, backend=backend, tiempos=tiempos)
+    cache_pdf.guardar(clave, pdf_bytes)
+    return pdf_bytes, backend_usado, None
+
+def convertir_lote_a_pdf(archivos, backend=None, tiempos=None):
+    """
+    Convierte varios .docx [(filename, bytes)]. Los que ya están en cache_pdf no se convierten;
+    con iLovePDF el resto va en tareas de varios archivos (convert_words_to_pdf_with_ilovepdf) y
+    con LibreOffice uno por uno en el pool. Devuelve [(filename, pdf_bytes, origen)] en el mismo
+    orden, con origen = backend usado o 'cache-disco' / 'cache-r2'.
+    """
+    claves = [CachePdf.clave(contenido) for _, contenido in archivos]
+    resultado: list[tuple[str, bytes, str] | None] = [None] * len(archivos)
+    with medir_paso(tiempos, 'cache'):
+        for i, clave in enumerate(claves):
+            pdf_bytes, nivel = cache_pdf.obtener(clave)
+            if pdf_bytes is not None:
+                resultado[i] = (archivos[i][0], pdf_bytes, f'cache-{nivel}')
+    pendientes = [i for i, r in enumerate(resultado) if r is None]
+    
+    if pendientes:
+        backend = backend_pdf(backend)
+        if backend == 'ilovepdf':
+            convertidos = convert_words_to_pdf_with_ilovepdf([archivos[i] for i in pendientes], tiempos)
+            for i, (filename, pdf_bytes) in zip(pendientes, convertidos):
+                resultado[i] = (filename, pdf_bytes, 'ilovepdf')
+        else:
+            for i in pendientes:
+                filename, contenido = archivos[i]
+                pdf_bytes, backend_usado = convertir_a_pdf(contenido, filename, backend=backend, tiempos=tiempos)
+                resultado[i] = (filename, pdf_bytes, backend_usado)
+    
+    completos = []
+    nuevos = set(pendientes)
+    for i, convertido in enumerate(resultado):
+        if convertido is None:
+            raise RuntimeError(f'No se obtuvo el PDF de {archivos[i][0]}')
+        if i in nuevos:
+            cache_pdf.guardar(claves[i], convertido[1])
+        completos.append(convertido)
+    return completos
+
+@app.route('/pdf-cache/stats', methods=['GET'])
+def pdf_cache_stats():
+    """Aciertos (disco / R2), fallos y tamaño de la caché de PDFs convertidos"""
+    return jsonify(cache_pdf.estado())
+
+# --- Salida de los endpoints de generación: .docx, o PDF convertido en la misma petición ---
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+FORMATOS_SALIDA = ('docx', 'pdf')
+
+def formato_salida(datos):
+    """Formato pedido en el parámetro o el campo 'format' del JSON ('docx' por defecto), o None si no es válido."""
+    datos = datos if isinstance(datos, dict) else {}
+    formato = str(request.args.get('format') or datos.get('format') or 'docx').strip().lower()
+    return formato if formato in FORMATOS_SALIDA else None
+
+def error_formato_salida():
+    return jsonify({'error': f"format debe ser uno de: {', '.join(FORMATOS_SALIDA)}"}), 400
+
+def respuesta_documento(contenido, filename, tiempos, formato):
+    """
+    Respuesta de un endpoint de generación. Con format=pdf el .docx recién generado pasa en memoria
+    al backend de conversión (con la caché de PDFs) y se devuelve el PDF, sin que el navegador tenga
+    que bajar el .docx y volver a subirlo. `formato` lo valida el endpoint (formato_salida) antes de
+    generar el documento.
+    `tiempos` trae los ms del render ('docx'); se devuelven en Server-Timing junto con los de la conversión.
+    """
+    datos = request.get_json(silent=True)
+    datos = datos if isinstance(datos, dict) else {}
+    if formato == 'docx':
+        respuesta = send_file(io.BytesIO(contenido), mimetype=DOCX_MIMETYPE, as_attachment=True, download_name=filename)
+        respuesta.headers['Server-Timing'] = cabecera_server_timing(tiempos)
+        return respuesta
+    
+    backend = request.args.get('backend') or datos.get('backend')
+    with medir_paso(tiempos, 'pdf'):
+        pdf_bytes, backend_usado, nivel_cache = convertir_a_pdf_cacheado(contenido, filename, backend=backend, tiempos=tiempos)
+    respuesta = send_file(io.BytesIO(pdf_bytes), mimetype='application/pdf', as_attachment=True,
+                          download_name=re.sub(r'\.docx$', '', filename) + '.pdf')
+    respuesta.headers['X-PDF-Backend'] = backend_usado
+    respuesta.headers['X-Cache'] = f'HIT-{nivel_cache.upper()}' if nivel_cache else 'MISS'
+    respuesta.headers['Server-Timing'] = cabecera_server_timing(tiempos)
+    return respuesta
+
+@app.route('/pdf-backends', methods=['GET'])
+def pdf_backends():
+    """Backend de conversión a PDF configurado, estado del pool de LibreOffice y de cada clave de iLovePDF"""
+    return jsonify({
+        'configurado': PDF_BACKEND,
+        'efectivo': backend_pdf(),
+        'respaldo_ilovepdf': PDF_RESPALDO_ILOVEPDF,
+        'libreoffice': pool_libreoffice.estado(),
+        'ilovepdf': pool_ilovepdf.estado(),
+    })
+
+@app.route('/convert-word-to-pdf', methods=['POST'])
+def convert_word_to_pdf():
+    """
+    Convierte un documento Word a PDF con el backend configurado (PDF_BACKEND) o el pedido en
+    el campo/parámetro 'backend' ('libreoffice' o 'ilovepdf'); iLovePDF queda de respaldo.
+    El mismo .docx se sirve desde la caché de PDFs (cabecera X-Cache); cache=0 fuerza la conversión.
+    """
+    try:
+        # Verificar si se envió un archivo
+        if 'file' not in request.files:
+            return jsonify({"error": "No se proporcionó ningún archivo"}), 400
+        
+        file = request.files['file']
+        
+        if file.filename == '':
+            return jsonify({"error": "Nombre de archivo vacío"}), 400
+        
+        # Leer el archivo
+        word_file_bytes = file.read()
+        
+        # Convertir a PDF
+        backend = request.form.get('backend') or request.args.get('backend')
+        usar_cache = (request.form.get('cache') or request.args.get('cache') or '1') != '0'
+        tiempos = {}
+        pdf_bytes, backend_usado, nivel_cache = convertir_a_pdf_cacheado(
+            word_file_bytes, file.filename, backend=backend, tiempos=tiempos, usar_cache=usar_cache)
+        
+        # Preparar respuesta
+        output = io.BytesIO(pdf_bytes)
+        output.seek(0)
+        
+        # Nombre del archivo PDF
+        pdf_filename = file.filename.replace('.docx', '.pdf').replace('.doc', '.pdf')
+        if not pdf_filename.endswith('.pdf'):
+            pdf_filename += '.pdf'
+        
+        respuesta = send_file(
+            output,
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=pdf_filename
+        )
+        respuesta.headers['X-PDF-Backend'] = backend_usado
+        respuesta.headers['X-Cache'] = f'HIT-{nivel_cache.upper()}' if nivel_cache else 'MISS'
+        respuesta.headers['Server-Timing'] = cabecera_server_timing(tiempos)
+        return respuesta
+        
+    except Exception as e:
+        import traceback
+        return jsonify({
+            "error": str(e),
+            "traceback": traceback.format_exc()
+        }), 500
+
+# Máximo de archivos por petición a /convert-word-to-pdf/batch
+PDF_BATCH_MAX = int(os.getenv('PDF_BATCH_MAX', '100'))
+
+def _nombre_pdf(filename):
+    return re.sub(r'\.docx?$', '', filename, flags=re.IGNORECASE) + '.pdf'
+
+def _entradas_lote_pdf(archivos, backend):
+    """
+    (archivo, contenido) de cada PDF del lote y al final el manifest.json con el origen de cada uno.
+    Se convierte en tandas de ILOVEPDF_LOTE_MAX y cada tanda se entrega antes de convertir la
+    siguiente: en memoria solo hay una tanda de PDFs. Un error en la primera tanda se propaga; en
+    las siguientes (el ZIP ya se está enviando) queda en el manifest.
+    """
+    tiempos = {}
+    manifest = []
+    tamaño_tanda = max(ILOVEPDF_LOTE_MAX, 1)
+    for inicio in range(0, len(archivos), tamaño_tanda):
+        tanda = archivos[inicio:inicio + tamaño_tanda]
+        try:
+            convertidos = convertir_lote_a_pdf(tanda, backend=backend, tiempos=tiempos)
+        except Exception as e:
+            if inicio == 0:
+                raise
+            for i, (filename, _) in enumerate(tanda, start=inicio + 1):
+                manifest.append({'indice': i, 'entrada': filename, 'error': f'No se pudo convertir a PDF: {e}'})
+            continue
+        for i, (filename, pdf_bytes, origen) in enumerate(convertidos, start=inicio + 1):
+            # Prefijo con la posición: dos archivos con el mismo nombre no se pisan en el ZIP
+            archivo = f"{i:03d}_{_nombre_pdf(filename)}"
+            manifest.append({'indice': i, 'entrada': filename, 'archivo': archivo, 'bytes': len(pdf_bytes), 'backend': origen})
+            yield archivo, pdf_bytes
+    yield 'manifest.json', json.dumps({'total': len(archivos), 'tiempos_ms': tiempos, 'items': manifest},
+                                      ensure_ascii=False, indent=2)
+
+@app.route('/convert-word-to-pdf/batch', methods=['POST'])
+def convert_word_to_pdf_batch():
+    """
+    Convierte varios documentos Word (campo 'files', repetido) y devuelve un ZIP con un PDF por archivo
+    y manifest.json (archivo de origen -> PDF). Con iLovePDF todos van en una sola tarea: subidas en
+    paralelo, un solo process y una sola descarga. Los que ya están en la caché de PDFs no se convierten.
+    """
+    try:
+        archivos = [(f.filename or 'document.docx', f.read()) for f in request.files.getlist('files') if f.filename]
+        if not archivos:
+            return jsonify({"error": "No se proporcionó ningún archivo (campo 'files')"}), 400
+        if len(archivos) > PDF_BATCH_MAX:
+            return jsonify({"error": f"Máximo {PDF_BATCH_MAX} archivos por lote"}), 400
+        
+        backend = request.form.get('backend') or request.args.get('backend')
+        # La primera tanda se convierte antes de responder (un error sale como JSON y no como un ZIP
+        # cortado); el resto se convierte mientras el ZIP se envía
+        entradas = _entradas_lote_pdf(archivos, backend)
+        primera = next(entradas)
+        filename = f"PDFs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        return respuesta_zip_stream(itertools.chain([primera], entradas), filename)
+        
+    except Exception as e:
+        import traceback
+        return jsonify({
+            "error": str(e),
+            "traceback": traceback.format_exc()
+        }), 500
+
+# --- Hoja de vida: documento base con estilos con nombre (se construye una vez por worker) ---
+HV_AZUL = RGBColor(0x44, 0x72, 0xC4)
+
+_hv_base = None
+_hv_base_lock = threading.Lock()
+
+def _crear_base_hv():
+    """
+    Documento vacío con los estilos de la hoja de vida. Los runs solo referencian el estilo
+    (w:rStyle / w:pStyle) en vez de repetir color, negrilla y fuente en cada w:rPr.
+    Los estilos solo llevan lo que difiere de los valores por defecto del documento (Normal está
+    vacío, el texto es Cambria 11 y negro): lo demás haría crecer styles.xml sin cambiar nada.
+    """
+    from typing import cast
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.styles.style import CharacterStyle, ParagraphStyle
+    doc = Document()
+    estilos = doc.styles
+    
+    # Nombre principal: Cambria 18, azul, negrita
+    nombre = cast(ParagraphStyle, estilos.add_style('HV Nombre', WD_STYLE_TYPE.PARAGRAPH))
+    nombre.font.size = Pt(18)
+    nombre.font.bold = True
+    nombre.font.color.rgb = HV_AZUL
+    
+    # Títulos de sección: centrados, 12 pt, azul, negrita
+    titulo = cast(ParagraphStyle, estilos.add_style('HV Titulo Seccion', WD_STYLE_TYPE.PARAGRAPH))
+    titulo.font.size = Pt(12)
+    titulo.font.bold = True
+    titulo.font.color.rgb = HV_AZUL
+    titulo.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    # Encabezado: barra azul #5B9BD5 con el nombre en blanco, negrita, a la derecha
+    encabezado = cast(ParagraphStyle, estilos.add_style('HV Encabezado', WD_STYLE_TYPE.PARAGRAPH))
+    encabezado.base_style = cast(ParagraphStyle, estilos['Header'])
+    encabezado.font.name = 'Calibri'
+    encabezado.font.bold = True
+    encabezado.font.color.rgb = RGBColor(255, 255, 255)
+    encabezado.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    pPr = encabezado.element.get_or_add_pPr()
+    # Sombreado, espaciado superior/inferior (para que se vea como una barra) e indentación derecha
+    pPr.append(parse_xml(r'<w:shd xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" w:fill="5B9BD5" w:val="clear"/>'))
+    encabezado.paragraph_format.space_before = Pt(12)
+    encabezado.paragraph_format.space_after = Pt(12)
+    encabezado.paragraph_format.right_indent = Inches(0.25)
+    
+    # Estilos de carácter para etiquetas y valores (los valores normales van sin estilo)
+    etiqueta = cast(CharacterStyle, estilos.add_style('HV Etiqueta', WD_STYLE_TYPE.CHARACTER))
+    etiqueta.font.bold = True
+    etiqueta.font.color.rgb = HV_AZUL
+    valor_negrita = cast(CharacterStyle, estilos.add_style('HV Valor Negrita', WD_STYLE_TYPE.CHARACTER))
+    valor_negrita.font.bold = True
+    referencia = cast(CharacterStyle, estilos.add_style('HV Referencia', WD_STYLE_TYPE.CHARACTER))
+    referencia.font.italic = True
+    referencia.font.color.rgb = HV_AZUL
+    
+    # Párrafo del encabezado listo para recibir el nombre
+    header = doc.sections[0].header
+    for para in header.paragraphs:
+        para.clear()
+    header.paragraphs[0].style = encabezado
+    _podar_estilos_hv(doc)
+    return doc
+
+def _podar_estilos_hv(doc):
+    """
+    Quita de styles.xml las definiciones de estilo que la hoja de vida no usa (el template por
+    defecto de python-docx trae ~170 y ocupan casi todo el .docx). Se conservan los estilos por
+    defecto, los HV, los que referencian el encabezado y numbering.xml, y sus basedOn/link/next.
+    Los estilos integrados de Word siguen en latentStyles y Word los recrea si el usuario los aplica.
+    """
+    raiz = doc.styles.element
+    estilos = {e.get(qn('w:styleId')): e for e in raiz.findall(qn('w:style'))}
+    usados = {sid for sid, e in estilos.items() if e.get(qn('w:default')) == '1'}
+    partes = [doc.sections[0].header.part.element, doc.part.numbering_part.element]
+    for parte in partes:
+        for ref in parte.iter(qn('w:pStyle'), qn('w:rStyle')):
+            usados.add(ref.get(qn('w:val')))
+    usados.update(doc.styles[nombre].style_id for nombre in HV_ESTILOS)
+    pendientes = list(usados)
+    while pendientes:
+        estilo = estilos.get(pendientes.pop())
+        if estilo is None:
+            continue
+        for etiqueta in ('w:basedOn', 'w:link', 'w:next'):
+            ref = estilo.find(qn(etiqueta))
+            if ref is not None and ref.get(qn('w:val')) not in usados:
+                usados.add(ref.get(qn('w:val')))
+                pendientes.append(ref.get(qn('w:val')))
+    for sid, estilo in estilos.items():
+        if sid not in usados:
+            raiz.remove(estilo)
+
+def obtener_base_hv():
+    """Copia del documento base de la hoja de vida (el original se crea una sola vez)."""
+    global _hv_base
+    if _hv_base is None:
+        with _hv_base_lock:
+            if _hv_base is None:
+                _hv_base = _crear_base_hv()
+    return copy.deepcopy(_hv_base)
+
+HV_ESTILOS = ('HV Nombre', 'HV Titulo Seccion', 'HV Etiqueta', 'HV Valor Negrita', 'HV Referencia')
+
+_hv_fragmentos = None
+
+def fragmentos_hv():
+    """
+    Plantillas XML (str.format) de las piezas repetidas de la hoja de vida, compiladas una vez
+    a partir de los style_id del documento base. Los valores se escapan con _hv_texto antes de rellenarlas.
+    """
+    global _hv_fragmentos
+    if _hv_fragmentos is None:
+        with _hv_base_lock:
+            if _hv_fragmentos is None:
+                base = _crear_base_hv() if _hv_base is None else _hv_base
+                ids = {nombre: base.styles[nombre].style_id for nombre in HV_ESTILOS}
+                run = '<w:r><w:rPr><w:rStyle w:val="%s"/></w:rPr>{%s}</w:r>'
+                _hv_fragmentos = {
+                    'vacio': '<w:p/>',
+                    'salto': '<w:p><w:r><w:br w:type="page"/></w:r></w:p>',
+                    'texto': '<w:p><w:r>{texto}</w:r></w:p>',
+                    'nombre': '<w:p><w:pPr><w:pStyle w:val="%s"/></w:pPr><w:r>{texto}</w:r></w:p>' % ids['HV Nombre'],
+                    'titulo': '<w:p><w:pPr><w:pStyle w:val="%s"/></w:pPr><w:r>{texto}</w:r></w:p>' % ids['HV Titulo Seccion'],
+                    'etiqueta': '<w:p>' + run % (ids['HV Etiqueta'], 'texto') + '</w:p>',
+                    'valor': '<w:p><w:r>{texto}</w:r></w:p>',
+                    'referencia': '<w:p>' + run % (ids['HV Referencia'], 'texto') + '</w:p>',
+                    'linea': '<w:p>' + run % (ids['HV Etiqueta'], 'etiqueta') + '<w:r>{valor}</w:r></w:p>',
+                    'linea_negrita': '<w:p>' + run % (ids['HV Etiqueta'], 'etiqueta') + run % (ids['HV Valor Negrita'], 'valor') + '</w:p>',
+                }
+    return _hv_fragmentos
+
+# Tabulaciones y saltos de línea: run.text de python-docx los escribe como w:tab / w:br, no en w:t
+_CONTROL_TEXTO_RE = re.compile(r'([\t\n\r])')
+
+def _hv_texto(valor):
+    """
+    Contenido de un run para un texto: w:t escapado, con tabulaciones y saltos de línea
+    convertidos en w:tab / w:br (igual que run.text de python-docx).
+    """
+    partes = []
+    for trozo in _CONTROL_TEXTO_RE.split(str(valor)):
+        if not trozo:
+            continue
+        if trozo == '\t':
+            partes.append('<w:tab/>')
+        elif trozo in ('\n', '\r'):
+            partes.append('<w:br/>')
+        elif trozo.strip() != trozo:
+            # xml:space solo si hay espacios al borde, como python-docx: el XML no crece sin motivo
+            partes.append('<w:t xml:space="preserve">%s</w:t>' % _escapar_xml(trozo))
+        else:
+            partes.append('<w:t>%s</w:t>' % _escapar_xml(trozo))
+    return ''.join(partes)
+
+class _HvCuerpo:
+    """Acumula los párrafos de la hoja de vida como XML y los inserta de una vez en el body."""
+    
+    def __init__(self):
+        self.frag = fragmentos_hv()
+        self.partes = []
+    
+    def vacio(self, veces=1):
+        self.partes.extend([self.frag['vacio']] * veces)
+    
+    def salto(self):
+        self.partes.append(self.frag['salto'])
+    
+    def parrafo(self, tipo, texto):
+        self.partes.append(self.frag[tipo].format(texto=_hv_texto(texto)))
+    
+    def linea(self, etiqueta, valor, negrita=False):
+        """Línea 'Etiqueta: valor' con la etiqueta en azul negrita y el valor en negro."""
+        self.partes.append(self.frag['linea_negrita' if negrita else 'linea'].format(
+            etiqueta=_hv_texto(etiqueta), valor=_hv_texto(valor)))
+    
+    def volcar(self, doc):
+        body = doc.element.body
+        nuevos = parse_xml('<w:body %s>%s</w:body>' % (nsdecls('w'), ''.join(self.partes)))
+        sect_pr = body.sectPr
+        for p in list(nuevos):
+            if sect_pr is not None:
+                sect_pr.addprevious(p)
+            else:
+                body.append(p)
+        self.partes = []
+
+def _hv_formacion(cuerpo, high_school, institution, formaciones):
+    """Sección FORMACIÓN ACADÉMICA (sin tabla, solo texto alineado)."""
+    cuerpo.parrafo('titulo', "FORMACIÓN ACADÉMICA")
+    cuerpo.vacio()
+    
+    if high_school or institution:
+        cuerpo.linea("BACHILLER: ", high_school)
+        cuerpo.linea("INSTITUCION: ", institution)
+    
+    # Formación técnica/universitaria (puede haber múltiples)
+    # Solo agregar si NO es "Bachiller" (ya está arriba)
+    for form in formaciones:
+        tipo_form = form.get('tipo', '').strip().upper()
+        nombre_form = form.get('nombre', '').strip()
+        if tipo_form and tipo_form != 'BACHILLER' and nombre_form:
+            cuerpo.vacio()
+            # El valor en la misma línea con dos puntos
+            cuerpo.linea(f"{tipo_form}: ", nombre_form)
+
+def _hv_referencias(cuerpo, titulo, referencias):
+    """Sección de referencias (familiares o personales): nombre en cursiva azul y teléfono."""
+    if not referencias:
+        return
+    cuerpo.parrafo('titulo', titulo)
+    cuerpo.vacio()
+    
+    for ref in referencias:
+        nombre_ref = ref.get('nombre', '').strip()
+        telefono_ref = ref.get('telefono', ref.get('celular', '')).strip()
+        
+        if nombre_ref:
+            cuerpo.parrafo('referencia', nombre_ref)
+            if telefono_ref:
+                cuerpo.linea("Teléfono: ", telefono_ref, negrita=True)
+            cuerpo.vacio()
+
+@app.route('/generate-word', methods=['POST'])
+def generate_word():
+    """Genera un documento Word desde cero con todos los datos recibidos"""
+    try:
+        data = request.json
+        formato = formato_salida(data)
+        if formato is None:
+            return error_formato_salida()
+        
+        # Obtener datos básicos
+        nombre = data.get('fullName', '').strip()
+        cedula = data.get('idNumber', '').strip()
+        fecha_raw = data.get('birthDate', '').strip()
+        fecha = formatear_fecha(fecha_raw)  # Convertir a formato "20 de noviembre de 1990"
         telefono = data.get('phone', '').strip()
         direccion = data.get('address', '').strip()
         ciudad = data.get('place', '').strip()
@@ -591,640 +2070,951 @@ def generate_word():
         high_school = data.get('highSchool', '').strip()
         institution = data.get('institution', '').strip()
         
-        # Crear un nuevo documento desde cero
-        doc = Document()
-        
-        # Configurar encabezado con fondo azul
-        section = doc.sections[0]
-        header = section.header
-        
-        # Limpiar párrafos existentes del encabezado
-        for para in header.paragraphs:
-            para.clear()
-        
-        # Crear nuevo párrafo para el encabezado
-        header_para = header.paragraphs[0] if header.paragraphs else header.add_paragraph()
-        header_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-        
-        # Agregar fondo azul al encabezado usando XML
-        header_xml = header_para._element
-        pPr = header_xml.get_or_add_pPr()
-        
-        # Crear elemento de sombreado (fondo azul #5B9BD5)
-        shd = parse_xml(r'<w:shd xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" w:fill="5B9BD5" w:val="clear"/>')
-        pPr.append(shd)
-        
-        # Agregar espaciado superior e inferior para que el fondo se vea como una barra
-        spacing = parse_xml(r'<w:spacing xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" w:before="240" w:after="240"/>')
-        pPr.append(spacing)
-        
-        # Agregar indentación derecha para que el texto no toque el borde
-        ind = parse_xml(r'<w:ind xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" w:right="360"/>')
-        pPr.append(ind)
-        
-        # Agregar el nombre en blanco, negrita
-        header_run = header_para.add_run(nombre.upper())
-        header_run.font.name = "Calibri"
-        header_run.font.size = Pt(11)
-        header_run.font.color.rgb = RGBColor(255, 255, 255)  # Blanco
-        header_run.bold = True
-        
-        # Agregar espacio
-        doc.add_paragraph()
-        
-        # Nombre principal (Cambria 18, color #4472C4, mayúsculas, negrita)
-        p_nombre = doc.add_paragraph()
-        run_nombre = p_nombre.add_run(nombre.upper())
-        run_nombre.font.name = "Cambria"
-        run_nombre.font.size = Pt(18)
-        run_nombre.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_nombre.bold = True
-        p_nombre.alignment = WD_ALIGN_PARAGRAPH.LEFT
-        doc.add_paragraph()
-        
-        # Información personal - etiquetas en negrita azul, valores en negro
-        p_cedula = doc.add_paragraph()
-        run_cedula_label = p_cedula.add_run("Número de cédula: ")
-        run_cedula_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_cedula_label.bold = True
-        run_cedula_valor = p_cedula.add_run(cedula)
-        run_cedula_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        p_fecha = doc.add_paragraph()
-        run_fecha_label = p_fecha.add_run("Fecha de nacimiento: ")
-        run_fecha_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_fecha_label.bold = True
-        run_fecha_valor = p_fecha.add_run(fecha)
-        run_fecha_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        p_tel = doc.add_paragraph()
-        run_tel_label = p_tel.add_run("Teléfono móvil: ")
-        run_tel_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_tel_label.bold = True
-        run_tel_valor = p_tel.add_run(telefono)
-        run_tel_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        p_dir = doc.add_paragraph()
-        run_dir_label = p_dir.add_run("Dirección: ")
-        run_dir_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_dir_label.bold = True
-        run_dir_valor = p_dir.add_run(direccion)
-        run_dir_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        p_ciu = doc.add_paragraph()
-        run_ciu_label = p_ciu.add_run("Ciudad: ")
-        run_ciu_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_ciu_label.bold = True
-        run_ciu_valor = p_ciu.add_run(ciudad)
-        run_ciu_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        p_est = doc.add_paragraph()
-        run_est_label = p_est.add_run("Estado civil: ")
-        run_est_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_est_label.bold = True
-        run_est_valor = p_est.add_run(estado_civil)
-        run_est_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        if correo:
-            p_corr = doc.add_paragraph()
-            run_corr_label = p_corr.add_run("Correo: ")
-            run_corr_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-            run_corr_label.bold = True
-            run_corr_valor = p_corr.add_run(correo)
-            run_corr_valor.font.color.rgb = RGBColor(0, 0, 0)
-        
-        # Perfil Profesional - título en azul, negrita, mayúsculas
-        if texto_perfil:
-            p_perfil_titulo = doc.add_paragraph()
-            p_perfil_titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run_perfil_titulo = p_perfil_titulo.add_run("PERFIL PROFESIONAL")
-            run_perfil_titulo.bold = True
-            run_perfil_titulo.font.size = Pt(12)
-            run_perfil_titulo.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-            doc.add_paragraph()
+        def renderizar():
+            # Copia del documento base con los estilos de la hoja de vida (se construye una vez por worker)
+            doc = obtener_base_hv()
+            cuerpo = _HvCuerpo()
             
-            p_perfil_texto = doc.add_paragraph()
-            p_perfil_texto.add_run(texto_perfil)
-        
-        # Si NO hay experiencia laboral, agregar formación académica en la hoja 1
-        if not experiencias:
-            # Solo agregar formación académica si hay datos
-            if high_school or institution or formaciones:
-                doc.add_paragraph()
-                doc.add_paragraph()
-                
-                # Formación Académica - título en azul, negrita, mayúsculas (hoja 1)
-                p_formacion_titulo = doc.add_paragraph()
-                p_formacion_titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                run_formacion_titulo = p_formacion_titulo.add_run("FORMACIÓN ACADÉMICA")
-                run_formacion_titulo.bold = True
-                run_formacion_titulo.font.size = Pt(12)
-                run_formacion_titulo.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                doc.add_paragraph()
-                
-                # Formación académica sin tabla, solo texto alineado
-                if high_school or institution:
-                    p_sec = doc.add_paragraph()
-                    run_sec_label = p_sec.add_run("BACHILLER: ")
-                    run_sec_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_sec_label.bold = True
-                    run_sec_valor = p_sec.add_run(high_school)
-                    run_sec_valor.font.color.rgb = RGBColor(0, 0, 0)
-                    
-                    p_inst = doc.add_paragraph()
-                    run_inst_label = p_inst.add_run("INSTITUCION: ")
-                    run_inst_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_inst_label.bold = True
-                    run_inst_valor = p_inst.add_run(institution)
-                    run_inst_valor.font.color.rgb = RGBColor(0, 0, 0)
-                
-                # Formación técnica/universitaria (puede haber múltiples)
-                # Solo agregar si NO es "Bachiller" (ya está arriba)
-                for form in formaciones:
-                    tipo_form = form.get('tipo', '').strip().upper()
-                    nombre_form = form.get('nombre', '').strip()
-                    
-                    # Filtrar: no mostrar si es "BACHILLER" (ya está en la sección de secundaria)
-                    if tipo_form and tipo_form != 'BACHILLER' and nombre_form:
-                        doc.add_paragraph()
-                        p_tec = doc.add_paragraph()
-                        run_tec_label = p_tec.add_run(tipo_form)
-                        run_tec_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_tec_label.bold = True
-                        # El valor en la misma línea con dos puntos
-                        run_tec_colon = p_tec.add_run(": ")
-                        run_tec_colon.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_tec_colon.bold = True
-                        run_tec_valor = p_tec.add_run(nombre_form)
-                        run_tec_valor.font.color.rgb = RGBColor(0, 0, 0)
-                
-                # Salto de página después de formación académica (inicio de hoja 2 para referencias)
-                p_break1 = doc.add_paragraph()
-                run_break1 = p_break1.add_run()
-                run_break1.add_break(WD_BREAK.PAGE)
-        else:
-            # Si hay experiencia laboral, salto de página después del perfil profesional (inicio de hoja 2)
-            p_break1 = doc.add_paragraph()
-            run_break1 = p_break1.add_run()
-            run_break1.add_break(WD_BREAK.PAGE)
+            # Encabezado con fondo azul: el párrafo ya tiene el estilo 'HV Encabezado', solo falta el nombre
+            header_para = doc.sections[0].header.paragraphs[0]
+            header_para.add_run(nombre.upper())
             
-            # Formación Académica - título en azul, negrita, mayúsculas (hoja 2)
-            # Solo agregar si hay datos
-            if high_school or institution or formaciones:
-                p_formacion_titulo = doc.add_paragraph()
-                p_formacion_titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                run_formacion_titulo = p_formacion_titulo.add_run("FORMACIÓN ACADÉMICA")
-                run_formacion_titulo.bold = True
-                run_formacion_titulo.font.size = Pt(12)
-                run_formacion_titulo.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                doc.add_paragraph()
-                
-                # Formación académica sin tabla, solo texto alineado
-                if high_school or institution:
-                    p_sec = doc.add_paragraph()
-                    run_sec_label = p_sec.add_run("BACHILLER: ")
-                    run_sec_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_sec_label.bold = True
-                    run_sec_valor = p_sec.add_run(high_school)
-                    run_sec_valor.font.color.rgb = RGBColor(0, 0, 0)
-                    
-                    p_inst = doc.add_paragraph()
-                    run_inst_label = p_inst.add_run("INSTITUCION: ")
-                    run_inst_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_inst_label.bold = True
-                    run_inst_valor = p_inst.add_run(institution)
-                    run_inst_valor.font.color.rgb = RGBColor(0, 0, 0)
-                
-                # Formación técnica/universitaria (puede haber múltiples)
-                # Solo agregar si NO es "Bachiller" (ya está arriba)
-                for form in formaciones:
-                    tipo_form = form.get('tipo', '').strip().upper()
-                    nombre_form = form.get('nombre', '').strip()
-                    
-                    # Filtrar: no mostrar si es "BACHILLER" (ya está en la sección de secundaria)
-                    if tipo_form and tipo_form != 'BACHILLER' and nombre_form:
-                        doc.add_paragraph()
-                        p_tec = doc.add_paragraph()
-                        run_tec_label = p_tec.add_run(tipo_form)
-                        run_tec_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_tec_label.bold = True
-                        # El valor en la misma línea con dos puntos
-                        run_tec_colon = p_tec.add_run(": ")
-                        run_tec_colon.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_tec_colon.bold = True
-                        run_tec_valor = p_tec.add_run(nombre_form)
-                        run_tec_valor.font.color.rgb = RGBColor(0, 0, 0)
-                
-                doc.add_paragraph()
-                doc.add_paragraph()
-        
-        # Experiencia Laboral - título en azul, negrita, mayúsculas, centrado (hoja 2, solo si hay experiencia)
-        if experiencias:
-            p_exp_titulo = doc.add_paragraph()
-            p_exp_titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run_exp_titulo = p_exp_titulo.add_run("EXPERIENCIA LABORAL")
-            run_exp_titulo.bold = True
-            run_exp_titulo.font.size = Pt(12)
-            run_exp_titulo.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-            doc.add_paragraph()
+            # Agregar espacio
+            cuerpo.vacio()
+            
+            # Nombre principal (Cambria 18, color #4472C4, mayúsculas, negrita)
+            cuerpo.parrafo('nombre', nombre.upper())
+            cuerpo.vacio()
             
-            for experiencia in experiencias:
-                # Las experiencias pueden venir con 'empresa' o 'local', 'cargo' o 'cargo', 'tiempo' o 'fechaInicio/fechaFin'
-                empresa = experiencia.get('empresa', experiencia.get('local', '')).strip()
-                cargo = experiencia.get('cargo', '').strip()
-                tiempo = experiencia.get('tiempo', '')
+            # Información personal - etiquetas en negrita azul, valores en negro
+            cuerpo.linea("Número de cédula: ", cedula)
+            cuerpo.linea("Fecha de nacimiento: ", fecha)
+            cuerpo.linea("Teléfono móvil: ", telefono)
+            cuerpo.linea("Dirección: ", direccion)
+            cuerpo.linea("Ciudad: ", ciudad)
+            cuerpo.linea("Estado civil: ", estado_civil)
+            if correo:
+                cuerpo.linea("Correo: ", correo)
+            
+            # Perfil Profesional - título en azul, negrita, mayúsculas
+            if texto_perfil:
+                cuerpo.parrafo('titulo', "PERFIL PROFESIONAL")
+                cuerpo.vacio()
+                cuerpo.parrafo('texto', texto_perfil)
+            
+            hay_formacion = bool(high_school or institution or formaciones)
+            
+            # Si NO hay experiencia laboral, agregar formación académica en la hoja 1
+            if not experiencias:
+                # Solo agregar formación académica si hay datos
+                if hay_formacion:
+                    cuerpo.vacio(2)
+                    _hv_formacion(cuerpo, high_school, institution, formaciones)
+                    # Salto de página después de formación académica (inicio de hoja 2 para referencias)
+                    cuerpo.salto()
+            else:
+                # Si hay experiencia laboral, salto de página después del perfil profesional (inicio de hoja 2)
+                cuerpo.salto()
+            
+                # Formación Académica (hoja 2), solo si hay datos
+                if hay_formacion:
+                    _hv_formacion(cuerpo, high_school, institution, formaciones)
+                    cuerpo.vacio(2)
+            
+            # Experiencia Laboral - título en azul, negrita, mayúsculas, centrado (hoja 2, solo si hay experiencia)
+            if experiencias:
+                cuerpo.parrafo('titulo', "EXPERIENCIA LABORAL")
+                cuerpo.vacio()
+            
+                for experiencia in experiencias:
+                    # Las experiencias pueden venir con 'empresa' o 'local', 'cargo' o 'cargo', 'tiempo' o 'fechaInicio/fechaFin'
+                    empresa = experiencia.get('empresa', experiencia.get('local', '')).strip()
+                    cargo = experiencia.get('cargo', '').strip()
+                    tiempo = experiencia.get('tiempo', '')
                 
-                # Si no viene tiempo, construirlo desde fechaInicio y fechaFin
-                if not tiempo:
-                    fecha_inicio = experiencia.get('fechaInicio', '').strip()
-                    fecha_fin = experiencia.get('fechaFin', '').strip()
-                    if fecha_inicio and fecha_fin:
-                        tiempo = f"Desde {fecha_inicio} hasta {fecha_fin}"
+                    # Si no viene tiempo, construirlo desde fechaInicio y fechaFin
+                    if not tiempo:
+                        fecha_inicio = experiencia.get('fechaInicio', '').strip()
+                        fecha_fin = experiencia.get('fechaFin', '').strip()
+                        if fecha_inicio and fecha_fin:
+                            tiempo = f"Desde {fecha_inicio} hasta {fecha_fin}"
                 
-                if empresa and cargo:
-                    p_estab = doc.add_paragraph()
-                    run_estab_label = p_estab.add_run("ESTABLECIMIENTO: ")
-                    run_estab_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_estab_label.bold = True
-                    run_estab_valor = p_estab.add_run(empresa)
-                    run_estab_valor.font.color.rgb = RGBColor(0, 0, 0)
-                    
-                    p_cargo = doc.add_paragraph()
-                    run_cargo_label = p_cargo.add_run("CARGO: ")
-                    run_cargo_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_cargo_label.bold = True
-                    run_cargo_valor = p_cargo.add_run(cargo)
-                    run_cargo_valor.font.color.rgb = RGBColor(0, 0, 0)
-                    
-                    if tiempo:
-                        p_periodo = doc.add_paragraph()
-                        run_periodo_label = p_periodo.add_run("PERIODO LABORAL: ")
-                        run_periodo_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_periodo_label.bold = True
-                        run_periodo_valor = p_periodo.add_run(tiempo)
-                        run_periodo_valor.font.color.rgb = RGBColor(0, 0, 0)
-                    
-                    doc.add_paragraph()
-                    doc.add_paragraph()
+                    if empresa and cargo:
+                        cuerpo.linea("ESTABLECIMIENTO: ", empresa)
+                        cuerpo.linea("CARGO: ", cargo)
+                        if tiempo:
+                            cuerpo.linea("PERIODO LABORAL: ", tiempo)
+                        cuerpo.vacio(2)
             
-            # Si hay experiencia, salto de página para referencias (hoja 3)
-            p_break2 = doc.add_paragraph()
-            run_break2 = p_break2.add_run()
-            run_break2.add_break(WD_BREAK.PAGE)
-        
-        # Referencias Familiares - título en azul, negrita, mayúsculas, centrado
-        # Solo agregar si hay referencias familiares
-        if referencias_familiares:
-            p_ref_fam_titulo = doc.add_paragraph()
-            p_ref_fam_titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run_ref_fam_titulo = p_ref_fam_titulo.add_run("REFERENCIAS FAMILIARES")
-            run_ref_fam_titulo.bold = True
-            run_ref_fam_titulo.font.size = Pt(12)
-            run_ref_fam_titulo.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-            doc.add_paragraph()
+                # Si hay experiencia, salto de página para referencias (hoja 3)
+                cuerpo.salto()
             
-            for ref in referencias_familiares:
-                nombre_ref = ref.get('nombre', '').strip()
-                telefono_ref = ref.get('telefono', ref.get('celular', '')).strip()
-                
-                if nombre_ref:
-                    p_ref_fam_nombre = doc.add_paragraph()
-                    run_ref_fam_nombre = p_ref_fam_nombre.add_run(nombre_ref)
-                    run_ref_fam_nombre.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_ref_fam_nombre.italic = True
-                    
-                    if telefono_ref:
-                        p_ref_fam_tel = doc.add_paragraph()
-                        run_ref_fam_tel_label = p_ref_fam_tel.add_run("Teléfono: ")
-                        run_ref_fam_tel_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_ref_fam_tel_label.bold = True
-                        run_ref_fam_tel_valor = p_ref_fam_tel.add_run(telefono_ref)
-                        run_ref_fam_tel_valor.font.color.rgb = RGBColor(0, 0, 0)
-                        run_ref_fam_tel_valor.bold = True
-                    
-                    doc.add_paragraph()
-        
-        # Referencias Personales - título en azul, negrita, mayúsculas, centrado
-        # Solo agregar si hay referencias personales
-        if referencias_personales:
-            p_ref_per_titulo = doc.add_paragraph()
-            p_ref_per_titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run_ref_per_titulo = p_ref_per_titulo.add_run("REFERENCIAS PERSONALES")
-            run_ref_per_titulo.bold = True
-            run_ref_per_titulo.font.size = Pt(12)
-            run_ref_per_titulo.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-            doc.add_paragraph()
+            # Referencias Familiares y Personales - título en azul, negrita, mayúsculas, centrado
+            # Solo se agrega cada sección si tiene referencias
+            _hv_referencias(cuerpo, "REFERENCIAS FAMILIARES", referencias_familiares)
+            _hv_referencias(cuerpo, "REFERENCIAS PERSONALES", referencias_personales)
             
-            for ref in referencias_personales:
-                nombre_ref = ref.get('nombre', '').strip()
-                telefono_ref = ref.get('telefono', ref.get('celular', '')).strip()
-                
-                if nombre_ref:
-                    p_ref_per_nombre = doc.add_paragraph()
-                    run_ref_per_nombre = p_ref_per_nombre.add_run(nombre_ref)
-                    run_ref_per_nombre.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                    run_ref_per_nombre.italic = True
-                    
-                    if telefono_ref:
-                        p_ref_per_tel = doc.add_paragraph()
-                        run_ref_per_tel_label = p_ref_per_tel.add_run("Teléfono: ")
-                        run_ref_per_tel_label.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-                        run_ref_per_tel_label.bold = True
-                        run_ref_per_tel_valor = p_ref_per_tel.add_run(telefono_ref)
-                        run_ref_per_tel_valor.font.color.rgb = RGBColor(0, 0, 0)
-                        run_ref_per_tel_valor.bold = True
-                    
-                    doc.add_paragraph()
-        
-        # Espacios finales antes del pie de página
-        doc.add_paragraph()
-        doc.add_paragraph()
-        doc.add_paragraph()
-        
-        # Pie de página con nombre en azul, negrita, mayúsculas
-        p_final = doc.add_paragraph()
-        run_final = p_final.add_run(nombre.upper())
-        run_final.font.color.rgb = RGBColor(0x44, 0x72, 0xC4)
-        run_final.bold = True
-        
-        p_cedula_final = doc.add_paragraph()
-        run_cedula_final = p_cedula_final.add_run(f"C.C. {cedula} de {exp}")
-        run_cedula_final.font.color.rgb = RGBColor(0, 0, 0)
-        
-        # Guardar en memoria
-        output = io.BytesIO()
-        doc.save(output)
-        output.seek(0)
+            # Espacios finales antes del pie de página
+            cuerpo.vacio(3)
+            
+            # Pie de página con nombre en azul, negrita, mayúsculas
+            cuerpo.parrafo('etiqueta', nombre.upper())
+            cuerpo.parrafo('valor', f"C.C. {cedula} de {exp}")
+            
+            # Todos los párrafos se parsean e insertan en el body de una sola vez
+            cuerpo.volcar(doc)
+            
+            # Guardar en memoria
+            output = io.BytesIO()
+            doc.save(output)
+            return output.getvalue()
+        
+        # Mismos datos => mismo documento (la fecha solo va en el nombre del archivo)
+        tiempos = {}
+        with medir_paso(tiempos, 'docx'):
+            contenido = render_cacheado('hv', None, {
+                'nombre': nombre, 'cedula': cedula, 'fecha': fecha, 'telefono': telefono,
+                'direccion': direccion, 'ciudad': ciudad, 'estado_civil': estado_civil, 'correo': correo,
+                'exp': exp, 'perfil': texto_perfil, 'high_school': high_school, 'institution': institution,
+                'referencias_familiares': referencias_familiares, 'referencias_personales': referencias_personales,
+                'experiencias': experiencias, 'formaciones': formaciones,
+            }, renderizar)
         
         # Nombre del archivo
         nombre_archivo = nombre.replace(' ', '_') if nombre else 'Hoja_de_Vida'
         filename = f"HV_{nombre_archivo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
         
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            as_attachment=True,
-            download_name=filename
-        )
+        return respuesta_documento(contenido, filename, tiempos, formato)
         
     except Exception as e:
         import traceback
         return jsonify({"error": str(e), "traceback": traceback.format_exc()}), 500
 
-def reemplazar_texto_en_documento(doc, reemplazos):
-    """
-    Reemplaza texto en un documento Word manteniendo el formato.
-    Busca en párrafos y tablas. Busca placeholders de forma case-insensitive.
-    Mejora: Busca en todos los runs de texto para encontrar variables divididas.
-    """
-    import re
+def _reemplazar_en_parrafo(paragraph, reemplazos_dict):
+    """Reemplaza texto en un párrafo manteniendo formato, especialmente negrilla"""
+    # Obtener todo el texto del párrafo
+    texto_original = paragraph.text
+    if not texto_original:
+        return
     
-    def reemplazar_en_parrafo(paragraph, reemplazos_dict):
-        """Reemplaza texto en un párrafo manteniendo formato, especialmente negrilla"""
-        # Obtener todo el texto del párrafo
-        texto_original = paragraph.text
-        if not texto_original:
-            return
+    # Trabajar directamente con los runs para conservar formato individual
+    if not paragraph.runs:
+        return
+    
+    # Buscar y reemplazar en cada run, conservando formato
+    sorted_reemplazos = sorted(reemplazos_dict.items(), key=lambda x: len(x[0]), reverse=True)
+    
+    for placeholder, valor in sorted_reemplazos:
+        if not placeholder:
+            continue
         
-        # Trabajar directamente con los runs para conservar formato individual
-        if not paragraph.runs:
-            return
+        # Si el placeholder tiene formato {{VARIABLE}}, buscar solo en mayúsculas y case-sensitive
+        if placeholder.startswith('{{') and placeholder.endswith('}}'):
+            pattern = re.escape(placeholder)
+            case_sensitive = True
+        # Para dia1 y dia2, buscar sin word boundaries para capturar variaciones
+        elif 'dia' in placeholder.lower() and len(placeholder) <= 5:
+            pattern = re.escape(placeholder)
+            case_sensitive = False
+        elif placeholder.upper() in ['4 TURNOS', 'ADICIONALES', 'SUELDO FIJO MENSUAL', 'SUELDO PROPORCIONAL', 
+                                     'BONO SEGURIDAD', 'AUXILIO DE TRANSPORTE', 'TURNOS', 'DESCANSOS']:
+            continue
+        elif 'SUELDO FIJO' in placeholder.upper() or 'SUELDO PROPORCIONAL' in placeholder.upper():
+            continue
+        elif 'BONO SEGURIDAD' in placeholder.upper() or 'AUXILIO' in placeholder.upper():
+            continue
+        else:
+            pattern = re.escape(placeholder)
+            case_sensitive = False
         
-        # Buscar y reemplazar en cada run, conservando formato
-        sorted_reemplazos = sorted(reemplazos_dict.items(), key=lambda x: len(x[0]), reverse=True)
+        # Buscar el placeholder en todos los runs
+        texto_completo = ''.join([run.text for run in paragraph.runs])
+        flags = 0 if case_sensitive else re.IGNORECASE
+        matches = list(re.finditer(pattern, texto_completo, flags))
         
-        for placeholder, valor in sorted_reemplazos:
-            if not placeholder:
-                continue
-            
-            # Si el placeholder tiene formato {{VARIABLE}}, buscar solo en mayúsculas y case-sensitive
-            if placeholder.startswith('{{') and placeholder.endswith('}}'):
-                pattern = re.escape(placeholder)
-                case_sensitive = True
-            # Para dia1 y dia2, buscar sin word boundaries para capturar variaciones
-            elif 'dia' in placeholder.lower() and len(placeholder) <= 5:
-                pattern = re.escape(placeholder)
-                case_sensitive = False
-            elif placeholder.upper() in ['4 TURNOS', 'ADICIONALES', 'SUELDO FIJO MENSUAL', 'SUELDO PROPORCIONAL', 
-                                         'BONO SEGURIDAD', 'AUXILIO DE TRANSPORTE', 'TURNOS', 'DESCANSOS']:
-                continue
-            elif 'SUELDO FIJO' in placeholder.upper() or 'SUELDO PROPORCIONAL' in placeholder.upper():
-                continue
-            elif 'BONO SEGURIDAD' in placeholder.upper() or 'AUXILIO' in placeholder.upper():
-                continue
-            else:
-                pattern = re.escape(placeholder)
-                case_sensitive = False
-            
-            # Buscar el placeholder en todos los runs
-            texto_completo = ''.join([run.text for run in paragraph.runs])
-            flags = 0 if case_sensitive else re.IGNORECASE
-            matches = list(re.finditer(pattern, texto_completo, flags))
-            
-            if matches:
-                # Reemplazar desde el final hacia el inicio para mantener índices
-                for match in reversed(matches):
-                    start, end = match.span()
-                    valor_reemplazo = str(valor)
+        if matches:
+            # Reemplazar desde el final hacia el inicio para mantener índices
+            for match in reversed(matches):
+                start, end = match.span()
+                valor_reemplazo = str(valor)
+                
+                # Para dia1 y dia2, verificar si necesita espacios alrededor
+                if 'dia' in placeholder.lower() and len(placeholder) <= 5:
+                    tiene_espacio_antes = start > 0 and texto_completo[start-1].isspace()
+                    tiene_espacio_despues = end < len(texto_completo) and texto_completo[end].isspace()
                     
-                    # Para dia1 y dia2, verificar si necesita espacios alrededor
-                    if 'dia' in placeholder.lower() and len(placeholder) <= 5:
-                        tiene_espacio_antes = start > 0 and texto_completo[start-1].isspace()
-                        tiene_espacio_despues = end < len(texto_completo) and texto_completo[end].isspace()
-                        
-                        if valor_reemplazo.startswith(' ') and tiene_espacio_antes:
-                            valor_reemplazo = valor_reemplazo.lstrip()
-                        if valor_reemplazo.endswith(' ') and tiene_espacio_despues:
-                            valor_reemplazo = valor_reemplazo.rstrip()
-                        
-                        if not tiene_espacio_antes and not valor_reemplazo.startswith(' '):
-                            if start > 0 and texto_completo[start-1].isalnum():
-                                valor_reemplazo = ' ' + valor_reemplazo
-                        if not tiene_espacio_despues and not valor_reemplazo.endswith(' '):
-                            if end < len(texto_completo) and texto_completo[end].isalnum():
-                                valor_reemplazo = valor_reemplazo + ' '
+                    if valor_reemplazo.startswith(' ') and tiene_espacio_antes:
+                        valor_reemplazo = valor_reemplazo.lstrip()
+                    if valor_reemplazo.endswith(' ') and tiene_espacio_despues:
+                        valor_reemplazo = valor_reemplazo.rstrip()
                     
-                    # Encontrar en qué run(s) está el placeholder y conservar formato (especialmente negrilla)
-                    current_pos = 0
-                    formato_aplicar = None
-                    placeholder_encontrado = False
+                    if not tiene_espacio_antes and not valor_reemplazo.startswith(' '):
+                        if start > 0 and texto_completo[start-1].isalnum():
+                            valor_reemplazo = ' ' + valor_reemplazo
+                    if not tiene_espacio_despues and not valor_reemplazo.endswith(' '):
+                        if end < len(texto_completo) and texto_completo[end].isalnum():
+                            valor_reemplazo = valor_reemplazo + ' '
+                
+                # Encontrar en qué run(s) está el placeholder y conservar formato (especialmente negrilla)
+                current_pos = 0
+                formato_aplicar = None
+                placeholder_encontrado = False
+                
+                for run in paragraph.runs:
+                    run_start = current_pos
+                    run_end = current_pos + len(run.text)
                     
-                    for run in paragraph.runs:
-                        run_start = current_pos
-                        run_end = current_pos + len(run.text)
+                    # Si el placeholder está completamente en este run
+                    if run_start <= start < run_end and run_start <= end <= run_end:
+                        # Conservar formato del run (incluyendo negrilla)
+                        formato_aplicar = {
+                            'font_name': run.font.name if run.font.name else None,
+                            'font_size': run.font.size if run.font.size else None,
+                            'bold': run.bold if run.bold is not None else False,
+                            'italic': run.italic if run.italic is not None else False,
+                            'color': run.font.color.rgb if run.font.color and run.font.color.rgb else None
+                        }
                         
-                        # Si el placeholder está completamente en este run
-                        if run_start <= start < run_end and run_start <= end <= run_end:
-                            # Conservar formato del run (incluyendo negrilla)
-                            formato_aplicar = {
-                                'font_name': run.font.name if run.font.name else None,
-                                'font_size': run.font.size if run.font.size else None,
-                                'bold': run.bold if run.bold is not None else False,
-                                'italic': run.italic if run.italic is not None else False,
-                                'color': run.font.color.rgb if run.font.color and run.font.color.rgb else None
-                            }
-                            
-                            # Reemplazar en el run - el formato se conserva automáticamente
-                            run_start_in_run = start - run_start
-                            run_end_in_run = end - run_start
-                            nuevo_texto = run.text[:run_start_in_run] + valor_reemplazo + run.text[run_end_in_run:]
-                            run.text = nuevo_texto
-                            placeholder_encontrado = True
-                            break
+                        # Reemplazar en el run - el formato se conserva automáticamente
+                        run_start_in_run = start - run_start
+                        run_end_in_run = end - run_start
+                        nuevo_texto = run.text[:run_start_in_run] + valor_reemplazo + run.text[run_end_in_run:]
+                        run.text = nuevo_texto
+                        placeholder_encontrado = True
+                        break
+                    
+                    # Si el placeholder comienza en este run (puede estar dividido)
+                    elif run_start <= start < run_end and formato_aplicar is None:
+                        # Usar el formato del run donde comienza el placeholder (conservar negrilla)
+                        formato_aplicar = {
+                            'font_name': run.font.name if run.font.name else None,
+                            'font_size': run.font.size if run.font.size else None,
+                            'bold': run.bold if run.bold is not None else False,
+                            'italic': run.italic if run.italic is not None else False,
+                            'color': run.font.color.rgb if run.font.color and run.font.color.rgb else None
+                        }
+                    
+                    current_pos = run_end
+                
+                # Si el placeholder estaba dividido entre múltiples runs, reconstruir conservando formato
+                if not placeholder_encontrado and formato_aplicar:
+                    # Reconstruir texto completo
+                    texto_completo_nuevo = ''.join([run.text for run in paragraph.runs])
+                    if placeholder in texto_completo_nuevo:
+                        # Reemplazar en el texto completo
+                        texto_completo_nuevo = texto_completo_nuevo.replace(placeholder, valor_reemplazo, 1)
                         
-                        # Si el placeholder comienza en este run (puede estar dividido)
-                        elif run_start <= start < run_end and formato_aplicar is None:
-                            # Usar el formato del run donde comienza el placeholder (conservar negrilla)
-                            formato_aplicar = {
-                                'font_name': run.font.name if run.font.name else None,
-                                'font_size': run.font.size if run.font.size else None,
-                                'bold': run.bold if run.bold is not None else False,
-                                'italic': run.italic if run.italic is not None else False,
-                                'color': run.font.color.rgb if run.font.color and run.font.color.rgb else None
-                            }
+                        # Limpiar y reconstruir con el formato del run donde estaba el placeholder
+                        paragraph.clear()
+                        nuevo_run = paragraph.add_run(texto_completo_nuevo)
                         
-                        current_pos = run_end
+                        # Aplicar formato conservado (incluyendo negrilla)
+                        if formato_aplicar:
+                            if formato_aplicar['font_name']:
+                                nuevo_run.font.name = formato_aplicar['font_name']
+                            if formato_aplicar['font_size']:
+                                nuevo_run.font.size = formato_aplicar['font_size']
+                            if formato_aplicar['color']:
+                                nuevo_run.font.color.rgb = formato_aplicar['color']
+                            nuevo_run.bold = formato_aplicar['bold']
+                            nuevo_run.italic = formato_aplicar['italic']
+
+def _reemplazar_en_runs(runs, reemplazos_dict):
+    """Reemplaza texto en runs individuales conservando formato, especialmente negrilla"""
+    texto_completo = ''.join([run.text for run in runs])
+    if not texto_completo:
+        return False
+    
+    texto_nuevo = texto_completo
+    cambios_realizados = False
+    formato_aplicar = None
+    
+    # Ordenar por longitud descendente
+    sorted_reemplazos = sorted(reemplazos_dict.items(), key=lambda x: len(x[0]), reverse=True)
+    
+    for placeholder, valor in sorted_reemplazos:
+        if not placeholder:
+            continue
+        
+        # Si el placeholder tiene formato {{VARIABLE}}, buscar solo en mayúsculas y case-sensitive
+        if placeholder.startswith('{{') and placeholder.endswith('}}'):
+            pattern = re.escape(placeholder)
+            matches = list(re.finditer(pattern, texto_nuevo))  # Case-sensitive
+        else:
+            pattern = re.escape(placeholder)
+            matches = list(re.finditer(pattern, texto_nuevo, re.IGNORECASE))
+        
+        if matches:
+            cambios_realizados = True
+            # Encontrar el formato del run donde está el placeholder (conservar negrilla)
+            for match in reversed(matches):
+                start, end = match.span()
+                
+                # Encontrar en qué run está el placeholder para conservar su formato
+                current_pos = 0
+                for run in runs:
+                    run_start = current_pos
+                    run_end = current_pos + len(run.text)
                     
-                    # Si el placeholder estaba dividido entre múltiples runs, reconstruir conservando formato
-                    if not placeholder_encontrado and formato_aplicar:
-                        # Reconstruir texto completo
-                        texto_completo_nuevo = ''.join([run.text for run in paragraph.runs])
-                        if placeholder in texto_completo_nuevo:
-                            # Reemplazar en el texto completo
-                            texto_completo_nuevo = texto_completo_nuevo.replace(placeholder, valor_reemplazo, 1)
-                            
-                            # Limpiar y reconstruir con el formato del run donde estaba el placeholder
-                            paragraph.clear()
-                            nuevo_run = paragraph.add_run(texto_completo_nuevo)
-                            
-                            # Aplicar formato conservado (incluyendo negrilla)
-                            if formato_aplicar:
-                                if formato_aplicar['font_name']:
-                                    nuevo_run.font.name = formato_aplicar['font_name']
-                                if formato_aplicar['font_size']:
-                                    nuevo_run.font.size = formato_aplicar['font_size']
-                                if formato_aplicar['color']:
-                                    nuevo_run.font.color.rgb = formato_aplicar['color']
-                                nuevo_run.bold = formato_aplicar['bold']
-                                nuevo_run.italic = formato_aplicar['italic']
-    
-    def reemplazar_en_runs(runs, reemplazos_dict):
-        """Reemplaza texto en runs individuales conservando formato, especialmente negrilla"""
-        texto_completo = ''.join([run.text for run in runs])
-        if not texto_completo:
-            return False
-        
-        texto_nuevo = texto_completo
-        cambios_realizados = False
-        formato_aplicar = None
-        
-        # Ordenar por longitud descendente
-        sorted_reemplazos = sorted(reemplazos_dict.items(), key=lambda x: len(x[0]), reverse=True)
-        
-        for placeholder, valor in sorted_reemplazos:
-            if not placeholder:
+                    if run_start <= start < run_end and formato_aplicar is None:
+                        # Conservar formato del run donde está el placeholder (incluyendo negrilla)
+                        formato_aplicar = {
+                            'font_name': run.font.name if run.font.name else None,
+                            'font_size': run.font.size if run.font.size else None,
+                            'bold': run.bold if run.bold is not None else False,
+                            'italic': run.italic if run.italic is not None else False,
+                            'color': run.font.color.rgb if run.font.color and run.font.color.rgb else None
+                        }
+                        break
+                    
+                    current_pos = run_end
+                
+                texto_nuevo = texto_nuevo[:start] + str(valor) + texto_nuevo[end:]
+    
+    if cambios_realizados and texto_nuevo != texto_completo:
+        # Limpiar todos los runs y crear uno nuevo con el texto reemplazado
+        for run in runs:
+            run.text = ''
+        if runs:
+            runs[0].text = texto_nuevo
+            # Aplicar formato conservado (incluyendo negrilla)
+            if formato_aplicar:
+                if formato_aplicar['font_name']:
+                    runs[0].font.name = formato_aplicar['font_name']
+                if formato_aplicar['font_size']:
+                    runs[0].font.size = formato_aplicar['font_size']
+                if formato_aplicar['color']:
+                    runs[0].font.color.rgb = formato_aplicar['color']
+                runs[0].bold = formato_aplicar['bold']
+                runs[0].italic = formato_aplicar['italic']
+        return True
+    
+    return False
+
+def _reemplazar_parrafo_legacy(paragraph, reemplazos):
+    """Aplica el reemplazo por párrafo y luego por runs (por si la variable está dividida)."""
+    _reemplazar_en_parrafo(paragraph, reemplazos)
+    if paragraph.runs and len(paragraph.runs) > 1:
+        _reemplazar_en_runs(paragraph.runs, reemplazos)
+
+# --- Motor de reemplazo de una sola pasada ---
+# 'unico': todas las claves compiladas en una sola regex, una pasada por párrafo.
+# 'legacy': _reemplazar_en_parrafo + _reemplazar_en_runs (una pasada por clave). Útil para comparar.
+MOTOR_REEMPLAZO = os.getenv('MOTOR_REEMPLAZO', 'unico').strip().lower()
+
+# Textos de la tabla de cobro que el reemplazo por párrafo nunca toca (igual que _reemplazar_en_parrafo)
+_CLAVES_TABLA_OMITIDAS = ['4 TURNOS', 'ADICIONALES', 'SUELDO FIJO MENSUAL', 'SUELDO PROPORCIONAL',
+                          'BONO SEGURIDAD', 'AUXILIO DE TRANSPORTE', 'TURNOS', 'DESCANSOS']
+
+def _es_placeholder(clave):
+    return clave.startswith('{{') and clave.endswith('}}')
+
+def _es_clave_dia(clave):
+    """dia1/dia2 sin llaves: se ajustan los espacios alrededor del valor."""
+    return 'dia' in clave.lower() and len(clave) <= 5
+
+def compilar_reemplazos(reemplazos):
+    """
+    Compila todas las claves en una sola expresión regular (las más largas primero).
+    Las {{...}} son case-sensitive; el resto se busca sin distinguir mayúsculas.
+    """
+    claves = []
+    for clave in reemplazos:
+        if not clave:
+            continue
+        if not _es_placeholder(clave):
+            upper = clave.upper()
+            if upper in _CLAVES_TABLA_OMITIDAS or 'SUELDO FIJO' in upper or 'SUELDO PROPORCIONAL' in upper \
+                    or 'BONO SEGURIDAD' in upper or 'AUXILIO' in upper:
+                continue
+        claves.append(clave)
+    claves.sort(key=len, reverse=True)
+    patrones = [re.escape(c) if _es_placeholder(c) else f'(?i:{re.escape(c)})' for c in claves]
+    return {
+        'patron': re.compile('|'.join(patrones)) if patrones else None,
+        'exactas': {c: str(reemplazos[c]) for c in claves if _es_placeholder(c)},
+        'sin_mayusculas': {c.lower(): (c, str(reemplazos[c])) for c in reversed(claves) if not _es_placeholder(c)},
+    }
+
+def _valor_para_match(compilado, texto, inicio, fin):
+    """Valor de reemplazo para el texto encontrado, con la regla de espacios de dia1/dia2."""
+    encontrado = texto[inicio:fin]
+    if encontrado in compilado['exactas']:
+        return compilado['exactas'][encontrado]
+    clave, valor = compilado['sin_mayusculas'][encontrado.lower()]
+    if _es_clave_dia(clave):
+        tiene_espacio_antes = inicio > 0 and texto[inicio - 1].isspace()
+        tiene_espacio_despues = fin < len(texto) and texto[fin].isspace()
+        if valor.startswith(' ') and tiene_espacio_antes:
+            valor = valor.lstrip()
+        if valor.endswith(' ') and tiene_espacio_despues:
+            valor = valor.rstrip()
+        if not tiene_espacio_antes and not valor.startswith(' ') and inicio > 0 and texto[inicio - 1].isalnum():
+            valor = ' ' + valor
+        if not tiene_espacio_despues and not valor.endswith(' ') and fin < len(texto) and texto[fin].isalnum():
+            valor = valor + ' '
+    return valor
+
+def _fijar_texto_wt(t, texto):
+    """
+    Pone `texto` en el w:t. Si trae tabulaciones o saltos de línea, el w:t se reemplaza por
+    w:t / w:tab / w:br hermanos dentro del mismo run (como run.text de python-docx).
+    """
+    if not _CONTROL_TEXTO_RE.search(texto):
+        t.text = texto
+        if texto != texto.strip():
+            t.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+        return
+    from docx.oxml import OxmlElement
+    anterior = t
+    for trozo in _CONTROL_TEXTO_RE.split(texto):
+        if not trozo:
+            continue
+        if trozo == '\t':
+            nuevo = OxmlElement('w:tab')
+        elif trozo in ('\n', '\r'):
+            nuevo = OxmlElement('w:br')
+        else:
+            nuevo = OxmlElement('w:t')
+            nuevo.text = trozo
+            if trozo != trozo.strip():
+                nuevo.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+        anterior.addnext(nuevo)
+        anterior = nuevo
+    t.getparent().remove(t)
+
+def reemplazar_parrafo_unico(p, compilado):
+    """
+    Reemplaza todas las claves de un párrafo (elemento w:p) en una sola pasada.
+    El valor queda en el run donde empieza el placeholder, con su formato (negrilla, cursiva,
+    color); si el placeholder estaba dividido, los runs siguientes solo pierden esos caracteres.
+    """
+    patron = compilado['patron']
+    if patron is None:
+        return False
+    nodos = [t for r in p.findall(qn('w:r')) for t in r.findall(qn('w:t'))]
+    if not nodos:
+        return False
+    textos = [t.text or '' for t in nodos]
+    texto = ''.join(textos)
+    matches = list(patron.finditer(texto))
+    if not matches:
+        return False
+    # Inicio de cada w:t dentro del texto del párrafo
+    inicios = []
+    pos = 0
+    for t in textos:
+        inicios.append(pos)
+        pos += len(t)
+    nuevos = list(textos)
+    # De derecha a izquierda para que los índices sigan siendo válidos
+    for match in reversed(matches):
+        inicio, fin = match.span()
+        valor = _valor_para_match(compilado, texto, inicio, fin)
+        primero = next(i for i, a in enumerate(inicios) if a <= inicio < a + len(textos[i]))
+        for i in range(len(textos) - 1, primero - 1, -1):
+            a = inicios[i]
+            b = a + len(textos[i])
+            if b <= inicio or a >= fin:
+                continue
+            desde = max(inicio, a) - a
+            hasta = min(fin, b) - a
+            nuevos[i] = nuevos[i][:desde] + (valor if i == primero else '') + nuevos[i][hasta:]
+    for t, original, nuevo in zip(nodos, textos, nuevos):
+        if nuevo != original:
+            r = t.getparent()
+            _fijar_texto_wt(t, nuevo)
+            # Quitar runs que quedaron vacíos (restos de un placeholder dividido)
+            if not nuevo and all(c.tag == qn('w:t') and not c.text for c in r if c.tag != qn('w:rPr')):
+                r.getparent().remove(r)
+    return True
+
+def _reemplazar_parrafo(part, p, reemplazos, compilado, motor):
+    """Reemplaza en un w:p; el proxy Paragraph de python-docx solo se crea para el motor legacy."""
+    if motor == 'legacy':
+        from docx.text.paragraph import Paragraph
+        _reemplazar_parrafo_legacy(Paragraph(p, _ParteStory(part)), reemplazos)
+    else:
+        reemplazar_parrafo_unico(p, compilado)
+
+def reemplazar_texto_en_documento(doc, reemplazos, indice=None, motor=None):
+    """
+    Reemplaza texto en un documento Word manteniendo el formato.
+    Busca en todos los párrafos (ver iterar_parrafos). Busca placeholders de forma case-insensitive.
+    Mejora: Busca en todos los runs de texto para encontrar variables divididas.
+    Si se pasa el índice de placeholders del template (ver construir_indice_placeholders),
+    solo se visitan los párrafos donde hay {{...}}.
+    motor: 'unico' (una pasada por párrafo) o 'legacy'; por defecto MOTOR_REEMPLAZO.
+    """
+    motor = (motor or MOTOR_REEMPLAZO)
+    compilado = compilar_reemplazos(reemplazos) if motor != 'legacy' else None
+    if indice is not None:
+        reemplazar_con_indice(doc, indice, reemplazos, motor=motor, compilado=compilado)
+        return
+    
+    # Un solo recorrido: cuerpo, tablas (también anidadas), cuadros de texto, headers y footers
+    for part, p in iterar_parrafos(doc):
+        _reemplazar_parrafo(part, p, reemplazos, compilado, motor)
+
+# --- Índice de placeholders: qué párrafos y runs contienen cada {{...}} ---
+PLACEHOLDER_RE = re.compile(r'\{\{[^{}]+\}\}')
+
+class _ParteStory:
+    """Padre mínimo para crear Paragraph sobre un w:p suelto (solo expone .part)."""
+    def __init__(self, part):
+        self.part = part
+
+def _partes_story(doc):
+    """Partes del documento que pueden tener texto: cuerpo, headers y footers (cada una una sola vez)."""
+    partes = [doc.part]
+    for rel in doc.part.rels.values():
+        if rel.is_external:
+            continue
+        if (rel.reltype.endswith('/header') or rel.reltype.endswith('/footer')) and rel.target_part not in partes:
+            partes.append(rel.target_part)
+    return partes
+
+_xpath_parrafos = None
+
+def parrafos_xml(raiz):
+    """
+    Todos los w:p bajo `raiz` en orden del documento: tablas anidadas y cuadros de texto incluidos.
+    Se omite mc:Fallback (copia VML de un cuadro de texto que ya se visita en mc:AlternateContent).
+    """
+    global _xpath_parrafos
+    if _xpath_parrafos is None:
+        import lxml.etree as etree
+        _xpath_parrafos = etree.XPath('.//w:p[not(ancestor::mc:Fallback)]', namespaces={
+            'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
+            'mc': 'http://schemas.openxmlformats.org/markup-compatibility/2006',
+        })
+    return _xpath_parrafos(raiz)
+
+def iterar_parrafos(doc):
+    """
+    (parte, w:p) de cada párrafo del documento exactamente una vez, en un solo recorrido del XML
+    de cada parte (cuerpo, headers y footers), sin armar listas de proxies de python-docx.
+    """
+    for part in _partes_story(doc):
+        for p in parrafos_xml(part.element):
+            yield part, p
+
+def _ruta_elemento(raiz, elemento):
+    """Índices de hijos desde la raíz de la parte hasta el elemento (sobrevive a copy.deepcopy)."""
+    ruta = []
+    actual = elemento
+    while actual is not raiz:
+        padre = actual.getparent()
+        ruta.append(padre.index(actual))
+        actual = padre
+    return tuple(reversed(ruta))
+
+def _resolver_ruta(raiz, ruta):
+    elemento = raiz
+    for i in ruta:
+        elemento = elemento[i]
+    return elemento
+
+def construir_indice_placeholders(doc):
+    """
+    Recorre el template una sola vez y registra en qué párrafos (y en qué runs) aparece cada
+    placeholder {{...}}. El índice se guarda junto al template y sirve para cualquier copia.
+    """
+    ubicaciones = []
+    por_placeholder = {}
+    for part, p in iterar_parrafos(doc):
+        raiz = part.element
+        runs = p.findall(qn('w:r'))
+        textos = [''.join(t.text or '' for t in r.iter(qn('w:t'))) for r in runs]
+        texto = ''.join(textos)
+        if '{{' not in texto:
+            continue
+        # Límites de cada run dentro del texto del párrafo
+        limites = []
+        pos = 0
+        for t in textos:
+            limites.append((pos, pos + len(t)))
+            pos += len(t)
+        runs_por_placeholder = {}
+        for match in PLACEHOLDER_RE.finditer(texto):
+            inicio, fin = match.span()
+            indices = [i for i, (a, b) in enumerate(limites) if a < fin and b > inicio]
+            runs_por_placeholder.setdefault(match.group(0), []).extend(indices)
+        if not runs_por_placeholder:
+            continue
+        ubicacion = {
+            'parte': str(part.partname),
+            'ruta': _ruta_elemento(raiz, p),
+            'placeholders': list(runs_por_placeholder),
+            'runs': runs_por_placeholder,
+        }
+        for placeholder in runs_por_placeholder:
+            por_placeholder.setdefault(placeholder, []).append(len(ubicaciones))
+        ubicaciones.append(ubicacion)
+    return {'ubicaciones': ubicaciones, 'placeholders': por_placeholder}
+
+def parrafos_indexados(doc, indice, reemplazos):
+    """
+    (parte, w:p, ubicación) de los párrafos del índice que tienen algún placeholder presente en
+    `reemplazos`, en el orden del documento.
+    """
+    partes = {str(part.partname): part for part in _partes_story(doc)}
+    visitadas = set()
+    for placeholder in reemplazos:
+        for i in indice['placeholders'].get(placeholder, ()):
+            visitadas.add(i)
+    resultado = []
+    for i in sorted(visitadas):
+        ubicacion = indice['ubicaciones'][i]
+        part = partes.get(ubicacion['parte'])
+        if part is None:
+            continue
+        resultado.append((part, _resolver_ruta(part.element, ubicacion['ruta']), ubicacion))
+    return resultado
+
+def _reemplazos_locales(reemplazos, ubicacion):
+    """Para el motor legacy: solo los placeholders del párrafo más las claves sin llaves."""
+    locales = {k: reemplazos[k] for k in ubicacion['placeholders'] if k in reemplazos}
+    locales.update({k: v for k, v in reemplazos.items() if not _es_placeholder(k)})
+    return locales
+
+def reemplazar_con_indice(doc, indice, reemplazos, motor=None, compilado=None):
+    """
+    Reemplaza usando el índice del template: solo se visitan los párrafos que tienen placeholders
+    presentes en `reemplazos`. Las claves sin llaves (limpieza de duplicados) se aplican en esos
+    mismos párrafos, que es donde pueden aparecer tras sustituir valores.
+    """
+    motor = (motor or MOTOR_REEMPLAZO)
+    if motor != 'legacy':
+        compilado = compilado or compilar_reemplazos(reemplazos)
+    for part, p, ubicacion in parrafos_indexados(doc, indice, reemplazos):
+        locales = reemplazos if motor != 'legacy' else _reemplazos_locales(reemplazos, ubicacion)
+        _reemplazar_parrafo(part, p, locales, compilado, motor)
+
+# --- Limpieza de duplicaciones tras el reemplazo (texto plano de un párrafo) ---
+def _regla(patron, reemplazo, flags=0, repetir=1, requiere=None):
+    """
+    Regla de limpieza declarativa. repetir: veces que se aplica (se corta en cuanto no cambia nada);
+    requiere: texto literal sin el cual la regla no puede aplicar (evita correr la regex).
+    """
+    return {'patron': patron, 'reemplazo': reemplazo, 'flags': flags, 'repetir': repetir, 'requiere': requiere}
+
+def compilar_reglas(reglas):
+    """Compila una lista de reglas (ver _regla) una sola vez, al importar el módulo."""
+    return [(re.compile(r['patron'], r['flags']), r['reemplazo'], r['repetir'], r['requiere']) for r in reglas]
+
+def aplicar_reglas(compiladas, texto):
+    """Aplica las reglas en orden sobre el texto plano de un párrafo."""
+    for patron, reemplazo, repetir, requiere in compiladas:
+        if requiere is not None and requiere not in texto:
+            continue
+        for _ in range(repetir):
+            nuevo = patron.sub(reemplazo, texto)
+            if nuevo == texto:
+                break
+            texto = nuevo
+    return texto
+
+# Duplicaciones de año: DE 2026 DE 2026 / DEL 2026 DEL 2026 / DE 2026 DEL 2026 / DEL 2026 DE 2026,
+# y otra vez las mixtas para casos anidados
+_REGLAS_AÑO = [
+    _regla(r'DE (\d{4}) DE \1', r'DE \1', requiere='DE '),
+    _regla(r'DEL (\d{4}) DEL \1', r'DEL \1', requiere='DEL '),
+    _regla(r'DE (\d{4}) DEL \1', r'DE \1', requiere='DEL '),
+    _regla(r'DEL (\d{4}) DE \1', r'DEL \1', requiere='DEL '),
+    _regla(r'DE (\d{4}) DEL \1', r'DE \1', requiere='DEL '),
+    _regla(r'DEL (\d{4}) DE \1', r'DEL \1', requiere='DEL '),
+]
+_REGLA_ESPACIOS = _regla(r'  +', ' ', requiere='  ')
+
+# Cuenta de cobro: años repetidos, símbolos $ repetidos y espacios múltiples
+REGLAS_COBRO = compilar_reglas(_REGLAS_AÑO + [
+    _regla(r'\$\$+', '$', requiere='$$'),
+    _regla(r'\$ \$+', '$', requiere='$ $'),
+    _REGLA_ESPACIOS,
+])
+
+# Contrato: 'CONVENCIÓN de CONVENCIÓN', 'TEXTO de TEXTO' (hasta 3 veces para casos anidados),
+# años repetidos y espacios múltiples
+REGLAS_CONTRATO = compilar_reglas([
+    _regla(r'\b(CONVENCIÓN)\s+de\s+\1\b', r'\1', re.IGNORECASE),
+    _regla(r'\b(NORTE DE SANTANDER)\s+de\s+\1\b', r'\1', re.IGNORECASE),
+    _regla(r'\b([A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑ\s]{2,}?)\s+de\s+\1\b', r'\1', re.IGNORECASE, repetir=3),
+] + _REGLAS_AÑO + [_REGLA_ESPACIOS])
+
+def limpiar_texto_cobro(texto):
+    """Quita duplicaciones de año, símbolos $ repetidos y espacios múltiples (cuenta de cobro)."""
+    return aplicar_reglas(REGLAS_COBRO, texto)
+
+def limpiar_texto_contrato(texto):
+    """Quita duplicaciones tipo 'CONVENCIÓN de CONVENCIÓN', años repetidos y espacios múltiples (contrato)."""
+    return aplicar_reglas(REGLAS_CONTRATO, texto)
+
+# Limpieza de cada template: (función, conservar formato del primer run al reconstruir el párrafo)
+LIMPIEZA_TEMPLATES = {
+    'cobro_12h': (limpiar_texto_cobro, True),
+    'cobro_8h': (limpiar_texto_cobro, True),
+    'contrato': (limpiar_texto_contrato, False),
+}
+
+# --- Render directo sobre el XML del .docx (sin el modelo de objetos de python-docx) ---
+# 'xml': contrato y cobro (cuando no hay que tocar filas de la tabla) se generan a nivel zip.
+# 'docx': siempre con python-docx.
+MODO_RENDER = os.getenv('MODO_RENDER', 'xml').strip().lower()
+
+# Partes del zip que pueden tener placeholders
+_PARTES_XML_RE = re.compile(r'^word/(document|header\d*|footer\d*)\.xml$')
+_XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+_MARCA_TEXTO = '\ue000'  # carácter de uso privado, no aparece en los templates
+
+def _nodos_texto(p):
+    """w:t de los runs directos del párrafo, en orden, con su run."""
+    return [(r, t) for r in p.findall(qn('w:r')) for t in r.findall(qn('w:t'))]
+
+def texto_parrafo_xml(p):
+    return ''.join(t.text or '' for _, t in _nodos_texto(p))
+
+_ENTRE_RUNS_PERMITIDOS = (qn('w:proofErr'), qn('w:bookmarkStart'), qn('w:bookmarkEnd'))
+
+def _run_solo_texto(r):
+    return all(c.tag in (qn('w:rPr'), qn('w:t')) for c in r)
+
+def fusionar_placeholders_divididos(p):
+    """
+    Cuando Word parte un {{placeholder}} en varios runs hermanos, deja el placeholder completo en
+    el primero (con su formato) y quita los restos. Devuelve los placeholders que no se pudieron
+    unir (p. ej. cruzan un hipervínculo o un campo).
+    """
+    nodos = _nodos_texto(p)
+    textos = [t.text or '' for _, t in nodos]
+    texto = ''.join(textos)
+    if '{{' not in texto:
+        return []
+    inicios = []
+    pos = 0
+    for t in textos:
+        inicios.append(pos)
+        pos += len(t)
+    no_unidos = []
+    tocados = set()
+    for match in reversed(list(PLACEHOLDER_RE.finditer(texto))):
+        inicio, fin = match.span()
+        idx = [i for i, a in enumerate(inicios) if a < fin and a + len(textos[i]) > inicio]
+        if len(idx) == 1:
+            nodos[idx[0]][1].set(_XML_SPACE, 'preserve')
+            continue
+        runs = []
+        for i in idx:
+            if nodos[i][0] not in runs:
+                runs.append(nodos[i][0])
+        ok = all(_run_solo_texto(r) for r in runs[1:-1])
+        for anterior, siguiente in zip(runs, runs[1:]):
+            hermano = anterior.getnext()
+            while hermano is not None and hermano is not siguiente and hermano.tag in _ENTRE_RUNS_PERMITIDOS:
+                hermano = hermano.getnext()
+            ok = ok and hermano is siguiente
+        if not ok:
+            no_unidos.append(match.group(0))
+            continue
+        primero, ultimo = idx[0], idx[-1]
+        t_primero = nodos[primero][1]
+        t_ultimo = nodos[ultimo][1]
+        t_ultimo.text = (t_ultimo.text or '')[fin - inicios[ultimo]:]
+        for i in idx[1:-1]:
+            nodos[i][1].text = ''
+        t_primero.text = (t_primero.text or '')[:inicio - inicios[primero]] + match.group(0)
+        t_primero.set(_XML_SPACE, 'preserve')
+        if t_ultimo.text != t_ultimo.text.strip():
+            t_ultimo.set(_XML_SPACE, 'preserve')
+        tocados.update(idx[1:])
+    # Quitar los runs que quedaron vacíos
+    for i in tocados:
+        r, t = nodos[i]
+        if not t.text and r.getparent() is not None and all(c.tag == qn('w:t') and not c.text for c in r if c.tag != qn('w:rPr')):
+            r.getparent().remove(r)
+    return list(reversed(no_unidos))
+
+def normalizar_runs_template(doc):
+    """
+    Une, una sola vez al cargar el template, los runs en los que Word partió cada {{placeholder}}
+    (cuerpo, tablas, headers y footers). Así cada petición encuentra el placeholder completo en
+    un solo run. Devuelve [{'parte', 'placeholder'}] con los que no se pudieron unir.
+    """
+    sin_normalizar = []
+    for part, p in iterar_parrafos(doc):
+        for placeholder in fusionar_placeholders_divididos(p):
+            sin_normalizar.append({'parte': str(part.partname), 'placeholder': placeholder})
+    return sin_normalizar
+
+def _plantilla_parrafo_reconstruido(p, conservar_formato):
+    """XML del párrafo con su pPr y un único run (formato del primer run si se pide), partido en la marca de texto."""
+    import lxml.etree as etree
+    copia = copy.deepcopy(p)
+    primer_rpr = None
+    for r in copia.findall(qn('w:r')):
+        primer_rpr = r.find(qn('w:rPr'))
+        break
+    for hijo in list(copia):
+        if hijo.tag != qn('w:pPr'):
+            copia.remove(hijo)
+    run = etree.SubElement(copia, qn('w:r'))
+    if conservar_formato and primer_rpr is not None:
+        run.append(primer_rpr)
+    t = etree.SubElement(run, qn('w:t'))
+    t.set(_XML_SPACE, 'preserve')
+    t.text = _MARCA_TEXTO
+    return etree.tostring(copia, encoding='unicode').split(_MARCA_TEXTO)
+
+# Caracteres que XML 1.0 no admite (controles salvo tab/saltos, surrogates, U+FFFE/U+FFFF).
+# python-docx rechaza estos valores; en el render a nivel zip se descartan para no generar un .docx corrupto
+_XML_INVALIDO_RE = re.compile('[^\t\n\r\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+def _escapar_xml(valor):
+    texto = _XML_INVALIDO_RE.sub('', str(valor))
+    return texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+_CIERRE_WT = {'\t': '</w:t><w:tab/><w:t xml:space="preserve">', '\n': '</w:t><w:br/><w:t xml:space="preserve">',
+              '\r': '</w:t><w:br/><w:t xml:space="preserve">'}
+
+def _escapar_wt(valor):
+    """
+    Como _escapar_xml, para un valor que va dentro de un w:t abierto: cada tabulación o salto de
+    línea cierra el w:t, pone w:tab / w:br y abre otro w:t (igual que _fijar_texto_wt en el flujo docx).
+    """
+    return ''.join(_CIERRE_WT.get(trozo) or _escapar_xml(trozo) for trozo in _CONTROL_TEXTO_RE.split(str(valor)))
+
+_ETIQUETA_RE = re.compile(r'<(/?[\w:]+)')
+
+def _partir_por_placeholders(texto):
+    """'a {{x}} b' -> ['a ', '{{x}}', ' b'] (posiciones impares = placeholders)."""
+    segmentos = []
+    pos = 0
+    for match in PLACEHOLDER_RE.finditer(texto):
+        segmentos.append(texto[pos:match.start()])
+        segmentos.append(match.group(0))
+        pos = match.end()
+    segmentos.append(texto[pos:])
+    return segmentos
+
+def compilar_plantilla_xml(data, limpieza=None):
+    """
+    Precompila un .docx para el render a nivel zip: las partes con placeholders quedan como
+    segmentos de XML y los demás miembros del zip se guardan tal cual.
+    Devuelve None si algún placeholder no se pudo normalizar (se usa python-docx en ese caso).
+    """
+    import zipfile
+    import lxml.etree as etree
+    limpiar, conservar_formato = limpieza or (None, False)
+    miembros = []
+    with zipfile.ZipFile(io.BytesIO(data)) as zin:
+        for info in zin.infolist():
+            contenido = zin.read(info.filename)
+            if not _PARTES_XML_RE.match(info.filename) or (b'{{' not in contenido and info.filename != 'word/document.xml'):
+                miembros.append((info, contenido))
                 continue
-            
-            # Si el placeholder tiene formato {{VARIABLE}}, buscar solo en mayúsculas y case-sensitive
-            if placeholder.startswith('{{') and placeholder.endswith('}}'):
-                pattern = re.escape(placeholder)
-                matches = list(re.finditer(pattern, texto_nuevo))  # Case-sensitive
-            else:
-                pattern = re.escape(placeholder)
-                matches = list(re.finditer(pattern, texto_nuevo, re.IGNORECASE))
-            
-            if matches:
-                cambios_realizados = True
-                # Encontrar el formato del run donde está el placeholder (conservar negrilla)
-                for match in reversed(matches):
-                    start, end = match.span()
-                    
-                    # Encontrar en qué run está el placeholder para conservar su formato
-                    current_pos = 0
-                    for run in runs:
-                        run_start = current_pos
-                        run_end = current_pos + len(run.text)
-                        
-                        if run_start <= start < run_end and formato_aplicar is None:
-                            # Conservar formato del run donde está el placeholder (incluyendo negrilla)
-                            formato_aplicar = {
-                                'font_name': run.font.name if run.font.name else None,
-                                'font_size': run.font.size if run.font.size else None,
-                                'bold': run.bold if run.bold is not None else False,
-                                'italic': run.italic if run.italic is not None else False,
-                                'color': run.font.color.rgb if run.font.color and run.font.color.rgb else None
-                            }
-                            break
-                        
-                        current_pos = run_end
-                    
-                    texto_nuevo = texto_nuevo[:start] + str(valor) + texto_nuevo[end:]
-        
-        if cambios_realizados and texto_nuevo != texto_completo:
-            # Limpiar todos los runs y crear uno nuevo con el texto reemplazado
-            for run in runs:
-                run.text = ''
-            if runs:
-                runs[0].text = texto_nuevo
-                # Aplicar formato conservado (incluyendo negrilla)
-                if formato_aplicar:
-                    if formato_aplicar['font_name']:
-                        runs[0].font.name = formato_aplicar['font_name']
-                    if formato_aplicar['font_size']:
-                        runs[0].font.size = formato_aplicar['font_size']
-                    if formato_aplicar['color']:
-                        runs[0].font.color.rgb = formato_aplicar['color']
-                    runs[0].bold = formato_aplicar['bold']
-                    runs[0].italic = formato_aplicar['italic']
-            return True
-        
-        return False
-    
-    # Reemplazar en párrafos
-    for paragraph in doc.paragraphs:
-        # Primero intentar reemplazo en el párrafo completo
-        reemplazar_en_parrafo(paragraph, reemplazos)
-        
-        # También intentar reemplazo en runs individuales (por si la variable está dividida)
-        if paragraph.runs and len(paragraph.runs) > 1:
-            reemplazar_en_runs(paragraph.runs, reemplazos)
-    
-    # Reemplazar en tablas
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    reemplazar_en_parrafo(paragraph, reemplazos)
-                    # También en runs individuales
-                    if paragraph.runs and len(paragraph.runs) > 1:
-                        reemplazar_en_runs(paragraph.runs, reemplazos)
-    
-    # Reemplazar en headers y footers de todas las secciones
-    for section in doc.sections:
-        # Header
-        if section.header:
-            for paragraph in section.header.paragraphs:
-                reemplazar_en_parrafo(paragraph, reemplazos)
-                if paragraph.runs and len(paragraph.runs) > 1:
-                    reemplazar_en_runs(paragraph.runs, reemplazos)
-        # Footer
-        if section.footer:
-            for paragraph in section.footer.paragraphs:
-                reemplazar_en_parrafo(paragraph, reemplazos)
-                if paragraph.runs and len(paragraph.runs) > 1:
-                    reemplazar_en_runs(paragraph.runs, reemplazos)
-        # First page header/footer (si es diferente)
-        if section.different_first_page_header_footer:
-            if section.first_page_header:
-                for paragraph in section.first_page_header.paragraphs:
-                    reemplazar_en_parrafo(paragraph, reemplazos)
-                    if paragraph.runs and len(paragraph.runs) > 1:
-                        reemplazar_en_runs(paragraph.runs, reemplazos)
-            if section.first_page_footer:
-                for paragraph in section.first_page_footer.paragraphs:
-                    reemplazar_en_parrafo(paragraph, reemplazos)
-                    if paragraph.runs and len(paragraph.runs) > 1:
-                        reemplazar_en_runs(paragraph.runs, reemplazos)
+            raiz = etree.fromstring(contenido)
+            parrafos = []
+            cambios_estaticos = False
+            for p in parrafos_xml(raiz):
+                if fusionar_placeholders_divididos(p):
+                    return None
+                texto = texto_parrafo_xml(p)
+                if '{{' in texto:
+                    parrafos.append(p)
+                elif limpiar and info.filename == 'word/document.xml' and texto and limpiar(texto) != texto:
+                    # La limpieza de un párrafo sin placeholders siempre da lo mismo: se hace una sola vez
+                    pre, post = _plantilla_parrafo_reconstruido(p, conservar_formato)
+                    nuevo = etree.fromstring(pre + _escapar_wt(limpiar(texto)) + post)
+                    p.getparent().replace(p, nuevo)
+                    cambios_estaticos = True
+            if not parrafos and not cambios_estaticos:
+                miembros.append((info, contenido))
+                continue
+            # Cada párrafo con placeholders se reemplaza por una marca y se compila aparte
+            compilados = []
+            for i, p in enumerate(parrafos):
+                xml_p = etree.tostring(p, encoding='unicode')
+                compilados.append({
+                    'xml': _partir_por_placeholders(xml_p),
+                    'texto': _partir_por_placeholders(texto_parrafo_xml(p)),
+                    'reconstruido': _plantilla_parrafo_reconstruido(p, conservar_formato),
+                })
+                marca = etree.Element(qn('w:p'))
+                marca.text = f'{_MARCA_TEXTO}{i}{_MARCA_TEXTO}'
+                p.getparent().replace(p, marca)
+            xml = etree.tostring(raiz, encoding='unicode')
+            xml = re.sub(r'<w:p>' + _MARCA_TEXTO + r'(\d+)' + _MARCA_TEXTO + r'</w:p>', _MARCA_TEXTO + r'\1' + _MARCA_TEXTO, xml)
+            trozos = xml.split(_MARCA_TEXTO)
+            # trozos: literal, índice, literal, índice, ...
+            segmentos = [trozo if n % 2 == 0 else compilados[int(trozo)] for n, trozo in enumerate(trozos)]
+            miembros.append((info, {'cabecera': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n', 'segmentos': segmentos}))
+    return {'miembros': miembros, 'limpiar': limpiar}
+
+def _rellenar(segmentos, valores, escapar):
+    partes = []
+    en_wt = False  # el placeholder está dentro de un w:t abierto (la última etiqueta antes de él)
+    for n, seg in enumerate(segmentos):
+        if n % 2 == 0:
+            partes.append(seg)
+            if escapar:
+                etiquetas = _ETIQUETA_RE.findall(seg)
+                if etiquetas:
+                    en_wt = etiquetas[-1] == 'w:t'
+        elif not escapar:
+            partes.append(str(valores.get(seg, seg)))
+        else:
+            valor = valores.get(seg, seg)
+            partes.append(_escapar_wt(valor) if en_wt else _escapar_xml(valor))
+    return ''.join(partes)
+
+def renderizar_xml(plantilla, reemplazos):
+    """
+    Genera el .docx final a partir de una plantilla compilada: solo se reescriben las partes con
+    placeholders; el resto de miembros del zip se copian sin pasar por python-docx.
+    Las claves sin llaves y la limpieza del template se aplican al texto de cada párrafo; si lo
+    cambian, el párrafo se reconstruye en un solo run (igual que el flujo con python-docx).
+    """
+    import zipfile
+    placeholders = {k: v for k, v in reemplazos.items() if _es_placeholder(k)}
+    extras = {k: v for k, v in reemplazos.items() if not _es_placeholder(k)}
+    compilado_extras = compilar_reemplazos(extras) if extras else None
+    limpiar = plantilla['limpiar']
+    salida = io.BytesIO()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info, contenido in plantilla['miembros']:
+            if isinstance(contenido, bytes):
+                zout.writestr(info, contenido)
+                continue
+            partes = [contenido['cabecera']]
+            for n, seg in enumerate(contenido['segmentos']):
+                if n % 2 == 0:
+                    partes.append(seg)
+                    continue
+                texto = _rellenar(seg['texto'], placeholders, escapar=False)
+                final = texto
+                if compilado_extras and compilado_extras['patron'] is not None:
+                    final = compilado_extras['patron'].sub(
+                        lambda m: _valor_para_match(compilado_extras, texto, m.start(), m.end()), texto)
+                if limpiar:
+                    final = limpiar(final)
+                if final != texto:
+                    pre, post = seg['reconstruido']
+                    partes.append(pre + _escapar_wt(final) + post)
+                else:
+                    partes.append(_rellenar(seg['xml'], placeholders, escapar=True))
+            zinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+            zinfo.compress_type = info.compress_type
+            zout.writestr(zinfo, ''.join(partes).encode('utf-8'))
+    return salida.getvalue()
+
+def plantilla_xml(nombre):
+    """Plantilla compilada para el render a nivel zip (None si el template no lo admite)."""
+    return _obtener_template_entry(nombre).get('xml')
+
+def modo_render(data):
+    """Modo de render pedido en el JSON (modoRender) o el configurado en MODO_RENDER."""
+    modo = str((data or {}).get('modoRender') or MODO_RENDER).strip().lower()
+    return modo if modo in ('xml', 'docx') else MODO_RENDER
 
 def formatear_monto(monto, incluir_signo=True):
     """Formatea un monto como moneda colombiana"""
@@ -1260,449 +3050,938 @@ def validate_numeric(value, min_val=None, max_val=None, default=0):
     except (ValueError, AttributeError):
         return default
 
-@app.route('/generate-cuenta-cobro', methods=['POST'])
-def generate_cuenta_cobro():
-    """Genera una cuenta de cobro usando el template Word"""
+# --- Catálogo de templates: se parsean una sola vez (al primer uso) y cada petición recibe una copia ---
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+# Nombre lógico -> archivos candidatos (se usa el primero que exista, incluye el typo 'cobro_ 2026.docx').
+# Los demás templates/*.docx se publican en el catálogo con el nombre del archivo sin espacios.
+TEMPLATE_ARCHIVOS = {
+    'cobro_12h': ['cobro_2026.docx', 'cobro_ 2026.docx'],
+    'cobro_8h': ['cobro_8h.docx'],
+    'contrato': ['contrato.docx'],
+}
+
+# Máximo de templates parseados que se mantienen en memoria
+TEMPLATE_CACHE_MAX = int(os.getenv('TEMPLATE_CACHE_MAX', '16'))
+# Segundos entre revisiones del archivo en disco (hot reload sin reiniciar los workers)
+TEMPLATE_VERIFICAR_CADA = float(os.getenv('TEMPLATE_VERIFICAR_CADA', '2'))
+
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+_template_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'recargas': 0}
+
+def _nombre_desde_archivo(archivo):
+    return re.sub(r'\s+', '', os.path.splitext(archivo)[0])
+
+def _archivos_docx():
     try:
-        if not request.json:
-            return jsonify({'error': 'No se recibieron datos'}), 400
-        
-        data = request.json
-        
-        # Validar y sanitizar datos del formulario
-        nombre = sanitize_input(data.get('nombre', ''), max_length=200)
-        if not nombre:
-            return jsonify({'error': 'El nombre es obligatorio'}), 400
-        
-        cedula = sanitize_input(data.get('cedula', ''), max_length=50)
-        if not cedula:
-            return jsonify({'error': 'La cédula es obligatoria'}), 400
-        
-        telefono = sanitize_input(data.get('phone', '') or data.get('telefono', '') or data.get('phoneNumber', ''), max_length=20)
-        # Remover print de debug con datos sensibles en producción
-        # print(f"📞 Teléfono recibido: '{telefono}'")  # Debug - removido por seguridad
-        mes = sanitize_input(data.get('mes', ''), max_length=50)
-        año = sanitize_input(data.get('año', ''), max_length=10)
-        
-        # Validar valores numéricos
-        mes_completo = bool(data.get('mesCompleto', True))
-        dia_inicio = str(int(validate_numeric(data.get('diaInicio', '1'), min_val=1, max_val=31, default=1)))
-        dia_fin = str(int(validate_numeric(data.get('diaFin', '30'), min_val=1, max_val=31, default=30)))
-        
-        # Calcular días trabajados
-        dias_num = 30  # Valor por defecto
-        if not mes_completo:
+        archivos = sorted(os.listdir(TEMPLATES_DIR))
+    except OSError:
+        return []
+    # ~$ son los archivos temporales que deja Word abierto
+    return [a for a in archivos if a.lower().endswith('.docx') and not a.startswith('~$')]
+
+def resolver_template_path(nombre):
+    """Devuelve la ruta del archivo para un template del catálogo (o la del primer candidato si no existe ninguno)."""
+    candidatos = TEMPLATE_ARCHIVOS.get(nombre)
+    if candidatos is None:
+        for archivo in _archivos_docx():
+            if _nombre_desde_archivo(archivo) == nombre:
+                return os.path.join(TEMPLATES_DIR, archivo)
+        candidatos = [nombre]
+    for archivo in candidatos:
+        path = os.path.join(TEMPLATES_DIR, archivo)
+        if os.path.exists(path):
+            return path
+    return os.path.join(TEMPLATES_DIR, candidatos[0])
+
+def catalogo_templates():
+    """Nombre -> ruta de todos los templates disponibles en templates/ (primero los nombres lógicos)."""
+    catalogo = {}
+    for nombre in TEMPLATE_ARCHIVOS:
+        path = resolver_template_path(nombre)
+        if os.path.exists(path):
+            catalogo[nombre] = path
+    usados = set(catalogo.values())
+    for archivo in _archivos_docx():
+        path = os.path.join(TEMPLATES_DIR, archivo)
+        if path not in usados:
+            catalogo.setdefault(_nombre_desde_archivo(archivo), path)
+    return catalogo
+
+def _cargar_template(nombre):
+    """Lee y parsea un template desde disco. Lanza FileNotFoundError si no existe."""
+    path = resolver_template_path(nombre)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Template no encontrado en: {path}")
+    inicio = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    estado = os.stat(path)
+    doc = Document(io.BytesIO(data))
+    sin_normalizar = normalizar_runs_template(doc)
+    if sin_normalizar:
+        print(f"⚠️ Template {nombre}: placeholders divididos que no se pudieron unir: {sin_normalizar}")
+    indice = construir_indice_placeholders(doc)
+    anclas = construir_anclas_tablas(doc)
+    try:
+        plantilla = compilar_plantilla_xml(data, LIMPIEZA_TEMPLATES.get(nombre))
+    except Exception as e:
+        print(f"⚠️ Template {nombre} sin render XML: {e}")
+        plantilla = None
+    sha256 = hashlib.sha256(data).hexdigest()
+    return {
+        'nombre': nombre,
+        'path': path,
+        'doc': doc,
+        'indice': indice,
+        'anclas': anclas,
+        'variantes': {},
+        'sin_normalizar': sin_normalizar,
+        'xml': plantilla,
+        'size': len(data),
+        'mtime_ns': estado.st_mtime_ns,
+        'sha256': sha256,
+        'version': sha256[:12],
+        'cargado_en': datetime.now().isoformat(timespec='seconds'),
+        'verificado': time.monotonic(),
+        'parse_ms': round((time.perf_counter() - inicio) * 1000, 2),
+    }
+
+def _template_cambio(entry):
+    """True si el archivo del template cambió en disco: primero mtime/tamaño, luego el hash del contenido."""
+    path = resolver_template_path(entry['nombre'])
+    try:
+        estado = os.stat(path)
+    except OSError:
+        # Si el archivo desaparece se sigue sirviendo la última versión cargada
+        return False
+    if path == entry['path'] and estado.st_mtime_ns == entry['mtime_ns'] and estado.st_size == entry['size']:
+        return False
+    with open(path, 'rb') as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    if sha256 == entry['sha256']:
+        # Solo cambió el mtime (p. ej. se copió el mismo archivo): no hace falta volver a parsear
+        entry['path'] = path
+        entry['mtime_ns'] = estado.st_mtime_ns
+        return False
+    return True
+
+def _guardar_en_cache(nombre, entry):
+    """Inserta la entrada respetando TEMPLATE_CACHE_MAX. Requiere _template_cache_lock."""
+    _template_cache[nombre] = entry
+    _template_cache.move_to_end(nombre)
+    while len(_template_cache) > max(TEMPLATE_CACHE_MAX, 1):
+        _template_cache.popitem(last=False)
+        _template_cache_stats['evictions'] += 1
+
+def _obtener_template_entry(nombre):
+    """Devuelve la entrada del catálogo (template prístino), cargándola o recargándola si hace falta."""
+    verificar = False
+    with _template_cache_lock:
+        entry = _template_cache.get(nombre)
+        if entry is not None:
+            _template_cache.move_to_end(nombre)
+            _template_cache_stats['hits'] += 1
+            ahora = time.monotonic()
+            if ahora - entry['verificado'] >= TEMPLATE_VERIFICAR_CADA:
+                entry['verificado'] = ahora
+                verificar = True
+    if entry is not None:
+        if not verificar:
+            return entry
+        try:
+            if not _template_cambio(entry):
+                return entry
+            # El archivo cambió: parsear la nueva versión y reemplazar la entrada
+            nuevo = _cargar_template(nombre)
+        except Exception as e:
+            # Archivo a medio copiar o ilegible: se sigue sirviendo la versión buena y se
+            # reintenta en la siguiente verificación ('verificado' ya se actualizó)
+            print(f"⚠️ Template {nombre}: no se pudo recargar ({e}); se mantiene la versión {entry['version']}")
+            return entry
+        with _template_cache_lock:
+            _template_cache_stats['recargas'] += 1
+            _guardar_en_cache(nombre, nuevo)
+        print(f"🔄 Template {nombre} recargado: versión {entry['version']} -> {nuevo['version']}")
+        return nuevo
+    # Parsear fuera del lock para no bloquear otras peticiones
+    entry = _cargar_template(nombre)
+    with _template_cache_lock:
+        _template_cache_stats['misses'] += 1
+        _guardar_en_cache(nombre, entry)
+    return entry
+
+def obtener_template(nombre):
+    """
+    Devuelve un Document listo para modificar: copia profunda del template ya parseado.
+    El original del catálogo nunca se modifica.
+    """
+    entry = _obtener_template_entry(nombre)
+    return copy.deepcopy(entry['doc'])
+
+def indice_template(nombre):
+    """Índice de placeholders calculado al cargar el template (ver construir_indice_placeholders)."""
+    return _obtener_template_entry(nombre)['indice']
+
+def version_template(nombre):
+    """Versión (hash del contenido) del template cargado; cambia cuando el archivo se recarga."""
+    return _obtener_template_entry(nombre)['version']
+
+def _resumen_template(entry):
+    return {
+        'nombre': entry['nombre'],
+        'archivo': os.path.basename(entry['path']),
+        'size': entry['size'],
+        'version': entry['version'],
+        'cargado_en': entry['cargado_en'],
+        'parse_ms': entry['parse_ms'],
+        'placeholders': len(entry['indice']['placeholders']),
+        'sin_normalizar': entry['sin_normalizar'],
+        'render_xml': entry['xml'] is not None,
+        'variantes': len(entry['variantes']),
+    }
+
+def template_cache_stats():
+    """Contadores del catálogo de templates (hits/misses/evictions/recargas) y templates cargados."""
+    with _template_cache_lock:
+        total = _template_cache_stats['hits'] + _template_cache_stats['misses']
+        return {
+            **_template_cache_stats,
+            'hit_rate': round(_template_cache_stats['hits'] / total, 4) if total else 0.0,
+            'size': len(_template_cache),
+            'max_size': TEMPLATE_CACHE_MAX,
+            'templates': [_resumen_template(e) for e in _template_cache.values()],
+        }
+
+def precargar_templates():
+    """Parsea todos los templates del catálogo y arma las variantes de los de cobro (PRECARGAR_TEMPLATES=1)."""
+    for nombre in catalogo_templates():
+        try:
+            _obtener_template_entry(nombre)
+            if nombre.startswith('cobro_'):
+                precargar_variantes_cobro(nombre)
+        except Exception as e:
+            print(f"⚠️ No se pudo precargar template {nombre}: {e}")
+
+@app.route('/templates', methods=['GET'])
+def listar_templates():
+    """
+    Lista el catálogo de templates con versión (hash del contenido), tamaño y tiempo de parseo.
+    Los templates se cargan al primer uso; con ?cargar=1 se cargan todos ahora.
+    """
+    cargar = (request.args.get('cargar') or '').strip().lower() in ('1', 'true', 'si')
+    templates = []
+    for nombre, path in catalogo_templates().items():
+        with _template_cache_lock:
+            entry = _template_cache.get(nombre)
+        if entry is None and cargar:
             try:
-                dia_inicio_num = int(dia_inicio)
-                dia_fin_num = int(dia_fin)
-                if dia_fin_num >= dia_inicio_num:
-                    dias_num = (dia_fin_num - dia_inicio_num) + 1
-                else:
-                    dias_num = 30
-            except (ValueError, TypeError):
-                dias_num = 30
+                entry = _obtener_template_entry(nombre)
+            except Exception as e:
+                templates.append({'nombre': nombre, 'archivo': os.path.basename(path), 'cargado': False, 'error': str(e)})
+                continue
+        if entry is None:
+            templates.append({
+                'nombre': nombre,
+                'archivo': os.path.basename(path),
+                'size': os.path.getsize(path) if os.path.exists(path) else None,
+                'cargado': False,
+            })
         else:
-            # Si es mes completo, usar el valor del campo o calcular desde el mes
-            try:
-                dias_trabajados_input = data.get('diasTrabajados', '')
-                if dias_trabajados_input:
-                    dias_num = int(validate_numeric(dias_trabajados_input, min_val=1, max_val=31, default=30))
-                else:
-                    dias_num = 30
-            except:
-                dias_num = 30
+            templates.append({**_resumen_template(entry), 'cargado': True})
+    return jsonify({'templates': templates, 'directorio': TEMPLATES_DIR})
+
+@app.route('/templates/cache-stats', methods=['GET'])
+def templates_cache_stats():
+    """Estadísticas del catálogo de templates parseados en memoria"""
+    return jsonify(template_cache_stats())
+
+# --- Caché de documentos generados (direccionada por contenido) ---
+# Clave: hash canónico de las entradas ya validadas + versión del template. Regenerar el mismo
+# documento (p. ej. tras una descarga perdida) devuelve los bytes guardados sin volver a renderizar.
+RENDER_CACHE_MAX = int(os.getenv('RENDER_CACHE_MAX', '256'))
+RENDER_CACHE_MAX_MB = float(os.getenv('RENDER_CACHE_MAX_MB', '64'))
+RENDER_CACHE_TTL = float(os.getenv('RENDER_CACHE_TTL', '900'))
+
+_render_cache = OrderedDict()  # clave -> (bytes, expira)
+_render_cache_lock = threading.Lock()
+_render_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirados': 0, 'bytes': 0}
+
+def clave_render(tipo, version, entradas):
+    """SHA-256 del JSON canónico (claves ordenadas, sin espacios) de tipo + versión + entradas."""
+    canonico = json.dumps([tipo, version, entradas], sort_keys=True, ensure_ascii=False,
+                          separators=(',', ':'), default=str)
+    return hashlib.sha256(canonico.encode('utf-8')).hexdigest()
+
+def _render_cache_get(clave):
+    with _render_cache_lock:
+        item = _render_cache.get(clave)
+        if item is None:
+            _render_cache_stats['misses'] += 1
+            return None
+        contenido, expira = item
+        if time.monotonic() >= expira:
+            del _render_cache[clave]
+            _render_cache_stats['bytes'] -= len(contenido)
+            _render_cache_stats['expirados'] += 1
+            _render_cache_stats['misses'] += 1
+            return None
+        _render_cache.move_to_end(clave)
+        _render_cache_stats['hits'] += 1
+        return contenido
+
+def _render_cache_put(clave, contenido):
+    max_bytes = int(RENDER_CACHE_MAX_MB * 1024 * 1024)
+    # Documentos más grandes que toda la caché no se guardan
+    if RENDER_CACHE_MAX <= 0 or len(contenido) > max_bytes:
+        return
+    with _render_cache_lock:
+        anterior = _render_cache.pop(clave, None)
+        if anterior is not None:
+            _render_cache_stats['bytes'] -= len(anterior[0])
+        _render_cache[clave] = (contenido, time.monotonic() + RENDER_CACHE_TTL)
+        _render_cache_stats['bytes'] += len(contenido)
+        while len(_render_cache) > RENDER_CACHE_MAX or _render_cache_stats['bytes'] > max_bytes:
+            _, (viejo, _) = _render_cache.popitem(last=False)
+            _render_cache_stats['bytes'] -= len(viejo)
+            _render_cache_stats['evictions'] += 1
+
+def render_cacheado(tipo, version, entradas, generar):
+    """Bytes del documento desde la caché, o llamando a generar() y guardando el resultado."""
+    clave = clave_render(tipo, version, entradas)
+    contenido = _render_cache_get(clave)
+    if contenido is None:
+        contenido = generar()
+        _render_cache_put(clave, contenido)
+    return contenido
+
+def render_cache_stats():
+    with _render_cache_lock:
+        contadores = dict(_render_cache_stats)
+        entradas = len(_render_cache)
+    consultas = contadores['hits'] + contadores['misses']
+    return {
+        **contadores,
+        'entradas': entradas,
+        'hit_rate': round(contadores['hits'] / consultas, 4) if consultas else 0.0,
+        'max_entradas': RENDER_CACHE_MAX,
+        'max_mb': RENDER_CACHE_MAX_MB,
+        'ttl_segundos': RENDER_CACHE_TTL,
+    }
+
+@app.route('/render-cache/stats', methods=['GET'])
+def render_cache_stats_endpoint():
+    """Aciertos, fallos, expulsiones y tamaño de la caché de documentos generados"""
+    return jsonify(render_cache_stats())
+
+def _reconstruir_parrafo(paragraph, texto, conservar_formato=True):
+    """Deja el párrafo con un solo run con `texto` (formato del primer run si se pide)."""
+    formato_original = None
+    if conservar_formato and paragraph.runs:
+        primer_run = paragraph.runs[0]
+        formato_original = {
+            'font_name': primer_run.font.name if primer_run.font.name else None,
+            'font_size': primer_run.font.size if primer_run.font.size else None,
+            'bold': primer_run.bold if primer_run.bold is not None else False,
+            'italic': primer_run.italic if primer_run.italic is not None else False,
+            'color': primer_run.font.color.rgb if primer_run.font.color and primer_run.font.color.rgb else None
+        }
+    
+    paragraph.clear()
+    nuevo_run = paragraph.add_run(texto)
+    
+    if formato_original:
+        if formato_original['font_name']:
+            nuevo_run.font.name = formato_original['font_name']
+        if formato_original['font_size']:
+            nuevo_run.font.size = formato_original['font_size']
+        if formato_original['color']:
+            nuevo_run.font.color.rgb = formato_original['color']
+        nuevo_run.bold = formato_original['bold']
+        nuevo_run.italic = formato_original['italic']
+
+def procesar_documento(doc, reemplazos, limpieza=None, indice=None, motor=None):
+    """
+    Reemplazo de placeholders y limpieza de duplicaciones en un solo recorrido (iterar_parrafos):
+    cuerpo, tablas, cuadros de texto, headers y footers. Cada párrafo se reemplaza y enseguida se limpia.
+    limpieza: (función, conservar formato del primer run) como en LIMPIEZA_TEMPLATES.
+    Con el índice del template el reemplazo solo se hace en los párrafos indexados; la limpieza
+    pasa por todos.
+    """
+    from docx.text.paragraph import Paragraph
+    motor = (motor or MOTOR_REEMPLAZO)
+    compilado = compilar_reemplazos(reemplazos) if motor != 'legacy' else None
+    limpiar, conservar_formato = limpieza or (None, False)
+    objetivos = None
+    if indice is not None:
+        objetivos = {p: ubicacion for _, p, ubicacion in parrafos_indexados(doc, indice, reemplazos)}
+    
+    for part, p in iterar_parrafos(doc):
+        if objetivos is None or p in objetivos:
+            locales = reemplazos if objetivos is None or motor != 'legacy' else _reemplazos_locales(reemplazos, objetivos[p])
+            _reemplazar_parrafo(part, p, locales, compilado, motor)
+        if limpiar:
+            texto = p.text
+            limpio = limpiar(texto)
+            if limpio != texto:
+                _reconstruir_parrafo(Paragraph(p, _ParteStory(part)), limpio, conservar_formato)
+
+def _texto_fila(tr):
+    """Texto de la fila en mayúsculas (celdas separadas por espacio), para ubicar las filas ancla."""
+    return ' '.join(''.join(t.text or '' for t in tc.iter(qn('w:t'))).strip() for tc in tr.iter(qn('w:tc'))).upper()
+
+def _prototipo_fila_auxilio(tbl):
+    """Fila 'AUXILIO DE TRANSPORTE | MES COMPLETO | <valor> | ' con el ancho de columnas de la tabla."""
+    from docx.oxml import OxmlElement
+    # Se arma con los elementos oxml, fuera del template: una celda por columna de la grilla
+    # (como Table.add_row) y cada una con un párrafo de un solo run (como _Cell.text)
+    tr = OxmlElement('w:tr')
+    for gridCol in tbl.tblGrid.gridCol_lst:
+        tc = tr.add_tc()
+        if gridCol.w is not None:
+            tc.width = gridCol.w
+    textos = ['AUXILIO DE TRANSPORTE', 'MES COMPLETO', _MARCA_TEXTO, '']  # _MARCA_TEXTO: valor (ax1), se llena en cada petición
+    if len(tr.tc_lst) >= 4:
+        for tc, texto in zip(tr.tc_lst, textos):
+            tc.clear_content()
+            tc.add_p().add_r().text = texto
+    return tr
+
+def construir_anclas_tablas(doc):
+    """
+    Filas estructurales de cada tabla del cuerpo, ubicadas una sola vez al cargar el template:
+    ADICIONALES (se quita si no hay turnos), TOTAL (el auxilio de transporte va antes) y el
+    prototipo de la fila de AUXILIO DE TRANSPORTE que se clona en cada petición.
+    """
+    raiz = doc.element
+    anclas = []
+    for tbl in doc.element.body.iterchildren(qn('w:tbl')):
+        adicionales = -1
+        total = -1
+        for idx, tr in enumerate(tbl.tr_lst):
+            texto = _texto_fila(tr)
+            if 'ADICIONALES' in texto and 'SUELDO FIJO' not in texto and 'BONO' not in texto:
+                adicionales = idx
+            if 'TOTAL' in texto and total < 0:
+                total = idx
+        anclas.append({
+            'ruta': _ruta_elemento(raiz, tbl),
+            'adicionales': adicionales,
+            'total': total,
+            'auxilio': _prototipo_fila_auxilio(tbl),
+        })
+    return anclas
+
+def anclas_template(nombre):
+    """Anclas de las tablas del template (ver construir_anclas_tablas)."""
+    return _obtener_template_entry(nombre)['anclas']
+
+def _ajustar_filas_cobro(doc, anclas, turnos_num, con_auxilio, ax1_formateado):
+    """Quita la fila de ADICIONALES y/o inserta la de AUXILIO DE TRANSPORTE en posiciones ya conocidas."""
+    raiz = doc.element
+    for ancla in anclas:
+        tbl = _resolver_ruta(raiz, ancla['ruta'])
+        filas = tbl.tr_lst
+        # Resolver las filas antes de modificar la tabla (los índices son los del template)
+        fila_adicionales = filas[ancla['adicionales']] if ancla['adicionales'] >= 0 else None
+        fila_total = filas[ancla['total']] if ancla['total'] >= 0 else None
+        
+        # Eliminar fila de ADICIONALES si no hay turnos
+        if turnos_num == 0 and fila_adicionales is not None:
+            tbl.remove(fila_adicionales)
         
-        # Obtener el número de días del mes seleccionado
+        # Agregar fila de AUXILIO DE TRANSPORTE antes del TOTAL (o al final si la tabla no tiene TOTAL)
+        if con_auxilio:
+            nueva_fila = copy.deepcopy(ancla['auxilio'])
+            for t in nueva_fila.iter(qn('w:t')):
+                if t.text == _MARCA_TEXTO:
+                    t.text = ax1_formateado
+            if fila_total is not None and fila_total is not fila_adicionales:
+                fila_total.addprevious(nueva_fila)
+            else:
+                tbl.append(nueva_fila)
+
+def _construir_variante_cobro(entry, hay_turnos, con_auxilio):
+    """
+    Variante estructural de un template de cobro: sin la fila de ADICIONALES si no hay turnos y con
+    la fila de AUXILIO DE TRANSPORTE (valor {{ax1}}) si aplica. Se indexa y se compila para el
+    render XML como cualquier template, así cada petición solo rellena texto.
+    """
+    doc = copy.deepcopy(entry['doc'])
+    _ajustar_filas_cobro(doc, entry['anclas'], 1 if hay_turnos else 0, con_auxilio, '{{ax1}}')
+    output = io.BytesIO()
+    doc.save(output)
+    try:
+        plantilla = compilar_plantilla_xml(output.getvalue(), LIMPIEZA_TEMPLATES.get(entry['nombre']))
+    except Exception as e:
+        print(f"⚠️ Variante de {entry['nombre']} sin render XML: {e}")
+        plantilla = None
+    print(f"🧩 Variante {entry['nombre']} (turnos={'sí' if hay_turnos else 'no'}, auxilio={'sí' if con_auxilio else 'no'}) construida")
+    return {'doc': doc, 'indice': construir_indice_placeholders(doc), 'xml': plantilla}
+
+def variante_cobro(nombre, hay_turnos, con_auxilio):
+    """
+    Variante (template × turnos > 0 × auxilio de transporte) ya construida, cacheada en la entrada
+    del catálogo: si el template se recarga, sus variantes se vuelven a construir al primer uso.
+    """
+    entry = _obtener_template_entry(nombre)
+    clave = (bool(hay_turnos), bool(con_auxilio))
+    variante = entry['variantes'].get(clave)
+    if variante is None:
+        # Se construye fuera del lock; si dos peticiones compiten, se queda la primera
+        variante = _construir_variante_cobro(entry, *clave)
+        with _template_cache_lock:
+            variante = entry['variantes'].setdefault(clave, variante)
+    return variante
+
+def precargar_variantes_cobro(nombre):
+    """Construye las cuatro variantes de un template de cobro."""
+    for hay_turnos in (True, False):
+        for con_auxilio in (False, True):
+            variante_cobro(nombre, hay_turnos, con_auxilio)
+
+def _renderizar_cobro_docx(doc, indice, reemplazos, nombre_template):
+    """Flujo con python-docx de la cuenta de cobro sobre una copia de la variante. Devuelve los bytes del .docx."""
+    # Reemplazar (solo en los párrafos indexados de la variante) y limpiar duplicaciones en un solo recorrido
+    procesar_documento(doc, reemplazos, LIMPIEZA_TEMPLATES[nombre_template], indice=indice)
+    print("✅ Reemplazos y limpieza de duplicaciones completados")
+    
+    # Guardar en memoria
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+def generar_cuenta_cobro(data):
+    """
+    Valida el payload de una cuenta de cobro, calcula los valores y renderiza el documento.
+    Devuelve (bytes del .docx, nombre de archivo). Lanza ValueError si faltan datos obligatorios
+    y FileNotFoundError si no está el template. La usan /generate-cuenta-cobro y el endpoint batch.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('No se recibieron datos')
+    
+    # Validar y sanitizar datos del formulario
+    nombre = sanitize_input(data.get('nombre', ''), max_length=200)
+    if not nombre:
+        raise ValueError('El nombre es obligatorio')
+    
+    cedula = sanitize_input(data.get('cedula', ''), max_length=50)
+    if not cedula:
+        raise ValueError('La cédula es obligatoria')
+    
+    telefono = sanitize_input(data.get('phone', '') or data.get('telefono', '') or data.get('phoneNumber', ''), max_length=20)
+    # Remover print de debug con datos sensibles en producción
+    # print(f"📞 Teléfono recibido: '{telefono}'")  # Debug - removido por seguridad
+    mes = sanitize_input(data.get('mes', ''), max_length=50)
+    año = sanitize_input(data.get('año', ''), max_length=10)
+    
+    # Validar valores numéricos
+    mes_completo = bool(data.get('mesCompleto', True))
+    dia_inicio = str(int(validate_numeric(data.get('diaInicio', '1'), min_val=1, max_val=31, default=1)))
+    dia_fin = str(int(validate_numeric(data.get('diaFin', '30'), min_val=1, max_val=31, default=30)))
+    
+    # Calcular días trabajados
+    dias_num = 30  # Valor por defecto
+    if not mes_completo:
+        try:
+            dia_inicio_num = int(dia_inicio)
+            dia_fin_num = int(dia_fin)
+            if dia_fin_num >= dia_inicio_num:
+                dias_num = (dia_fin_num - dia_inicio_num) + 1
+            else:
+                dias_num = 30
+        except (ValueError, TypeError):
+            dias_num = 30
+    else:
+        # Si es mes completo, usar el valor del campo o calcular desde el mes
         try:
-            mes_num = int(mes) if mes.isdigit() else 0
-            año_num = int(año) if año.isdigit() else datetime.now().year
-            if 1 <= mes_num <= 12:
-                from calendar import monthrange
-                dias_del_mes = monthrange(año_num, mes_num)[1]
+            dias_trabajados_input = data.get('diasTrabajados', '')
+            if dias_trabajados_input:
+                dias_num = int(validate_numeric(dias_trabajados_input, min_val=1, max_val=31, default=30))
             else:
-                dias_del_mes = 30
+                dias_num = 30
         except:
-            dias_del_mes = 30
-        
-        # Limitar días trabajados al máximo de días del mes
-        if dias_num > dias_del_mes:
-            dias_num = dias_del_mes
-        if dias_num < 1:
             dias_num = 30
-        
-        # Parsear sueldo fijo correctamente (soporta formatos: "2000000", "2.000.000", "2,000,000")
+    
+    # Obtener el número de días del mes seleccionado
+    try:
+        mes_num = int(mes) if mes.isdigit() else 0
+        año_num = int(año) if año.isdigit() else datetime.now().year
+        if 1 <= mes_num <= 12:
+            from calendar import monthrange
+            dias_del_mes = monthrange(año_num, mes_num)[1]
+        else:
+            dias_del_mes = 30
+    except:
+        dias_del_mes = 30
+    
+    # Limitar días trabajados al máximo de días del mes
+    if dias_num > dias_del_mes:
+        dias_num = dias_del_mes
+    if dias_num < 1:
+        dias_num = 30
+    
+    # Parsear sueldo fijo correctamente (soporta formatos: "2000000", "2.000.000", "2,000,000")
+    sueldo_fijo_num = 0
+    try:
+        sueldo_fijo_raw = str(data.get('sueldoFijo', '0')).strip()
+        if sueldo_fijo_raw:
+            # Remover puntos (separadores de miles) y reemplazar coma por punto (decimal)
+            sueldo_fijo_limpio = sueldo_fijo_raw.replace('.', '').replace(',', '.')
+            sueldo_fijo_num = float(sueldo_fijo_limpio)
+            if sueldo_fijo_num < 0:
+                sueldo_fijo_num = 0
+            if sueldo_fijo_num > 10000000:
+                sueldo_fijo_num = 10000000
+    except (ValueError, TypeError):
         sueldo_fijo_num = 0
-        try:
-            sueldo_fijo_raw = str(data.get('sueldoFijo', '0')).strip()
-            if sueldo_fijo_raw:
-                # Remover puntos (separadores de miles) y reemplazar coma por punto (decimal)
-                sueldo_fijo_limpio = sueldo_fijo_raw.replace('.', '').replace(',', '.')
-                sueldo_fijo_num = float(sueldo_fijo_limpio)
-                if sueldo_fijo_num < 0:
-                    sueldo_fijo_num = 0
-                if sueldo_fijo_num > 10000000:
-                    sueldo_fijo_num = 10000000
-        except (ValueError, TypeError):
-            sueldo_fijo_num = 0
-        
-        # Calcular sueldo proporcional según días trabajados
-        sueldo_proporcional = 0
-        if sueldo_fijo_num > 0 and dias_del_mes > 0:
-            valor_por_dia = sueldo_fijo_num / dias_del_mes
-            sueldo_proporcional = round(valor_por_dia * dias_num)
-        
-        # Validar y sanitizar valores monetarios y otros campos
-        turnos_descansos = str(int(validate_numeric(data.get('turnosDescansos', '0'), min_val=0, max_val=100, default=0)))
-        paciente = sanitize_input(data.get('paciente', '') or data.get('patientName', ''), max_length=200)
-        cuenta_bancaria = sanitize_input(data.get('cuentaBancaria', '') or data.get('bankAccount', ''), max_length=50)
-        banco = sanitize_input(data.get('banco', ''), max_length=100).upper() or 'Bancolombia'
-        tipo_cuenta_cobro = sanitize_input(data.get('tipoCuentaCobro', '12h'), max_length=10)
-        if tipo_cuenta_cobro not in ['12h', '8h']:
-            tipo_cuenta_cobro = '12h'
-        tiene_auxilio_transporte = bool(data.get('tieneAuxilioTransporte', False))
-        
-        # Parsear bono de seguridad CORRECTAMENTE
+    
+    # Calcular sueldo proporcional según días trabajados
+    sueldo_proporcional = 0
+    if sueldo_fijo_num > 0 and dias_del_mes > 0:
+        valor_por_dia = sueldo_fijo_num / dias_del_mes
+        sueldo_proporcional = round(valor_por_dia * dias_num)
+    
+    # Validar y sanitizar valores monetarios y otros campos
+    turnos_descansos = str(int(validate_numeric(data.get('turnosDescansos', '0'), min_val=0, max_val=100, default=0)))
+    paciente = sanitize_input(data.get('paciente', '') or data.get('patientName', ''), max_length=200)
+    cuenta_bancaria = sanitize_input(data.get('cuentaBancaria', '') or data.get('bankAccount', ''), max_length=50)
+    banco = sanitize_input(data.get('banco', ''), max_length=100).upper() or 'Bancolombia'
+    tipo_cuenta_cobro = sanitize_input(data.get('tipoCuentaCobro', '12h'), max_length=10)
+    if tipo_cuenta_cobro not in ['12h', '8h']:
+        tipo_cuenta_cobro = '12h'
+    tiene_auxilio_transporte = bool(data.get('tieneAuxilioTransporte', False))
+    
+    # Parsear bono de seguridad CORRECTAMENTE
+    bono_seguridad_num = 0
+    try:
+        bono_raw = data.get('bonoSeguridad', '0')
+        if bono_raw:
+            # Convertir a string y limpiar
+            bono_str = str(bono_raw).strip()
+            # Remover puntos (separadores de miles) y reemplazar coma por punto (decimal)
+            bono_limpio = bono_str.replace('.', '').replace(',', '.')
+            bono_seguridad_num = float(bono_limpio)
+            # Validar rango
+            if bono_seguridad_num < 0:
+                bono_seguridad_num = 0
+            if bono_seguridad_num > 10000000:
+                bono_seguridad_num = 10000000
+    except (ValueError, TypeError, AttributeError):
         bono_seguridad_num = 0
+    
+    # Parsear auxilio de transporte
+    auxilio_transporte_num = 0
+    if tiene_auxilio_transporte:
         try:
-            bono_raw = data.get('bonoSeguridad', '0')
-            if bono_raw:
-                # Convertir a string y limpiar
-                bono_str = str(bono_raw).strip()
-                # Remover puntos (separadores de miles) y reemplazar coma por punto (decimal)
-                bono_limpio = bono_str.replace('.', '').replace(',', '.')
-                bono_seguridad_num = float(bono_limpio)
-                # Validar rango
-                if bono_seguridad_num < 0:
-                    bono_seguridad_num = 0
-                if bono_seguridad_num > 10000000:
-                    bono_seguridad_num = 10000000
+            auxilio_raw = data.get('auxilioTransporte', '0')
+            if auxilio_raw:
+                auxilio_str = str(auxilio_raw).strip()
+                auxilio_limpio = auxilio_str.replace('.', '').replace(',', '.')
+                auxilio_transporte_num = float(auxilio_limpio)
+                if auxilio_transporte_num < 0:
+                    auxilio_transporte_num = 0
+                if auxilio_transporte_num > 10000000:
+                    auxilio_transporte_num = 10000000
         except (ValueError, TypeError, AttributeError):
-            bono_seguridad_num = 0
-        
-        # Parsear auxilio de transporte
-        auxilio_transporte_num = 0
-        if tiene_auxilio_transporte:
-            try:
-                auxilio_raw = data.get('auxilioTransporte', '0')
-                if auxilio_raw:
-                    auxilio_str = str(auxilio_raw).strip()
-                    auxilio_limpio = auxilio_str.replace('.', '').replace(',', '.')
-                    auxilio_transporte_num = float(auxilio_limpio)
-                    if auxilio_transporte_num < 0:
-                        auxilio_transporte_num = 0
-                    if auxilio_transporte_num > 10000000:
-                        auxilio_transporte_num = 10000000
-            except (ValueError, TypeError, AttributeError):
-                auxilio_transporte_num = 0
-        
-        # Calcular adicionales (turnos * 60000)
-        turnos_num = int(turnos_descansos) if turnos_descansos.isdigit() else 0
-        valor_por_turno = 60000
-        adicionales_valor = turnos_num * valor_por_turno
-        
-        # El total se calculará después de formatear los valores
-        
-        # Formatear fecha (mes en texto)
-        fecha_texto = ''
-        if mes and año:
-            mes_num = int(mes) if mes.isdigit() else 0
-            if 1 <= mes_num <= 12:
-                fecha_texto = f"{MESES[mes_num].upper()} DE {año}"
-        
-        # Cargar template
-        # Seleccionar template según tipo de cuenta de cobro
-        templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
-        if tipo_cuenta_cobro == '8h':
-            template_path = os.path.join(templates_dir, 'cobro_8h.docx')
-        else:
-            # Probar ambos nombres (con y sin espacio - typo común)
-            for name in ['cobro_2026.docx', 'cobro_ 2026.docx']:
-                p = os.path.join(templates_dir, name)
-                if os.path.exists(p):
-                    template_path = p
-                    break
-            else:
-                template_path = os.path.join(templates_dir, 'cobro_2026.docx')
-        if not os.path.exists(template_path):
-            return jsonify({"error": f"Template no encontrado en: {template_path}"}), 404
-        
-        doc = Document(template_path)
+            auxilio_transporte_num = 0
+    
+    # Calcular adicionales (turnos * 60000)
+    turnos_num = int(turnos_descansos) if turnos_descansos.isdigit() else 0
+    valor_por_turno = 60000
+    adicionales_valor = turnos_num * valor_por_turno
+    
+    # El total se calculará después de formatear los valores
+    
+    # Formatear fecha (mes en texto)
+    fecha_texto = ''
+    if mes and año:
+        mes_num = int(mes) if mes.isdigit() else 0
+        if 1 <= mes_num <= 12:
+            fecha_texto = f"{MESES[mes_num].upper()} DE {año}"
+    
+    # Seleccionar template según tipo de cuenta de cobro
+    nombre_template = 'cobro_8h' if tipo_cuenta_cobro == '8h' else 'cobro_12h'
+    # Variante estructural: fila de ADICIONALES solo con turnos, fila de AUXILIO DE TRANSPORTE si aplica
+    con_auxilio = tiene_auxilio_transporte and auxilio_transporte_num > 0
+    usar_xml = modo_render(data) == 'xml'
+    
+    # Preparar reemplazos usando los placeholders exactos del template
+    # Buscar todas las variaciones posibles de las variables
+    reemplazos = {}
+    
+    # ============================================
+    # FORMATEO DE VALORES - CÓDIGO NUEVO DESDE CERO
+    # ============================================
+    
+    # Variable sf1: Sueldo proporcional según días trabajados
+    # Ejemplo: sueldo fijo 2.000.000, enero 31 días = 2.000.000, febrero 28 días = 2.000.000
+    sf1_valor = sueldo_proporcional
+    sf1_formateado = formatear_monto(sf1_valor, incluir_signo=False)
+    
+    # Variable bs1: Bono de seguridad
+    # Ejemplo: 200.000
+    bs1_valor = bono_seguridad_num
+    bs1_formateado = formatear_monto(bs1_valor, incluir_signo=False) if bs1_valor > 0 else ''
+    
+    # Variable ad1: Adicionales (turnos de descansos)
+    # Ejemplo: 4 turnos * 60.000 = 240.000
+    ad1_valor = adicionales_valor
+    ad1_formateado = formatear_monto(ad1_valor, incluir_signo=False) if ad1_valor > 0 else ''
+    
+    # Variable ax1: Auxilio de transporte
+    ax1_valor = auxilio_transporte_num
+    ax1_formateado = formatear_monto(ax1_valor, incluir_signo=False) if ax1_valor > 0 else ''
+    
+    # Calcular TOTAL: sf1 + bs1 + ad1 + ax1
+    total_calculado = sf1_valor + bs1_valor + ad1_valor + ax1_valor
+    total_formateado = formatear_monto(total_calculado, incluir_signo=False)
+    
+    # SOLO reemplazar variables {{VARIABLE}} - no tocar texto normal
+    # El template Word usa placeholders entre llaves dobles
+    nombre_upper = nombre.upper()
+    paciente_upper = paciente.upper() if paciente else ''
+    telefono_valor = telefono if telefono else ''
+    
+    # Variables del template (solo formato {{variable}})
+    reemplazos['{{Name1}}'] = nombre_upper
+    reemplazos['{{Cedu1}}'] = cedula
+    reemplazos['{{Num1}}'] = telefono_valor
+    reemplazos['{{banco1}}'] = banco
+    reemplazos['{{nbanco1}}'] = cuenta_bancaria
+    reemplazos['{{mes1}}'] = fecha_texto
+    reemplazos['{{valor1}}'] = total_formateado
+    reemplazos['{{paciente1}}'] = paciente_upper
+    reemplazos['{{sf1}}'] = sf1_formateado
+    reemplazos['{{sb1}}'] = bs1_formateado
+    reemplazos['{{ad1}}'] = ad1_formateado
+    reemplazos['{{ax1}}'] = ax1_formateado
+    
+    # Días trabajados - {{dias1}} para uso numérico; MES COMPLETO se deja tal cual (no reemplazar con días)
+    reemplazos['{{dias1}}'] = str(dias_num)
+    
+    # dia1 y dia2 - solo {{dia1}} {{dia2}}
+    dia_inicio = data.get('diaInicio', '1').strip() if data.get('diaInicio') else '1'
+    dia_fin = str(dias_del_mes)
+    reemplazos['{{dia1}}'] = dia_inicio
+    reemplazos['{{dia2}}'] = dia_fin
+    
+    # Limpiar duplicaciones de texto comunes ANTES de reemplazar
+    # Duplicaciones de año - múltiples variaciones (ordenar por longitud descendente)
+    # Primero los más largos para evitar reemplazos parciales
+    reemplazos['DE ' + año + ' DEL ' + año] = f'DE {año}'
+    reemplazos['DEL ' + año + ' DE ' + año] = f'DEL {año}'
+    reemplazos['DE ' + año + ' DE ' + año] = f'DE {año}'
+    reemplazos['DEL ' + año + ' DEL ' + año] = f'DEL {año}'
+    # También valores hardcodeados comunes
+    reemplazos['DE 2026 DEL 2026'] = f'DE {año}'
+    reemplazos['DEL 2026 DE 2026'] = f'DEL {año}'
+    reemplazos['DE 2026 DE 2026'] = f'DE {año}'
+    reemplazos['DEL 2026 DEL 2026'] = f'DEL {año}'
+    
+    # Log de reemplazos para debug - especialmente dia1 y dia2
+    print(f"🔍 Reemplazos a realizar: {len(reemplazos)} variables")
+    print(f"📅 dia1 (día inicio): '{dia_inicio}'")
+    print(f"📅 dia2 (día fin): '{dia_fin}'")
+    # Debug removido por seguridad - comentado para producción
+    # for key, value in sorted(reemplazos.items()):
+    #     if value and ('dia' in key.lower() or 'DIA' in key):
+    #         print(f"  - {key} -> {value}")
+    
+    def renderizar():
+        # Variante ya armada del template (FileNotFoundError si no existe: el endpoint responde 404)
+        variante = variante_cobro(nombre_template, turnos_num > 0, con_auxilio)
+        if usar_xml and variante['xml'] is not None:
+            # Render directo sobre el XML de la variante
+            return renderizar_xml(variante['xml'], reemplazos)
+        return _renderizar_cobro_docx(copy.deepcopy(variante['doc']), variante['indice'], reemplazos, nombre_template)
+    
+    # Misma entrada validada + misma versión del template => mismo documento (la fecha solo va en el nombre)
+    contenido = render_cacheado('cobro', version_template(nombre_template), {
+        'template': nombre_template,
+        'reemplazos': reemplazos,
+        'turnos': turnos_num > 0,
+        'auxilio': con_auxilio,
+        'xml': usar_xml,
+        'motor': MOTOR_REEMPLAZO,
+    }, renderizar)
+    
+    # Nombre del archivo
+    nombre_archivo = nombre.replace(' ', '_') if nombre else 'Cuenta_Cobro'
+    filename = f"Cuenta_Cobro_{nombre_archivo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
+    return contenido, filename
+
+@app.route('/generate-cuenta-cobro', methods=['POST'])
+def generate_cuenta_cobro():
+    """Genera una cuenta de cobro usando el template Word"""
+    try:
+        if not request.json:
+            return jsonify({'error': 'No se recibieron datos'}), 400
+        formato = formato_salida(request.json)
+        if formato is None:
+            return error_formato_salida()
         
-        # Preparar reemplazos usando los placeholders exactos del template
-        # Buscar todas las variaciones posibles de las variables
-        reemplazos = {}
+        tiempos = {}
+        try:
+            with medir_paso(tiempos, 'docx'):
+                contenido, filename = generar_cuenta_cobro(request.json)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except FileNotFoundError as e:
+            return jsonify({"error": str(e)}), 404
         
-        # ============================================
-        # FORMATEO DE VALORES - CÓDIGO NUEVO DESDE CERO
-        # ============================================
-        
-        # Variable sf1: Sueldo proporcional según días trabajados
-        # Ejemplo: sueldo fijo 2.000.000, enero 31 días = 2.000.000, febrero 28 días = 2.000.000
-        sf1_valor = sueldo_proporcional
-        sf1_formateado = formatear_monto(sf1_valor, incluir_signo=False)
-        
-        # Variable bs1: Bono de seguridad
-        # Ejemplo: 200.000
-        bs1_valor = bono_seguridad_num
-        bs1_formateado = formatear_monto(bs1_valor, incluir_signo=False) if bs1_valor > 0 else ''
-        
-        # Variable ad1: Adicionales (turnos de descansos)
-        # Ejemplo: 4 turnos * 60.000 = 240.000
-        ad1_valor = adicionales_valor
-        ad1_formateado = formatear_monto(ad1_valor, incluir_signo=False) if ad1_valor > 0 else ''
-        
-        # Variable ax1: Auxilio de transporte
-        ax1_valor = auxilio_transporte_num
-        ax1_formateado = formatear_monto(ax1_valor, incluir_signo=False) if ax1_valor > 0 else ''
-        
-        # Calcular TOTAL: sf1 + bs1 + ad1 + ax1
-        total_calculado = sf1_valor + bs1_valor + ad1_valor + ax1_valor
-        total_formateado = formatear_monto(total_calculado, incluir_signo=False)
-        
-        # SOLO reemplazar variables {{VARIABLE}} - no tocar texto normal
-        # El template Word usa placeholders entre llaves dobles
-        nombre_upper = nombre.upper()
-        paciente_upper = paciente.upper() if paciente else ''
-        telefono_valor = telefono if telefono else ''
-        
-        # Variables del template (solo formato {{variable}})
-        reemplazos['{{Name1}}'] = nombre_upper
-        reemplazos['{{Cedu1}}'] = cedula
-        reemplazos['{{Num1}}'] = telefono_valor
-        reemplazos['{{banco1}}'] = banco
-        reemplazos['{{nbanco1}}'] = cuenta_bancaria
-        reemplazos['{{mes1}}'] = fecha_texto
-        reemplazos['{{valor1}}'] = total_formateado
-        reemplazos['{{paciente1}}'] = paciente_upper
-        reemplazos['{{sf1}}'] = sf1_formateado
-        reemplazos['{{sb1}}'] = bs1_formateado
-        reemplazos['{{ad1}}'] = ad1_formateado
-        reemplazos['{{ax1}}'] = ax1_formateado
-        
-        # Días trabajados - {{dias1}} para uso numérico; MES COMPLETO se deja tal cual (no reemplazar con días)
-        reemplazos['{{dias1}}'] = str(dias_num)
-        
-        # dia1 y dia2 - solo {{dia1}} {{dia2}}
-        dia_inicio = data.get('diaInicio', '1').strip() if data.get('diaInicio') else '1'
-        dia_fin = str(dias_del_mes)
-        reemplazos['{{dia1}}'] = dia_inicio
-        reemplazos['{{dia2}}'] = dia_fin
-        
-        # Limpiar duplicaciones de texto comunes ANTES de reemplazar
-        # Duplicaciones de año - múltiples variaciones (ordenar por longitud descendente)
-        # Primero los más largos para evitar reemplazos parciales
-        reemplazos['DE ' + año + ' DEL ' + año] = f'DE {año}'
-        reemplazos['DEL ' + año + ' DE ' + año] = f'DEL {año}'
-        reemplazos['DE ' + año + ' DE ' + año] = f'DE {año}'
-        reemplazos['DEL ' + año + ' DEL ' + año] = f'DEL {año}'
-        # También valores hardcodeados comunes
-        reemplazos['DE 2026 DEL 2026'] = f'DE {año}'
-        reemplazos['DEL 2026 DE 2026'] = f'DEL {año}'
-        reemplazos['DE 2026 DE 2026'] = f'DE {año}'
-        reemplazos['DEL 2026 DEL 2026'] = f'DEL {año}'
-        
-        # Log de reemplazos para debug - especialmente dia1 y dia2
-        print(f"🔍 Reemplazos a realizar: {len(reemplazos)} variables")
-        print(f"📅 dia1 (día inicio): '{dia_inicio}'")
-        print(f"📅 dia2 (día fin): '{dia_fin}'")
-        # Debug removido por seguridad - comentado para producción
-        # for key, value in sorted(reemplazos.items()):
-        #     if value and ('dia' in key.lower() or 'DIA' in key):
-        #         print(f"  - {key} -> {value}")
-        
-        # Reemplazar texto en el documento
-        reemplazar_texto_en_documento(doc, reemplazos)
-        print("✅ Reemplazos completados en el documento")
-        
-        # Verificar si dia1 y dia2 fueron reemplazados correctamente
-        texto_completo = ' '.join([para.text for para in doc.paragraphs])
-        if 'dia1' in texto_completo.lower() or 'dia2' in texto_completo.lower():
-            # Debug removido por seguridad - solo en desarrollo
-            # print(f"⚠️ ADVERTENCIA: Todavía hay 'dia1' o 'dia2' sin reemplazar en el documento")
-            # print(f"   Texto encontrado: {texto_completo[texto_completo.lower().find('dia'):texto_completo.lower().find('dia')+50]}")
-            pass
-        
-        # Limpiar duplicaciones después del reemplazo
-        # Buscar y limpiar patrones comunes de duplicación
-        import re
-        for paragraph in doc.paragraphs:
-            texto = paragraph.text
-            # Limpiar duplicaciones de año - múltiples patrones (aplicar varias veces para asegurar)
-            # Patrón 1: DE 2026 DE 2026 -> DE 2026
-            texto = re.sub(r'DE (\d{4}) DE \1', r'DE \1', texto)
-            # Patrón 2: DEL 2026 DEL 2026 -> DEL 2026
-            texto = re.sub(r'DEL (\d{4}) DEL \1', r'DEL \1', texto)
-            # Patrón 3: DE 2026 DEL 2026 -> DE 2026 (el más común)
-            texto = re.sub(r'DE (\d{4}) DEL \1', r'DE \1', texto)
-            # Patrón 4: DEL 2026 DE 2026 -> DEL 2026
-            texto = re.sub(r'DEL (\d{4}) DE \1', r'DEL \1', texto)
-            # Aplicar nuevamente para casos anidados
-            texto = re.sub(r'DE (\d{4}) DEL \1', r'DE \1', texto)
-            texto = re.sub(r'DEL (\d{4}) DE \1', r'DEL \1', texto)
-            # Limpiar múltiples símbolos $ seguidos
-            texto = re.sub(r'\$\$+', '$', texto)
-            texto = re.sub(r'\$ \$+', '$', texto)
-            # Limpiar espacios múltiples
-            texto = re.sub(r'  +', ' ', texto)
-            
-            if texto != paragraph.text:
-                # Guardar formato
-                formato_original = None
-                if paragraph.runs:
-                    primer_run = paragraph.runs[0]
-                    formato_original = {
-                        'font_name': primer_run.font.name if primer_run.font.name else None,
-                        'font_size': primer_run.font.size if primer_run.font.size else None,
-                        'bold': primer_run.bold if primer_run.bold is not None else False,
-                        'italic': primer_run.italic if primer_run.italic is not None else False,
-                        'color': primer_run.font.color.rgb if primer_run.font.color and primer_run.font.color.rgb else None
-                    }
-                
-                paragraph.clear()
-                nuevo_run = paragraph.add_run(texto)
-                
-                if formato_original:
-                    if formato_original['font_name']:
-                        nuevo_run.font.name = formato_original['font_name']
-                    if formato_original['font_size']:
-                        nuevo_run.font.size = formato_original['font_size']
-                    if formato_original['color']:
-                        nuevo_run.font.color.rgb = formato_original['color']
-                    nuevo_run.bold = formato_original['bold']
-                    nuevo_run.italic = formato_original['italic']
-        
-        # También limpiar en tablas
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        texto = paragraph.text
-                        # Limpiar duplicaciones de año - múltiples patrones (aplicar varias veces)
-                        # Patrón 1: DE 2026 DE 2026 -> DE 2026
-                        texto = re.sub(r'DE (\d{4}) DE \1', r'DE \1', texto)
-                        # Patrón 2: DEL 2026 DEL 2026 -> DEL 2026
-                        texto = re.sub(r'DEL (\d{4}) DEL \1', r'DEL \1', texto)
-                        # Patrón 3: DE 2026 DEL 2026 -> DE 2026 (el más común)
-                        texto = re.sub(r'DE (\d{4}) DEL \1', r'DE \1', texto)
-                        # Patrón 4: DEL 2026 DE 2026 -> DEL 2026
-                        texto = re.sub(r'DEL (\d{4}) DE \1', r'DEL \1', texto)
-                        # Aplicar nuevamente para casos anidados
-                        texto = re.sub(r'DE (\d{4}) DEL \1', r'DE \1', texto)
-                        texto = re.sub(r'DEL (\d{4}) DE \1', r'DEL \1', texto)
-                        texto = re.sub(r'\$\$+', '$', texto)
-                        texto = re.sub(r'\$ \$+', '$', texto)
-                        texto = re.sub(r'  +', ' ', texto)
-                        
-                        if texto != paragraph.text:
-                            formato_original = None
-                            if paragraph.runs:
-                                primer_run = paragraph.runs[0]
-                                formato_original = {
-                                    'font_name': primer_run.font.name if primer_run.font.name else None,
-                                    'font_size': primer_run.font.size if primer_run.font.size else None,
-                                    'bold': primer_run.bold if primer_run.bold is not None else False,
-                                    'italic': primer_run.italic if primer_run.italic is not None else False,
-                                    'color': primer_run.font.color.rgb if primer_run.font.color and primer_run.font.color.rgb else None
-                                }
-                            
-                            paragraph.clear()
-                            nuevo_run = paragraph.add_run(texto)
-                            
-                            if formato_original:
-                                if formato_original['font_name']:
-                                    nuevo_run.font.name = formato_original['font_name']
-                                if formato_original['font_size']:
-                                    nuevo_run.font.size = formato_original['font_size']
-                                if formato_original['color']:
-                                    nuevo_run.font.color.rgb = formato_original['color']
-                                nuevo_run.bold = formato_original['bold']
-                                nuevo_run.italic = formato_original['italic']
-        
-        print("✅ Limpieza de duplicaciones completada")
-        
-        # Procesar tablas: eliminar fila de ADICIONALES si no hay turnos, agregar AUXILIO DE TRANSPORTE si está seleccionado
-        for table in doc.tables:
-            filas_a_eliminar = []
-            indice_adicionales = -1
-            indice_ultima_fila_datos = -1
-            
-            # Buscar la fila de ADICIONALES y la última fila de datos (antes del TOTAL)
-            for idx, row in enumerate(table.rows):
-                row_text = ' '.join([cell.text.strip() for cell in row.cells]).upper()
-                
-                # Buscar fila de ADICIONALES
-                if 'ADICIONALES' in row_text and 'SUELDO FIJO' not in row_text and 'BONO' not in row_text:
-                    indice_adicionales = idx
-                
-                # Buscar última fila de datos (antes del TOTAL)
-                if 'TOTAL' not in row_text and 'SUELDO FIJO' in row_text or 'BONO' in row_text or 'ADICIONALES' in row_text:
-                    indice_ultima_fila_datos = idx
-            
-            # Eliminar fila de ADICIONALES si no hay turnos
-            if turnos_num == 0 and indice_adicionales >= 0:
-                filas_a_eliminar.append(indice_adicionales)
-                print(f"🗑️ Eliminando fila de ADICIONALES (índice {indice_adicionales}) - no hay turnos")
-            
-            # Eliminar filas en orden inverso para mantener los índices correctos
-            for idx in sorted(filas_a_eliminar, reverse=True):
-                if idx < len(table.rows):
-                    table._element.remove(table.rows[idx]._element)
-            
-            # Agregar fila de AUXILIO DE TRANSPORTE si está seleccionado
-            if tiene_auxilio_transporte and auxilio_transporte_num > 0:
-                # Buscar la fila del TOTAL para insertar antes de ella
-                indice_total = -1
-                for idx, row in enumerate(table.rows):
-                    row_text = ' '.join([cell.text.strip() for cell in row.cells]).upper()
-                    if 'TOTAL' in row_text:
-                        indice_total = idx
-                        break
-                
-                # Si no se encuentra TOTAL, usar el final de la tabla
-                if indice_total < 0:
-                    indice_total = len(table.rows)
-                
-                # Crear nueva fila al final primero
-                nueva_fila = table.add_row()
-                
-                # Llenar las celdas de la nueva fila
-                if len(nueva_fila.cells) >= 4:
-                    # Columna 1: Descripción
-                    nueva_fila.cells[0].text = 'AUXILIO DE TRANSPORTE'
-                    # Columna 2: Cantidad
-                    nueva_fila.cells[1].text = 'MES COMPLETO'
-                    # Columna 3: Valor
-                    nueva_fila.cells[2].text = ax1_formateado
-                    # Columna 4: Paciente (vacía)
-                    nueva_fila.cells[3].text = ''
-                
-                # Mover la fila a la posición correcta (antes del TOTAL)
-                if indice_total < len(table.rows) - 1:
-                    nueva_fila_element = nueva_fila._element
-                    tbl = table._element
-                    # Remover de la posición actual
-                    tbl.remove(nueva_fila_element)
-                    # Insertar antes del TOTAL
-                    fila_total = table.rows[indice_total]._element
-                    fila_total.addprevious(nueva_fila_element)
-                
-                print(f"✅ Agregada fila de AUXILIO DE TRANSPORTE con valor {ax1_formateado}")
+        return respuesta_documento(contenido, filename, tiempos, formato)
         
-        # Guardar en memoria
-        output = io.BytesIO()
-        doc.save(output)
-        output.seek(0)
+    except Exception as e:
+        import traceback
+        return jsonify({"error": str(e), "traceback": traceback.format_exc()}), 500
+
+# --- ZIP en streaming: cada documento se envía apenas se genera (memoria acotada sin importar el tamaño del lote) ---
+class _SalidaStream(io.RawIOBase):
+    """Destino no seekable para zipfile: guarda lo escrito solo hasta que el generador lo envía."""
+    
+    def __init__(self):
+        super().__init__()
+        self._pendiente = bytearray()
+    
+    def writable(self):
+        return True
+    
+    def write(self, datos):
+        self._pendiente += datos
+        return len(datos)
+    
+    def vaciar(self):
+        datos = bytes(self._pendiente)
+        self._pendiente.clear()
+        return datos
+
+def zip_en_stream(entradas):
+    """
+    Generador con los bytes de un ZIP armado a partir de (nombre, contenido).
+    Como el destino no es seekable, zipfile escribe cada entrada con data descriptor y no
+    necesita volver atrás: en memoria solo queda el documento actual y el directorio central.
+    """
+    import zipfile
+    salida = _SalidaStream()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for nombre, contenido in entradas:
+            zf.writestr(nombre, contenido)
+            datos = salida.vaciar()
+            if datos:
+                yield datos
+    # Directorio central (se escribe al cerrar el ZIP)
+    yield salida.vaciar()
+
+def respuesta_zip_stream(entradas, filename):
+    """Respuesta chunked (sin Content-Length) que va enviando el ZIP mientras se generan las entradas."""
+    return Response(
+        stream_with_context(zip_en_stream(entradas)),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            # Evitar que un proxy (nginx) acumule la respuesta completa antes de reenviarla
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+# Máximo de cuentas de cobro por petición al endpoint batch
+COBRO_BATCH_MAX = int(os.getenv('COBRO_BATCH_MAX', '500'))
+
+def _entradas_lote_cobro(items, formato='docx', backend=None):
+    """
+    Genera (archivo, contenido) por cada cuenta de cobro del lote y al final el manifest.json.
+    Con formato='pdf' los .docx se convierten en tandas de ILOVEPDF_LOTE_MAX (convertir_lote_a_pdf) y
+    cada tanda se entrega antes de generar la siguiente: en memoria solo hay una tanda.
+    Si la conversión de una tanda falla se entregan sus .docx y cada item lo indica en el manifest
+    (ok=False, formato='docx').
+    """
+    inicio = time.perf_counter()
+    manifest = []
+    para_pdf = []
+    extra = {}
+    
+    def convertir_tanda():
+        tiempos = {}
+        try:
+            convertidos = convertir_lote_a_pdf([(a, c) for a, c, _ in para_pdf], backend=backend, tiempos=tiempos)
+        except Exception as e:
+            extra['error_pdf'] = str(e)
+            for archivo, contenido, registro in para_pdf:
+                registro.update({'ok': False, 'formato': 'docx', 'error': f'No se pudo convertir a PDF: {e}'})
+                yield archivo, contenido
+        else:
+            acumulado = extra.setdefault('tiempos_pdf_ms', {})
+            for paso, ms in tiempos.items():
+                acumulado[paso] = round(acumulado.get(paso, 0) + ms, 2)
+            for (archivo, _, registro), (_, pdf_bytes, origen) in zip(para_pdf, convertidos):
+                archivo = _nombre_pdf(archivo)
+                registro.update({'archivo': archivo, 'bytes': len(pdf_bytes), 'formato': 'pdf', 'backend': origen})
+                yield archivo, pdf_bytes
+        para_pdf.clear()
+    
+    for i, item in enumerate(items, start=1):
+        registro = {'indice': i, 'nombre': item.get('nombre', '') if isinstance(item, dict) else ''}
+        manifest.append(registro)
+        try:
+            contenido, filename = generar_cuenta_cobro(item)
+        except (ValueError, FileNotFoundError) as e:
+            registro.update({'ok': False, 'error': str(e)})
+            continue
+        except Exception as e:
+            registro.update({'ok': False, 'error': f'Error interno: {e}'})
+            continue
+        # Prefijo con la posición: dos trabajadores con el mismo nombre no se pisan en el ZIP
+        archivo = f"{i:03d}_{filename}"
+        registro.update({'ok': True, 'archivo': archivo, 'bytes': len(contenido)})
+        if formato == 'pdf':
+            para_pdf.append((archivo, contenido, registro))
+            if len(para_pdf) >= max(ILOVEPDF_LOTE_MAX, 1):
+                yield from convertir_tanda()
+            continue
+        yield archivo, contenido
+    
+    if para_pdf:
+        yield from convertir_tanda()
+    
+    generados = sum(1 for r in manifest if r['ok'])
+    print(f"📦 Lote de cuentas de cobro: {generados}/{len(items)} generadas")
+    yield 'manifest.json', json.dumps({
+        'total': len(items),
+        'generados': generados,
+        'errores': len(items) - generados,
+        'formato': formato,
+        'ms': round((time.perf_counter() - inicio) * 1000, 1),
+        **extra,
+        'items': manifest,
+    }, ensure_ascii=False, indent=2)
+
+@app.route('/generate-cuenta-cobro/batch', methods=['POST'])
+def generate_cuenta_cobro_batch():
+    """
+    Genera varias cuentas de cobro en una sola petición y devuelve un ZIP con un .docx por trabajador.
+    Recibe una lista de payloads (los mismos de /generate-cuenta-cobro) o {"items": [...]}.
+    Los errores de cada item quedan en manifest.json dentro del ZIP en vez de tumbar todo el lote;
+    el template se parsea una sola vez y lo comparten todos los items. El ZIP se envía en streaming.
+    Con format=pdf (parámetro o campo del JSON) el ZIP trae PDFs, convertidos en tandas de ILOVEPDF_LOTE_MAX.
+    """
+    try:
+        data = request.get_json(silent=True)
+        items = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Se esperaba una lista de cuentas de cobro'}), 400
+        if len(items) > COBRO_BATCH_MAX:
+            return jsonify({'error': f'Máximo {COBRO_BATCH_MAX} cuentas de cobro por lote'}), 400
         
-        # Nombre del archivo
-        nombre_archivo = nombre.replace(' ', '_') if nombre else 'Cuenta_Cobro'
-        filename = f"Cuenta_Cobro_{nombre_archivo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
+        opciones = data if isinstance(data, dict) else {}
+        formato = formato_salida(opciones)
+        if formato is None:
+            return error_formato_salida()
+        backend = request.args.get('backend') or opciones.get('backend')
         
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            as_attachment=True,
-            download_name=filename
-        )
+        filename = f"Cuentas_Cobro_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        return respuesta_zip_stream(_entradas_lote_cobro(items, formato, backend), filename)
         
     except Exception as e:
         import traceback
@@ -1716,6 +3995,9 @@ def generate_contrato_arrendamiento():
             return jsonify({'error': 'No se recibieron datos'}), 400
         
         data = request.json
+        formato = formato_salida(data)
+        if formato is None:
+            return error_formato_salida()
         
         # Validar y sanitizar datos del formulario
         nombre_arrendador = sanitize_input(data.get('nombreArrendador', ''), max_length=200)
@@ -1746,7 +4028,7 @@ def generate_contrato_arrendamiento():
         anio_firma = sanitize_input(data.get('anioFirma', ''), max_length=10)
         
         # Obtener hectáreas en texto si viene del formulario
-        hectareas_arrendadas_texto = data.get('hectareasArrendadasTexto', '')
+        hectareas_arrendadas_texto = sanitize_input(data.get('hectareasArrendadasTexto', ''), max_length=200)
         if not hectareas_arrendadas_texto and hectareas_arrendadas:
             try:
                 hectareas_num = float(hectareas_arrendadas.replace(',', '.'))
@@ -1756,7 +4038,7 @@ def generate_contrato_arrendamiento():
                 hectareas_arrendadas_texto = hectareas_arrendadas
         
         # Obtener nombre del mes
-        mes_nombre = data.get('mesFirmaNombre', '')
+        mes_nombre = sanitize_input(data.get('mesFirmaNombre', ''), max_length=20)
         if not mes_nombre and mes_firma:
             try:
                 mes_num = int(mes_firma)
@@ -1765,24 +4047,22 @@ def generate_contrato_arrendamiento():
             except:
                 mes_nombre = mes_firma
         
-        # Cargar template
-        base_dir = os.path.dirname(__file__)
-        template_path = os.path.join(base_dir, 'templates', 'contrato.docx')
-        
-        # Debug: Listar archivos en templates si no existe
-        if not os.path.exists(template_path):
-            templates_dir = os.path.join(base_dir, 'templates')
+        # Versión del template (lo carga en el catálogo si hace falta)
+        try:
+            version = version_template('contrato')
+        except FileNotFoundError:
+            # Debug: Listar archivos en templates si no existe
+            base_dir = os.path.dirname(__file__)
+            template_path = resolver_template_path('contrato')
             available_files = []
-            if os.path.exists(templates_dir):
-                available_files = os.listdir(templates_dir)
+            if os.path.exists(TEMPLATES_DIR):
+                available_files = os.listdir(TEMPLATES_DIR)
             error_msg = f"Template no encontrado en: {template_path}\n"
             error_msg += f"Directorio base: {base_dir}\n"
-            error_msg += f"Directorio templates: {templates_dir}\n"
+            error_msg += f"Directorio templates: {TEMPLATES_DIR}\n"
             error_msg += f"Archivos disponibles en templates: {', '.join(available_files) if available_files else 'Ninguno'}"
             return jsonify({"error": error_msg}), 404
         
-        doc = Document(template_path)
-        
         # Preparar reemplazos con todas las variaciones posibles
         reemplazos = {}
         
@@ -1832,64 +4112,47 @@ def generate_contrato_arrendamiento():
         reemplazos['{{MES_FIRMA}}'] = mes_nombre.upper()
         reemplazos['{{ANIO_FIRMA}}'] = anio_firma
         
-        # Reemplazar texto en el documento
-        reemplazar_texto_en_documento(doc, reemplazos)
-        
-        # Limpiar duplicaciones después del reemplazo
-        # Buscar y limpiar patrones comunes de duplicación
-        import re
-        for paragraph in doc.paragraphs:
-            texto = paragraph.text
-            # Limpiar duplicaciones específicas primero
-            # "CONVENCIÓN de CONVENCIÓN" -> "CONVENCIÓN"
-            texto = re.sub(r'\b(CONVENCIÓN)\s+de\s+\1\b', r'\1', texto, flags=re.IGNORECASE)
-            # "NORTE DE SANTANDER de NORTE DE SANTANDER" -> "NORTE DE SANTANDER"
-            texto = re.sub(r'\b(NORTE DE SANTANDER)\s+de\s+\1\b', r'\1', texto, flags=re.IGNORECASE)
-            # Limpiar duplicaciones generales: "TEXTO de TEXTO" -> "TEXTO"
-            # Aplicar múltiples veces para casos anidados
-            for _ in range(3):  # Aplicar hasta 3 veces para casos complejos
-                # Patrón que captura cualquier texto seguido de " de " y el mismo texto
-                texto_anterior = texto
-                # Mejorar el patrón para capturar mejor textos con espacios
-                texto = re.sub(r'\b([A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑ\s]{2,}?)\s+de\s+\1\b', r'\1', texto, flags=re.IGNORECASE)
-                if texto == texto_anterior:
-                    break  # No hay más cambios
-            # Limpiar duplicaciones de año - múltiples patrones
-            texto = re.sub(r'DE (\d{4}) DE \1', r'DE \1', texto)
-            texto = re.sub(r'DEL (\d{4}) DEL \1', r'DEL \1', texto)
-            texto = re.sub(r'DE (\d{4}) DEL \1', r'DE \1', texto)
-            texto = re.sub(r'DEL (\d{4}) DE \1', r'DEL \1', texto)
-            # Aplicar nuevamente para casos anidados
-            texto = re.sub(r'DE (\d{4}) DEL \1', r'DE \1', texto)
-            texto = re.sub(r'DEL (\d{4}) DE \1', r'DEL \1', texto)
-            # Limpiar espacios múltiples
-            texto = re.sub(r'  +', ' ', texto)
+        usar_xml = modo_render(data) == 'xml'
+        
+        def renderizar():
+            plantilla = plantilla_xml('contrato') if usar_xml else None
+            if plantilla is not None:
+                # Render directo sobre el XML del template (incluye la limpieza de duplicaciones)
+                return renderizar_xml(plantilla, reemplazos)
             
-            if texto != paragraph.text:
-                # Limpiar el párrafo y reconstruirlo
-                paragraph.clear()
-                paragraph.add_run(texto)
-        
-        # Guardar en memoria
-        output = io.BytesIO()
-        doc.save(output)
-        output.seek(0)
+            # Cargar template (copia del template ya parseado en el registro)
+            doc = obtener_template('contrato')
+            
+            # Reemplazar (solo en los párrafos indexados del template) y limpiar duplicaciones en un solo recorrido
+            procesar_documento(doc, reemplazos, LIMPIEZA_TEMPLATES['contrato'], indice=indice_template('contrato'))
+            
+            # Guardar en memoria
+            output = io.BytesIO()
+            doc.save(output)
+            return output.getvalue()
+        
+        tiempos = {}
+        with medir_paso(tiempos, 'docx'):
+            contenido = render_cacheado('contrato', version, {
+                'reemplazos': reemplazos,
+                'xml': usar_xml,
+                'motor': MOTOR_REEMPLAZO,
+            }, renderizar)
         
         # Nombre del archivo
         nombre_archivo = nombre_arrendador.replace(' ', '_') if nombre_arrendador else 'Contrato_Arrendamiento'
         filename = f"Contrato_Arrendamiento_{nombre_archivo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
         
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            as_attachment=True,
-            download_name=filename
-        )
+        return respuesta_documento(contenido, filename, tiempos, formato)
         
     except Exception as e:
         import traceback
         return jsonify({"error": str(e), "traceback": traceback.format_exc()}), 500
 
+# Los templates se cargan al primer uso; PRECARGAR_TEMPLATES=1 los parsea al arrancar cada worker
+if os.getenv('PRECARGAR_TEMPLATES', '0') == '1':
+    precargar_templates()
+
 if __name__ == '__main__':
     # Crear directorio de templates si no existe
     os.makedirs(os.path.join(os.path.dirname(__file__), 'templates'), exist_ok=True)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de /convert-word-to-pdf: throughput y latencias p50/p95/p99 con varios niveles de concurrencia.
+
+Por defecto no gasta créditos: arranca fake_ilovepdf.py y la API en este mismo proceso
+(servidor de desarrollo con hilos), con la caché de PDFs desactivada.
+
+Uso:
+    python bench_conversion.py [--concurrencia 1,4,8,16] [--peticiones 100] [--archivo templates/hv.docx]
+                               [--latencia 0.05] [--fallos 0.02] [--creditos-principal 50]
+    python bench_conversion.py --api http://localhost:5000      # contra una API ya arrancada
+
+Además de las latencias, muestra el promedio de cada paso de la cabecera Server-Timing y, con el
+servidor falso, cuántas conexiones TCP y autenticaciones hubo (keep-alive y token reutilizado).
+"""
+
+import argparse
+import io
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import requests
+except ImportError:
+    print("Instala requests: pip install requests")
+    sys.exit(1)
+
+# Configurar encoding para Windows
+if sys.platform == 'win32':
+    import codecs
+    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+    sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+
+
+def percentil(valores_ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not valores_ordenados:
+        return 0.0
+    rango = max(math.ceil(p / 100 * len(valores_ordenados)), 1)
+    return valores_ordenados[rango - 1]
+
+
+def docx_de_prueba(ruta=None):
+    """Bytes del .docx a convertir: el archivo indicado o uno pequeño generado en memoria."""
+    if ruta:
+        with open(ruta, 'rb') as f:
+            return f.read()
+    from docx import Document
+    doc = Document()
+    doc.add_heading('Benchmark de conversión', level=1)
+    for i in range(20):
+        doc.add_paragraph(f'Párrafo de prueba {i + 1}: texto para convertir a PDF.')
+    salida = io.BytesIO()
+    doc.save(salida)
+    return salida.getvalue()
+
+
+def arrancar_api_local(args):
+    """iLovePDF falso + la API en hilos de este proceso. Devuelve (url_api, url_fake)."""
+    import fake_ilovepdf
+    from werkzeug.serving import make_server
+
+    creditos = {}
+    if args.creditos_principal is not None:
+        creditos['bench_principal'] = args.creditos_principal
+    config = fake_ilovepdf.configuracion(args.latencia, args.jitter, args.fallos, creditos=creditos,
+                                         proceso_async=args.proceso_async)
+    _, url_fake = fake_ilovepdf.iniciar_en_hilo(config)
+
+    # La configuración de app.py se lee al importarlo
+    os.environ.update({
+        'ILOVEPDF_BASE_URL': url_fake,
+        'ILOVEPDF_PRIMARY_PUBLIC_KEY': 'bench_principal',
+        'ILOVEPDF_PRIMARY_SECRET_KEY': 'bench',
+        'ILOVEPDF_BACKUP_PUBLIC_KEY': 'bench_respaldo',
+        'ILOVEPDF_BACKUP_SECRET_KEY': 'bench',
+        'PDF_BACKEND': 'ilovepdf',
+        'PDF_CACHE_MAX_MB': '0',
+    })
+    import app as api
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    servidor = make_server('127.0.0.1', 0, api.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, name='api-bench', daemon=True).start()
+    return f'http://127.0.0.1:{servidor.server_port}', url_fake
+
+
+def medir_nivel(url_api, docx_bytes, concurrencia, peticiones):
+    """Lanza `peticiones` conversiones con `concurrencia` hilos. Devuelve el resumen del nivel."""
+    local = threading.local()
+    latencias = []
+    pasos = defaultdict(list)
+    estados = Counter()
+    backends = Counter()
+    lock = threading.Lock()
+
+    def una():
+        # Una sesión por hilo: el cliente también reutiliza conexiones
+        if not hasattr(local, 'sesion'):
+            local.sesion = requests.Session()
+        inicio = time.perf_counter()
+        try:
+            r = local.sesion.post(f'{url_api}/convert-word-to-pdf', params={'cache': '0'},
+                                  files={'file': ('bench.docx', docx_bytes)}, timeout=300)
+            estado = r.status_code
+        except requests.RequestException as e:
+            r, estado = None, type(e).__name__
+        ms = (time.perf_counter() - inicio) * 1000
+        with lock:
+            estados[estado] += 1
+            if estado == 200 and r is not None:
+                latencias.append(ms)
+                backends[r.headers.get('X-PDF-Backend', '?')] += 1
+                for item in filter(None, (x.strip() for x in r.headers.get('Server-Timing', '').split(','))):
+                    nombre, _, dur = item.partition(';dur=')
+                    try:
+                        pasos[nombre].append(float(dur))
+                    except ValueError:
+                        pass
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+        for _ in executor.map(lambda _: una(), range(peticiones)):
+            pass
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        'concurrencia': concurrencia,
+        'ok': estados.get(200, 0),
+        'errores': sum(n for estado, n in estados.items() if estado != 200),
+        'estados': dict(estados),
+        'rps': estados.get(200, 0) / total if total else 0.0,
+        'p50': percentil(latencias, 50),
+        'p95': percentil(latencias, 95),
+        'p99': percentil(latencias, 99),
+        'pasos': {nombre: sum(v) / len(v) for nombre, v in pasos.items()},
+        'backends': dict(backends),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de /convert-word-to-pdf')
+    parser.add_argument('--api', help='URL de una API ya arrancada (si no, se arranca una local con iLovePDF falso)')
+    parser.add_argument('--concurrencia', default='1,4,8,16', help='Niveles de concurrencia separados por coma')
+    parser.add_argument('--peticiones', type=int, default=100, help='Peticiones por nivel')
+    parser.add_argument('--archivo', help='.docx a convertir (por defecto uno pequeño generado)')
+    parser.add_argument('--latencia', type=float, default=0.02, help='Latencia por paso del iLovePDF falso (s)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Variación relativa de la latencia')
+    parser.add_argument('--fallos', type=float, default=0.0, help='Probabilidad de 503 en el iLovePDF falso')
+    parser.add_argument('--creditos-principal', type=int, help='Créditos de la clave principal (prueba el respaldo)')
+    parser.add_argument('--proceso-async', type=float, default=0.0, help='Segundos hasta que la tarea queda lista')
+    args = parser.parse_args()
+
+    niveles = [int(n) for n in args.concurrencia.split(',') if n.strip()]
+    docx_bytes = docx_de_prueba(args.archivo)
+
+    url_fake = None
+    if args.api:
+        url_api = args.api.rstrip('/')
+    else:
+        url_api, url_fake = arrancar_api_local(args)
+        print(f"🧪 iLovePDF falso en {url_fake} (latencia {args.latencia}s/paso, fallos {args.fallos:.0%})")
+    print(f"📄 Documento de {len(docx_bytes) / 1024:.1f} KB, {args.peticiones} peticiones por nivel\n")
+
+    print(f"{'conc':>5} {'ok':>5} {'err':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    resultados = []
+    for concurrencia in niveles:
+        if url_fake:
+            requests.post(f'{url_fake}/reset', timeout=10)
+        resultado = medir_nivel(url_api, docx_bytes, concurrencia, args.peticiones)
+        if url_fake:
+            resultado['fake'] = requests.get(f'{url_fake}/stats', timeout=10).json()
+        resultados.append(resultado)
+        print(f"{concurrencia:>5} {resultado['ok']:>5} {resultado['errores']:>5} {resultado['rps']:>8.1f} "
+              f"{resultado['p50']:>9.1f} {resultado['p95']:>9.1f} {resultado['p99']:>9.1f}")
+
+    print("\nPromedio por paso (Server-Timing, ms):")
+    for resultado in resultados:
+        pasos = ', '.join(f"{nombre}={ms:.1f}" for nombre, ms in resultado['pasos'].items())
+        print(f"  conc {resultado['concurrencia']:>3}: {pasos or '-'}")
+        if resultado['errores']:
+            print(f"           estados: {resultado['estados']}")
+        if 'fake' in resultado:
+            fake = resultado['fake']
+            print(f"           iLovePDF: {fake['conexiones']} conexiones, {fake['llamadas']['auth']} auth, "
+                  f"{fake['llamadas']['start']} start, {fake['errores_inyectados']} fallos inyectados, "
+                  f"{fake['sin_creditos']} sin créditos, archivos por clave {fake['procesados']}")
+
+
+if __name__ == '__main__':
+    main()
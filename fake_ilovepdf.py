@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Servidor local que imita la API de iLovePDF (auth, start, upload, process, task, download)
+para probar y medir la conversión a PDF sin gastar créditos.
+
+Uso:
+    python fake_ilovepdf.py [--puerto 8765] [--latencia 0.05] [--latencia upload=0.2]
+                            [--fallos 0.05] [--fallos-paso process] [--creditos clave=20]
+                            [--proceso-async 0.5]
+
+y arrancar la API apuntando a él:
+    ILOVEPDF_BASE_URL=http://127.0.0.1:8765 ILOVEPDF_PRIMARY_PUBLIC_KEY=prueba \
+    ILOVEPDF_PRIMARY_SECRET_KEY=prueba PDF_BACKEND=ilovepdf python app.py
+
+- Latencia: segundos por paso (uno para todos o paso=segundos), con jitter opcional.
+- Fallos: probabilidad de responder 503 en cada llamada (o solo en los pasos indicados).
+- Créditos: archivos que puede procesar cada public_key; al agotarse responde 401 "Not enough credits".
+- Proceso asíncrono: /v1/process responde TaskProcessing y la tarea queda lista N segundos después.
+- Salida: siempre el mismo PDF mínimo; con varios archivos, un ZIP con <nombre>.pdf por archivo.
+
+GET /stats devuelve llamadas por paso y conexiones TCP distintas (para ver el keep-alive);
+POST /reset las pone en cero y restaura los créditos.
+"""
+
+import argparse
+import base64
+import io
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from flask import Flask, request, jsonify, Response
+
+# Configurar encoding para Windows
+if sys.platform == 'win32':
+    import codecs
+    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+    sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+
+PASOS = ('auth', 'start', 'upload', 'process', 'task', 'download')
+
+# PDF mínimo válido (~200 bytes)
+MINI_PDF = b"""%PDF-1.4
+1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj
+2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj
+3 0 obj<</Type/Page/MediaBox[0 0 612 792]/Parent 2 0 R>>endobj
+xref
+0 4
+0000000000 65535 f
+0000000009 00000 n
+0000000052 00000 n
+0000000101 00000 n
+trailer<</Size 4/Root 1 0 R>>
+startxref
+178
+%%EOF"""
+
+
+def configuracion(latencia=None, jitter=0.0, fallos=0.0, fallos_pasos=None, creditos=None,
+                  proceso_async=0.0, ttl_token=7200):
+    """Configuración del servidor falso. `latencia` es un número (todos los pasos) o un dict paso -> segundos."""
+    if not isinstance(latencia, dict):
+        latencia = {paso: float(latencia or 0) for paso in PASOS}
+    return {
+        'latencia': {paso: float(latencia.get(paso, 0)) for paso in PASOS},
+        'jitter': float(jitter),
+        'fallos': float(fallos),
+        'fallos_pasos': set(fallos_pasos or PASOS),
+        'creditos': dict(creditos or {}),  # public_key -> archivos (las claves no listadas no tienen límite)
+        'proceso_async': float(proceso_async),
+        'ttl_token': float(ttl_token),
+    }
+
+
+def crear_app(config=None):
+    """App Flask del servidor falso. El estado (tareas, créditos, estadísticas) vive en app.config['FAKE']."""
+    config = config or configuracion()
+    app = Flask('fake_ilovepdf')
+    lock = threading.Lock()
+    estado = {
+        'tareas': {},
+        'creditos': dict(config['creditos']),
+        'llamadas': {paso: 0 for paso in PASOS},
+        'errores_inyectados': 0,
+        'sin_creditos': 0,
+        'procesados': {},  # public_key -> archivos convertidos
+        'conexiones': set(),
+    }
+    app.config['FAKE'] = estado
+
+    def token_para(public_key):
+        payload = json.dumps({'exp': time.time() + config['ttl_token'], 'pk': public_key}).encode()
+        return 'fake.' + base64.urlsafe_b64encode(payload).decode().rstrip('=') + '.firma'
+
+    def clave_del_token():
+        try:
+            payload = request.headers.get('Authorization', '').split(' ', 1)[1].split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload))['pk']
+        except Exception:
+            return None
+
+    def entrar(paso):
+        """Cuenta la llamada, aplica la latencia y, según la probabilidad configurada, devuelve un 503."""
+        with lock:
+            estado['llamadas'][paso] += 1
+            estado['conexiones'].add((request.remote_addr, request.environ.get('REMOTE_PORT')))
+        espera = config['latencia'][paso]
+        if config['jitter']:
+            espera *= 1 + random.uniform(-config['jitter'], config['jitter'])
+        if espera > 0:
+            time.sleep(espera)
+        if paso in config['fallos_pasos'] and random.random() < config['fallos']:
+            with lock:
+                estado['errores_inyectados'] += 1
+            return jsonify({'error': {'type': 'ServerError', 'message': 'Fallo inyectado'}}), 503
+        return None
+
+    def sin_creditos():
+        with lock:
+            estado['sin_creditos'] += 1
+        return jsonify({'error': {'type': 'AuthError', 'message': 'Not enough credits'}}), 401
+
+    def creditos_restantes(public_key):
+        return estado['creditos'].get(public_key)
+
+    @app.post('/v1/auth')
+    def auth():
+        fallo = entrar('auth')
+        if fallo:
+            return fallo
+        public_key = (request.get_json(silent=True) or {}).get('public_key')
+        if not public_key:
+            return jsonify({'error': {'type': 'AuthError', 'message': 'Falta public_key'}}), 401
+        return jsonify({'token': token_para(public_key)})
+
+    @app.get('/v1/start/<tool>')
+    def start(tool):
+        fallo = entrar('start')
+        if fallo:
+            return fallo
+        public_key = clave_del_token()
+        if public_key is None:
+            return jsonify({'error': {'type': 'AuthError', 'message': 'Token inválido'}}), 401
+        restantes = creditos_restantes(public_key)
+        if restantes is not None and restantes <= 0:
+            return sin_creditos()
+        task = uuid.uuid4().hex
+        with lock:
+            estado['tareas'][task] = {'public_key': public_key, 'archivos': {}, 'procesados': [], 'lista_en': None}
+        return jsonify({'server': request.host, 'task': task, 'remaining_files': restantes})
+
+    @app.post('/v1/upload')
+    def upload():
+        fallo = entrar('upload')
+        if fallo:
+            return fallo
+        tarea = estado['tareas'].get(request.form.get('task'))
+        archivo = request.files.get('file')
+        if tarea is None or archivo is None:
+            return jsonify({'error': {'type': 'UploadError', 'message': 'Tarea o archivo inválido'}}), 400
+        server_filename = uuid.uuid4().hex + '.docx'
+        with lock:
+            tarea['archivos'][server_filename] = len(archivo.read())
+        return jsonify({'server_filename': server_filename})
+
+    @app.post('/v1/process')
+    def process():
+        fallo = entrar('process')
+        if fallo:
+            return fallo
+        datos = request.get_json(silent=True) or {}
+        tarea = estado['tareas'].get(datos.get('task'))
+        archivos = datos.get('files') or []
+        if tarea is None or not archivos or any(f.get('server_filename') not in tarea['archivos'] for f in archivos):
+            return jsonify({'error': {'type': 'ProcessError', 'message': 'Tarea o archivos inválidos'}}), 400
+        with lock:
+            restantes = estado['creditos'].get(tarea['public_key'])
+            if restantes is not None and restantes < len(archivos):
+                agotado = True
+            else:
+                agotado = False
+                if restantes is not None:
+                    estado['creditos'][tarea['public_key']] = restantes - len(archivos)
+                estado['procesados'][tarea['public_key']] = estado['procesados'].get(tarea['public_key'], 0) + len(archivos)
+                tarea['procesados'] = [f.get('filename') or f['server_filename'] for f in archivos]
+                tarea['lista_en'] = time.monotonic() + config['proceso_async']
+        if agotado:
+            return sin_creditos()
+        if config['proceso_async'] > 0:
+            return jsonify({'status': 'TaskProcessing'})
+        return jsonify({'status': 'TaskSuccess', 'output_filenumber': len(archivos)})
+
+    @app.get('/v1/task/<task>')
+    def task_estado(task):
+        fallo = entrar('task')
+        if fallo:
+            return fallo
+        tarea = estado['tareas'].get(task)
+        if tarea is None:
+            return jsonify({'status': 'TaskNotFound'})
+        if tarea['lista_en'] is None:
+            return jsonify({'status': 'TaskWaiting'})
+        return jsonify({'status': 'TaskSuccess' if time.monotonic() >= tarea['lista_en'] else 'TaskProcessing'})
+
+    @app.get('/v1/download/<task>')
+    def download(task):
+        fallo = entrar('download')
+        if fallo:
+            return fallo
+        tarea = estado['tareas'].get(task)
+        if tarea is None or tarea['lista_en'] is None or time.monotonic() < tarea['lista_en']:
+            return jsonify({'error': {'type': 'DownloadError', 'message': 'La tarea aún no está lista'}}), 404
+        with lock:
+            estado['tareas'].pop(task, None)
+        if len(tarea['procesados']) == 1:
+            return Response(MINI_PDF, mimetype='application/pdf')
+        salida = io.BytesIO()
+        with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for nombre in tarea['procesados']:
+                zf.writestr(nombre.rsplit('.', 1)[0] + '.pdf', MINI_PDF)
+        return Response(salida.getvalue(), mimetype='application/zip')
+
+    @app.get('/stats')
+    def stats():
+        with lock:
+            return jsonify({
+                'llamadas': dict(estado['llamadas']),
+                'conexiones': len(estado['conexiones']),
+                'errores_inyectados': estado['errores_inyectados'],
+                'sin_creditos': estado['sin_creditos'],
+                'creditos': dict(estado['creditos']),
+                'procesados': dict(estado['procesados']),
+                'tareas_abiertas': len(estado['tareas']),
+            })
+
+    @app.post('/reset')
+    def reset():
+        with lock:
+            estado['tareas'].clear()
+            estado['creditos'] = dict(config['creditos'])
+            estado['llamadas'] = {paso: 0 for paso in PASOS}
+            estado['errores_inyectados'] = 0
+            estado['sin_creditos'] = 0
+            estado['procesados'] = {}
+            estado['conexiones'] = set()
+        return jsonify({'ok': True})
+
+    return app
+
+
+class _HandlerWsgi(BaseHTTPRequestHandler):
+    """
+    Sirve la app WSGI con HTTP/1.1 y keep-alive, como la API real, para poder medir la reutilización
+    de conexiones (el servidor de desarrollo de werkzeug cierra la conexión después de cada respuesta).
+    Solo admite cuerpos con Content-Length, que es lo que envía requests.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Cabeceras y cuerpo salen en dos escrituras: sin TCP_NODELAY el ACK retardado suma ~40 ms por llamada
+    disable_nagle_algorithm = True
+    app: Flask  # lo asigna iniciar_en_hilo en la subclase
+
+    def _servir(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        cuerpo = self.rfile.read(longitud) if longitud else b''
+        ruta, _, query = self.path.partition('?')
+        host, puerto = self.connection.getsockname()[:2]
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(ruta),
+            'QUERY_STRING': query,
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(puerto),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'REMOTE_PORT': self.client_address[1],
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(longitud),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(cuerpo),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for clave, valor in self.headers.items():
+            nombre = clave.upper().replace('-', '_')
+            if nombre not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[f'HTTP_{nombre}'] = valor
+
+        respuesta = {}
+
+        def start_response(status, headers, exc_info=None):
+            respuesta['status'] = status
+            respuesta['headers'] = headers
+
+        resultado = self.app(environ, start_response)
+        try:
+            datos = b''.join(resultado)
+        finally:
+            if hasattr(resultado, 'close'):
+                resultado.close()
+        codigo, _, razon = respuesta['status'].partition(' ')
+        self.send_response(int(codigo), razon)
+        for clave, valor in respuesta['headers']:
+            if clave.lower() not in ('content-length', 'connection'):
+                self.send_header(clave, valor)
+        self.send_header('Content-Length', str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    do_GET = do_POST = _servir
+
+    def log_message(self, format, *args):
+        pass
+
+
+def iniciar_en_hilo(config=None, host='127.0.0.1', puerto=0):
+    """Arranca el servidor falso en un hilo (HTTP/1.1 con keep-alive). Devuelve (servidor, url_base)."""
+    handler = type('Handler', (_HandlerWsgi,), {'app': crear_app(config)})
+    servidor = ThreadingHTTPServer((host, puerto), handler)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='fake-ilovepdf', daemon=True).start()
+    return servidor, f'http://{host}:{servidor.server_port}'
+
+
+
+def _parsear_latencia(valores):
+    latencia = {paso: 0.0 for paso in PASOS}
+    for valor in valores or []:
+        if '=' in valor:
+            paso, segundos = valor.split('=', 1)
+            if paso not in PASOS:
+                raise SystemExit(f"Paso desconocido '{paso}'. Pasos: {', '.join(PASOS)}")
+            latencia[paso] = float(segundos)
+        else:
+            latencia = {paso: float(valor) for paso in PASOS}
+    return latencia
+
+
+def _parsear_creditos(valores):
+    creditos = {}
+    for valor in valores or []:
+        clave, cantidad = valor.rsplit('=', 1)
+        creditos[clave] = int(cantidad)
+    return creditos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor local que imita la API de iLovePDF')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--latencia', action='append', metavar='[PASO=]SEGUNDOS',
+                        help='Latencia de todos los pasos o de uno (se puede repetir)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Variación relativa de la latencia (0.2 = ±20%%)')
+    parser.add_argument('--fallos', type=float, default=0.0, help='Probabilidad de responder 503 (0-1)')
+    parser.add_argument('--fallos-paso', action='append', choices=PASOS, help='Limitar los fallos a estos pasos')
+    parser.add_argument('--creditos', action='append', metavar='PUBLIC_KEY=N', help='Archivos que puede procesar una clave')
+    parser.add_argument('--proceso-async', type=float, default=0.0, metavar='SEGUNDOS',
+                        help='process responde TaskProcessing y la tarea queda lista después de N segundos')
+    parser.add_argument('--ttl-token', type=float, default=7200, help='Vida del token en segundos')
+    args = parser.parse_args()
+
+    config = configuracion(_parsear_latencia(args.latencia), args.jitter, args.fallos, args.fallos_paso,
+                           _parsear_creditos(args.creditos), args.proceso_async, args.ttl_token)
+    servidor, url = iniciar_en_hilo(config, args.host, args.puerto)
+    print(f"🧪 iLovePDF falso escuchando en {url}")
+    print(f"   ILOVEPDF_BASE_URL={url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        servidor.shutdown()
+        print("\n👋 Detenido")
+
+
+if __name__ == '__main__':
+    main()
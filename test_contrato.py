@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script de prueba para el endpoint de contrato de arrendamiento
+Verifica que el render XML genere un Word que se pueda abrir aunque lleguen caracteres de control
+y que los saltos de línea y tabulaciones de los valores lleguen como w:br / w:tab
+"""
+
+import io
+import json
+import re
+import sys
+import zipfile
+
+import requests
+from docx import Document
+
+# Configurar encoding para Windows
+if sys.platform == 'win32':
+    import codecs
+    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+    sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+
+# URL local
+API_URL = "http://localhost:5000"
+
+# Datos de prueba (con caracteres de control que XML 1.0 no admite)
+test_data = {
+    "nombreArrendador": "JUAN PEREZ",
+    "cedulaArrendador": "1234567890",
+    "nombreArrendatario": "MARIA GARCIA",
+    "cedulaArrendatario": "9876543210",
+    "nombrePredio": "LA\x0bESPERANZA",
+    "hectareasArrendadas": "3.5",
+    "hectareasArrendadasTexto": "tres\x0bcinco",
+    "mesFirma": "1",
+    "mesFirmaNombre": "ene\x01ro",
+    "anioFirma": "2026",
+    "modoRender": "xml"
+}
+
+def test_generate_contrato_caracteres_control():
+    """El contrato generado en modo xml se abre con python-docx y no conserva los caracteres de control"""
+    print("[TEST] Probando contrato con caracteres de control (modoRender=xml)...")
+    print(f"[ENVIO] Enviando datos: {json.dumps(test_data, indent=2, ensure_ascii=False)}")
+
+    try:
+        response = requests.post(
+            f"{API_URL}/generate-contrato-arrendamiento",
+            json=test_data,
+            timeout=30
+        )
+
+        print(f"\n[STATUS] Status Code: {response.status_code}")
+        if response.status_code != 200:
+            print(f"[ERROR] Error Text: {response.text[:500]}")
+            return False
+
+        # Reabrir el Word: un carácter inválido en w:t hace fallar el parseo
+        doc = Document(io.BytesIO(response.content))
+        texto = '\n'.join(p.text for p in doc.paragraphs)
+        for t in doc.tables:
+            for row in t.rows:
+                for cell in row.cells:
+                    texto += '\n' + cell.text
+        if '\x0b' in texto or '\x01' in texto:
+            print("[ERROR] El documento conserva caracteres de control")
+            return False
+        print(f"[OK] Documento válido ({len(response.content)} bytes)")
+        return True
+
+    except requests.exceptions.ConnectionError:
+        print(f"[ERROR] No se pudo conectar a {API_URL}")
+        print("[INFO] Asegúrate de que el servidor esté corriendo: python app.py")
+        return False
+    except Exception as e:
+        print(f"[ERROR] Error inesperado: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def test_generate_contrato_saltos_de_linea(modo='docx'):
+    """Un valor con \\n y \\t queda como <w:br/> y <w:tab/> en el run, no como texto dentro de w:t"""
+    print(f"[TEST] Probando saltos de línea y tabulaciones (modoRender={modo})...")
+    datos = dict(test_data, nombrePredio="LA\nESPERANZA\tTAB", modoRender=modo)
+
+    try:
+        response = requests.post(
+            f"{API_URL}/generate-contrato-arrendamiento",
+            json=datos,
+            timeout=30
+        )
+
+        print(f"\n[STATUS] Status Code: {response.status_code}")
+        if response.status_code != 200:
+            print(f"[ERROR] Error Text: {response.text[:500]}")
+            return False
+
+        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
+            xml = z.read('word/document.xml').decode('utf-8')
+        if not re.search(r'LA</w:t><w:br/><w:t[^>]*>ESPERANZA</w:t><w:tab/><w:t[^>]*>TAB</w:t>', xml):
+            print("[ERROR] El salto de línea o la tabulación no se convirtieron en w:br / w:tab")
+            return False
+        print("[OK] Saltos de línea y tabulaciones como w:br / w:tab")
+        return True
+
+    except requests.exceptions.ConnectionError:
+        print(f"[ERROR] No se pudo conectar a {API_URL}")
+        print("[INFO] Asegúrate de que el servidor esté corriendo: python app.py")
+        return False
+    except Exception as e:
+        print(f"[ERROR] Error inesperado: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("PRUEBA LOCAL - CONTRATO CON CARACTERES DE CONTROL")
+    print("=" * 60)
+    print()
+
+    success = test_generate_contrato_caracteres_control()
+    success = test_generate_contrato_saltos_de_linea('docx') and success
+    success = test_generate_contrato_saltos_de_linea('xml') and success
+
+    print()
+    print("=" * 60)
+    print("[RESULTADO] PRUEBA EXITOSA" if success else "[RESULTADO] PRUEBA FALLIDA")
+    print("=" * 60)